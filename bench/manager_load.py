@@ -0,0 +1,514 @@
+"""
+Load test of the manager's message routing.
+
+    python bench/manager_load.py [n_clients] [seconds] [lines] [--real]
+                                 [--binary] [--stalled=N] [--reconnect=K]
+                                 [--nodes=N] [--greedy=N] [--fifo]
+                                 [--cell-ms=T] [--max-running=N]
+                                 [--cpu=N] [--affinity=POLICY]
+
+Each of n_clients WebSocket sessions runs ExecCells back to back, each cell
+answered with ``lines`` Stdouts and a Done.  By default the workers are
+fakes in the manager process that answer at once, so what's measured is
+the manager: decoding, routing and the WebSocket framing.  With ``--real``
+the cells run in real workers (``print`` in a loop).  With ``--binary``
+the sessions take the worker's frames as binary messages instead of JSON.
+
+With ``--stalled=N``, N more sessions (fake workers only) run a cell that
+prints without end and never read from their connections.  The manager
+should hold a bounded amount of their output and pause their workers,
+while the other sessions carry on.
+
+With ``--reconnect=K``, each session drops its connection after every K
+messages it gets, mid-cell, and reconnects to the same session with the
+number of the last message it saw.  The manager should send what it missed,
+so the cells still finish.
+
+With ``--nodes=N``, N managers with fake workers are started as processes
+of their own on localhost, behind a front-end process
+(``run_frontend.py``), and the sessions connect to the front-end, each as a
+user of its own.  Prints the sessions each node got too.  (A manager alone
+is ``--serve=port:name``.)
+
+With ``--greedy=N``, N more sessions all belong to one user, and the
+round trips of the other users' cells are printed apart from theirs.
+``--max-running=N`` lets N cells run at once on the node and
+``--cell-ms=T`` makes each fake cell take T milliseconds, so cells queue.
+The other users should wait about as long as the greedy one rather than
+behind all of its cells.  ``--fifo`` makes every session the same user,
+which queues cells first come, first served, to compare with.
+
+With ``--real --cpu=N`` the cells are CPU-bound instead, summing a list of
+N ints a few times over, and ``--affinity=POLICY`` sets the manager's
+``exc_cpu_affinity`` (``numa`` or ``dedicated``) to compare with workers
+that float across the CPUs.  Run with as many clients as cores.
+
+Prints the messages a second delivered to clients and the 50th and 99th
+percentile of the time from sending an ExecCell to getting its Done.
+"""
+
+import json
+import os
+import socket
+import subprocess
+import sys
+from struct import unpack_from
+from time import time as _time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from twisted.internet import defer, protocol, reactor
+from twisted.python import log
+
+import sageserver.msg as msg
+from sageserver.msg.decodedmsg import MsgDecoder
+from sageserver.compnode.manager.manager import (BINARY_SUBPROTOCOL,
+        DEFAULT_CONFIG, Worker, WorkerService, WebSocketFactory)
+from sageserver.compnode.manager.websocket import (OP_BINARY, OP_TEXT,
+        decode_frame, mask)
+from sageserver.frontend.frontend import poll_capacity
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+FLOOD = 'FLOOD'
+
+
+class FakeTransport(object):
+    """
+    Stands in for a worker process: answers what's written to it.  A cell
+    of FLOOD prints until the worker is shut down.
+    """
+
+    _next_pid = [1000000]
+
+    def __init__(self, worker, lines, cell_seconds=0):
+        self.pid = self._next_pid[0]
+        self._next_pid[0] += 1
+        self._worker = worker
+        self._lines = lines
+        self._cell_seconds = cell_seconds
+        self._decoder = MsgDecoder()
+        self._paused = False
+        self._flooding = None # sid of the FLOOD cell
+
+    def writeToChild(self, fd, data):
+        for m in self._decoder.feed(data):
+            reactor.callLater(self._cell_seconds if m.type == msg.EXEC_CELL
+                              else 0, self._answer, m)
+
+    def _answer(self, m):
+        if m.type == msg.EXEC_CELL and m['source'] == FLOOD:
+            self._flooding = m.hdr.sid
+            self._flood()
+            return
+        if m.type == msg.EXEC_CELL:
+            out = [msg.Stdout('line\n', _hsid=m.hdr.sid)
+                   for i in range(self._lines)]
+            out.append(msg.Done().as_reply_to(m))
+        elif m.type == msg.SHUTDOWN:
+            self._flooding = None
+            return
+        else:
+            out = [msg.No().as_reply_to(m)]
+        self._worker.childDataReceived(4, ''.join(str(o.encode())
+                                                  for o in out))
+
+    def _flood(self):
+        if self._flooding is None or self._paused:
+            return
+        self._worker.childDataReceived(4, str(msg.Stdout(
+                'x' * 4095 + '\n', _hsid=self._flooding).encode()))
+        reactor.callLater(0, self._flood)
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        self._flood()
+
+    def signalProcess(self, signal):
+        self._flooding = None
+
+
+class FakeWorkerService(WorkerService):
+
+    def __init__(self, config, lines, cell_seconds=0):
+        WorkerService.__init__(self, config)
+        self._lines = lines
+        self._cell_seconds = cell_seconds
+
+    def _start_worker(self):
+        w = Worker(self)
+        self._starting[w] = (reactor.callLater(3600, lambda: None), _time())
+        w.makeConnection(FakeTransport(w, self._lines, self._cell_seconds))
+        return w
+
+
+class LoadClient(protocol.Protocol):
+    """
+    A WebSocket session running one cell after another.
+    """
+
+    def connectionMade(self):
+        self._buf = ''
+        self._open = False
+        self._received = 0
+        self._dropped = False
+        if self.factory.resuming:
+            self.session = self.factory.resuming.pop()
+            path = '/?session=%(token)s&seq=%(seq)d' % self.session
+        else:
+            # kept across reconnects
+            self.session = {'token': None, 'seq': 0, 'next_id': 1,
+                            'sent': None}
+            # the front-end's key for placing the session, and the user
+            # for the manager's fair shares
+            self.factory.users += 1
+            greedy = self.factory.users > self.factory.greedy_after
+            self.session['greedy'] = greedy
+            if self.factory.fifo:
+                user = 'everyone'
+            elif greedy:
+                user = 'greedy'
+            else:
+                user = 'user%d' % (self.factory.users,)
+            path = '/?user=%s' % (user,)
+        self._stalled = self.factory.stalled > 0
+        self.factory.stalled -= 1
+        self.transport.write('GET %s HTTP/1.1\r\n'
+                             'Host: localhost\r\n'
+                             'Upgrade: websocket\r\n'
+                             'Connection: Upgrade\r\n'
+                             'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+                             'Sec-WebSocket-Version: 13\r\n%s\r\n'
+                             % (path, 'Sec-WebSocket-Protocol: %s\r\n'
+                                % (BINARY_SUBPROTOCOL,)
+                                if self.factory.binary else ''))
+
+    def dataReceived(self, data):
+        self._buf += data
+        if not self._open:
+            end = self._buf.find('\r\n\r\n')
+            if end < 0:
+                return
+            self._buf = self._buf[end + 4:]
+            self._open = True
+            if self._stalled:
+                self._send_cell(FLOOD)
+                # the reactor drops a connection that isn't read or
+                # written, so it's kept here
+                self.factory.stalled_clients.append(self)
+                self.transport.pauseProducing()
+                return
+            if self.session['sent'] is None:
+                self._send_cell()
+        offset = 0
+        session = self.session
+        while True:
+            f = decode_frame(self._buf, offset)
+            if f is None:
+                break
+            offset = f[3]
+            m = json.loads(f[2]) if f[1] == OP_TEXT else None
+            if m is not None and m['type'] == 'Session':
+                session['token'] = str(m['token'])
+                session['seq'] = m['seq']
+                if session['sent'] is not None and not m['resumed']:
+                    # the cell's Done may be gone, run another
+                    self.factory.gaps += 1
+                    self._send_cell()
+                continue
+            session['seq'] += 1
+            self.factory.messages += 1
+            if f[1] == OP_BINARY:
+                done = unpack_from('<HH', f[2]) == (msg.DONE,
+                                                    session['next_id'] - 1)
+            else:
+                done = (m is not None and m['type'] == 'Done'
+                        and m['id'] == session['next_id'] - 1)
+            self._received += 1
+            if (self.factory.reconnect and not done
+                    and self._received >= self.factory.reconnect):
+                # mid-cell, as an ExecCell could be lost with the connection
+                self._dropped = True
+                self.transport.abortConnection()
+                return
+            if done:
+                (self.factory.greedy_latencies if session['greedy'] else
+                 self.factory.latencies).append(_time() - session['sent'])
+                session['sent'] = None
+                if self.factory.running:
+                    self._send_cell()
+        self._buf = self._buf[offset:]
+
+    def connectionLost(self, reason):
+        if self._dropped and self.factory.running:
+            self.factory.reconnects += 1
+            self.factory.resuming.append(self.session)
+            reactor.connectTCP(self.factory.host, self.factory.port,
+                               self.factory)
+
+    def _send_cell(self, source=None):
+        session = self.session
+        payload = json.dumps({'type': 'ExecCell', 'id': session['next_id'],
+                              'source': source or self.factory.source})
+        session['next_id'] += 1
+        key = os.urandom(4)
+        n = len(payload)
+        if n < 126:
+            hdr = chr(0x81) + chr(0x80 | n)
+        else:
+            hdr = chr(0x81) + chr(0x80 | 126) + chr(n >> 8) + chr(n & 0xff)
+        session['sent'] = _time()
+        self.transport.write(hdr + key + mask(payload, key))
+
+
+class LoadFactory(protocol.ClientFactory):
+    protocol = LoadClient
+
+    def __init__(self, host, port, source, binary, stalled, reconnect):
+        self.host = host
+        self.port = port
+        self.source = source
+        self.binary = binary
+        self.stalled = stalled
+        self.stalled_clients = []
+        self.reconnect = reconnect
+        self.resuming = [] # sessions to reconnect to
+        self.reconnects = 0
+        self.gaps = 0 # reconnects the manager couldn't replay for
+        self.users = 0
+        # sessions after this many are the greedy user's
+        self.greedy_after = sys.maxint
+        self.greedy_latencies = []
+        self.fifo = False
+        self.running = True
+        self.messages = 0
+        self.latencies = []
+
+
+def percentile(xs, p):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(len(xs) * p))] if xs else 0.0
+
+
+def bench_config(n_workers):
+    config = dict(DEFAULT_CONFIG)
+    config['exc_min_idle_workers'] = n_workers
+    config['exc_max_idle_workers'] = n_workers
+    config['exc_hibernate_after'] = None
+    config['exc_recycle_cells'] = None
+    return config
+
+
+def serve(port, name, n_workers, lines):
+    """
+    Runs a manager with fake workers on port.
+    """
+    config = bench_config(n_workers)
+    config['exc_node_name'] = name
+    s = FakeWorkerService(config, lines)
+    s.startService()
+    reactor.listenTCP(port, WebSocketFactory(s), interface='127.0.0.1')
+    reactor.run()
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_nodes(n_nodes, n_workers, lines):
+    """
+    Starts n_nodes managers and a front-end for them.  Returns the
+    front-end's port, the ``(name, port)`` of the nodes and the processes.
+    """
+    devnull = open(os.devnull, 'w')
+    nodes = [('node%d' % (i,), free_port()) for i in range(n_nodes)]
+    procs = [subprocess.Popen([sys.executable, __file__, str(n_workers), '0',
+                               str(lines), '--serve=%d:%s' % (port, name)],
+                              stdout=devnull, stderr=devnull)
+             for name, port in nodes]
+    fe_port = free_port()
+    procs.append(subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'run_frontend.py'),
+             str(fe_port)] + ['%s=127.0.0.1:%d' % n for n in nodes],
+            stdout=devnull, stderr=devnull))
+    return fe_port, nodes, procs
+
+
+def main(argv):
+    real = '--real' in argv
+    binary = '--binary' in argv
+    stalled = 0
+    reconnect = None
+    n_nodes = 0
+    greedy = 0
+    cell_seconds = 0
+    max_running = None
+    cpu = None
+    affinity = None
+    for a in argv:
+        if a.startswith('--stalled='):
+            stalled = int(a.split('=', 1)[1])
+        elif a.startswith('--reconnect='):
+            reconnect = int(a.split('=', 1)[1])
+        elif a.startswith('--nodes='):
+            n_nodes = int(a.split('=', 1)[1])
+        elif a.startswith('--greedy='):
+            greedy = int(a.split('=', 1)[1])
+        elif a.startswith('--cell-ms='):
+            cell_seconds = float(a.split('=', 1)[1]) / 1000
+        elif a.startswith('--max-running='):
+            max_running = int(a.split('=', 1)[1])
+        elif a.startswith('--cpu='):
+            cpu = int(a.split('=', 1)[1])
+        elif a.startswith('--affinity='):
+            affinity = a.split('=', 1)[1]
+        elif a.startswith('--serve='):
+            port, name = a.split('=', 1)[1].split(':')
+            serve_at = int(port), name
+    argv = [a for a in argv if not a.startswith('--')]
+    n_clients = int(argv[0]) if len(argv) > 0 else 50
+    seconds = float(argv[1]) if len(argv) > 1 else 10.0
+    lines = int(argv[2]) if len(argv) > 2 else 10
+    if 'serve_at' in locals():
+        serve(serve_at[0], serve_at[1], n_clients, lines)
+        return
+    procs = []
+    s = None
+    if n_nodes:
+        port, nodes, procs = start_nodes(n_nodes, n_clients + stalled, lines)
+    else:
+        config = bench_config(n_clients + stalled + greedy)
+        config['exc_max_running'] = max_running
+        config['exc_cpu_affinity'] = affinity
+        if real:
+            config['exc_min_idle_workers'] = \
+                    config['exc_max_idle_workers'] = min(n_clients, 8)
+            s = WorkerService(config)
+        else:
+            s = FakeWorkerService(config, lines, cell_seconds)
+        s.startService()
+        port = reactor.listenTCP(0, WebSocketFactory(s),
+                                 interface='127.0.0.1').getHost().port
+    source = "for i in range(%d): print 'line'" % (lines,)
+    if cpu:
+        source = "d = range(%d)\nfor j in range(10): s = sum(d)" % (cpu,)
+    factory = LoadFactory('127.0.0.1', port, source, binary, stalled,
+                          reconnect)
+    factory.greedy_after = stalled + n_clients
+    factory.fifo = '--fifo' in sys.argv
+
+
+    def connect():
+        for i in range(greedy + stalled + n_clients):
+            reactor.connectTCP(factory.host, factory.port, factory)
+    start = [None]
+
+    def begin():
+        factory.messages = 0
+        factory.latencies = []
+        factory.greedy_latencies = []
+        factory.reconnects = factory.gaps = 0
+        start[0] = _time()
+
+    def end():
+        factory.running = False
+        elapsed = _time() - start[0]
+        print "%d clients, %s%s%s%s" % (
+                n_clients, '%d ints a cell' % (cpu,) if cpu
+                           else '%d lines a cell' % (lines,),
+                ' (real workers%s)' % (', ' + affinity if affinity else '',)
+                if real else '',
+                ', binary' if binary else '',
+                ', %d nodes' % (n_nodes,) if n_nodes else '')
+        print "%10.0f messages/s" % (factory.messages / elapsed,)
+        print "%10.0f cells/s" % (len(factory.latencies) / elapsed,)
+        print "%10.2f ms p50 cell round trip" % (
+                1000 * percentile(factory.latencies, 0.5),)
+        print "%10.2f ms p99 cell round trip" % (
+                1000 * percentile(factory.latencies, 0.99),)
+        if greedy:
+            g = factory.greedy_latencies
+            print "%10d greedy sessions%s" % (
+                    greedy, ' (all one user)' if factory.fifo else '')
+            print "%10.0f greedy cells/s" % (len(g) / elapsed,)
+            print "%10.2f ms p50 greedy cell round trip" % (
+                    1000 * percentile(g, 0.5),)
+        snap = s.stats.snapshot() if s else {}
+        if stalled:
+            print "%10d stalled sessions" % (stalled,)
+            if s:
+                print "%10d bytes held for them" % (
+                        snap.get('send_buffered_bytes', 0),)
+                print "%10d worker pauses" % (
+                        snap.get('backpressure_pauses', 0),)
+        if reconnect:
+            print "%10d reconnects" % (factory.reconnects,)
+            if s:
+                print "%10d messages replayed" % (
+                        snap.get('replayed_messages', 0),)
+            print "%10d reconnects with a gap" % (factory.gaps,)
+        rejected = sum(v for k, v in snap.iteritems()
+                       if k.startswith('rejected_'))
+        if rejected:
+            print "%10d requests rejected" % (rejected,)
+        if affinity and s:
+            print "%10d affinity changes" % (
+                    snap.get('affinity_changes', 0),)
+        if s:
+            print "%10.2f messages a write" % (s.coalescing_ratio(),)
+            s.stopService()
+            reactor.stop()
+            return
+        d = defer.DeferredList([poll_capacity('127.0.0.1', node_port)
+                                for name, node_port in nodes])
+        d.addCallback(nodes_done)
+
+    def nodes_done(results):
+        for (ok, c), (name, node_port) in zip(results, nodes):
+            print "%10s %s sessions" % (c['sessions'] if ok else '?', name)
+        for p in procs:
+            p.terminate()
+        reactor.stop()
+
+    def go():
+        # warm up first, so workers are spawned and sessions assigned
+        warmup = 5.0 if real else 1.0
+        connect()
+        reactor.callLater(warmup, begin)
+        reactor.callLater(warmup + seconds, end)
+
+    def wait_for_nodes():
+        d = defer.DeferredList([poll_capacity('127.0.0.1', node_port)
+                                for name, node_port in nodes],
+                               consumeErrors=True)
+        d.addCallback(nodes_polled)
+
+    def nodes_polled(results):
+        if all(ok for ok, c in results):
+            # and for the front-end to have polled them
+            reactor.callLater(2.5, go)
+        else:
+            reactor.callLater(0.5, wait_for_nodes)
+
+    if n_nodes:
+        wait_for_nodes()
+    else:
+        go()
+    try:
+        reactor.run()
+    finally:
+        for p in procs:
+            if p.poll() is None:
+                p.terminate()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,79 @@
+"""
+Times a batch of independent CPU-bound cells run one at a time and with
+``parallel=True``.
+
+    python bench/parallel_cells.py [n_cells] [loop_size]
+
+The speedup should be close to min(n_cells, number of CPUs).
+"""
+
+import os
+import sys
+import time
+from multiprocessing import Process, cpu_count
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sageserver.compnode.worker import Worker
+from sageserver.compnode.worker.msgr import PipeMsgr
+import sageserver.msg as msg
+from sageserver.msg.decodedmsg import MsgDecoder
+
+import logging
+logging.disable(logging.CRITICAL)
+
+
+def start_worker():
+    p2c_r, p2c_w = os.pipe()
+    c2p_r, c2p_w = os.pipe()
+    p = Process(target=lambda: Worker(PipeMsgr(p2c_r, c2p_w)).loop_forever())
+    p.start()
+    return p, p2c_w, c2p_r
+
+
+def send(fd, m):
+    data = m.encode()
+    i = 0
+    while i < len(data):
+        i += os.write(fd, buffer(data, i))
+
+
+def wait_for_done(fd, sid):
+    decoder = MsgDecoder()
+    while True:
+        for m in decoder.feed(os.read(fd, 65536)):
+            if m.type == msg.DONE and m.hdr.sid == sid:
+                return
+
+
+def run_batch(n_cells, loop_size, parallel):
+    p, wfd, rfd = start_worker()
+    try:
+        cells = [{'sid': i + 1,
+                  'source': 'r%d = sum(i * i for i in xrange(%d))'
+                            % (i, loop_size)}
+                 for i in range(n_cells)]
+        start = time.time()
+        send(wfd, msg.ExecBatch(cells, parallel=parallel, _hsid=1000))
+        wait_for_done(rfd, 1000)
+        return time.time() - start
+    finally:
+        send(wfd, msg.Shutdown())
+        p.join(1.0)
+        if p.is_alive():
+            p.terminate()
+
+
+def main():
+    n_cells = int(sys.argv[1]) if len(sys.argv) > 1 else cpu_count()
+    loop_size = int(sys.argv[2]) if len(sys.argv) > 2 else 5 * 10 ** 6
+    serial = run_batch(n_cells, loop_size, False)
+    parallel = run_batch(n_cells, loop_size, True)
+    print "%d cells, %d CPUs" % (n_cells, cpu_count())
+    print "serial:   %.2fs" % (serial,)
+    print "parallel: %.2fs" % (parallel,)
+    print "speedup:  %.2fx" % (serial / parallel,)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Times turning message bodies into client JSON: decoding the BSON and then
+``json.dumps``, against :func:`sageserver.msg.transcode.bson_to_json`.
+
+    python bench/transcode.py [n]
+
+Each row is a message shape the manager forwards, timed n times.  The
+walk is in Python, so it wins on flat bodies (output, Progress, Done) and
+loses on deeply nested ones such as an Except's stack, which the manager
+still decodes.
+"""
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bson import _bson_to_dict, SON
+
+import sageserver.msg as msg
+from sageserver.msg.transcode import bson_to_json
+
+HEAD = '"type": "Stdout", "id": 7'
+
+
+def body_of(m):
+    return str(m.encode())[msg.HDR_LEN:]
+
+
+def decode_dumps(body):
+    d = _bson_to_dict(body, SON, False)[0]
+    del d['t']
+    d['type'] = 'Stdout'
+    d['id'] = 7
+    return json.dumps(d)
+
+
+def transcode(body):
+    return bson_to_json(body, head=HEAD, skip='t')
+
+
+SHAPES = [
+    ('Stdout, one line', msg.Stdout('x = 1\n')),
+    ('Stdout, 4KB', msg.Stdout(('%d\n' % 12345678) * 455)),
+    ('Stdout, 64KB', msg.Stdout(('%d\n' % 12345678) * 7282)),
+    ('Stdout, 4KB unicode', msg.Stdout(u'\xe9\u03bb\n' * 820)),
+    ('Done', msg.Done()),
+    ('Progress', msg.Progress(0.5, 'step 5 of 10')),
+    ('Except', msg.Except('Traceback ...\nZeroDivisionError\n',
+                          [['<cell>', i, 'f', 'x = 1 / 0']
+                           for i in range(20)],
+                          'ZeroDivisionError', 'integer division by zero')),
+]
+
+
+def timeit(f, body, n):
+    t = time.time()
+    for i in xrange(n):
+        f(body)
+    return (time.time() - t) / n
+
+
+def main(argv):
+    n = int(argv[0]) if argv else 20000
+    print "%-22s %12s %12s %8s" % ('message', 'decode+dumps', 'transcode',
+                                   'speedup')
+    for name, m in SHAPES:
+        body = body_of(m)
+        assert json.loads(decode_dumps(body)) == json.loads(transcode(body))
+        a = timeit(decode_dumps, body, n)
+        b = timeit(transcode, body, n)
+        print "%-22s %10.2fus %10.2fus %7.2fx" % (name, a * 1e6, b * 1e6,
+                                                  a / b)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
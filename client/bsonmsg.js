@@ -0,0 +1,103 @@
+/**
+Decoding of the binary messages sent to clients that speak the
+"sageserver.bson" subprotocol: a worker's frames as they are, a header
+followed by a BSON body.
+
+The header is little-endian, "<HHIBH": type, sid, length, flags and a
+checksum.  The sid is the id the client sent the request with.
+
+Needs msgtypes.js.
+*/
+
+var MSG_HDR_LEN = 11;
+
+function decode_msg(buf) {
+    /**
+     * Returns the message in buf (an ArrayBuffer) as the same object a JSON
+     * message would be: the body with type set to the class name and id
+     * to the sid.  Binary fields are ArrayBuffers.
+     */
+    var view = new DataView(buf),
+        t = view.getUint16(0, true),
+        m = decode_bson(view, MSG_HDR_LEN);
+    m.type = MSG_TYPE_NAMES[t];
+    m.id = view.getUint16(2, true);
+    delete m.t;
+    return m;
+}
+
+var _utf8 = window.TextDecoder ? new TextDecoder('utf-8') : null;
+
+function _decode_utf8(view, start, end) {
+    var bytes = new Uint8Array(view.buffer, view.byteOffset + start,
+                               end - start),
+        s = '', i;
+    if (_utf8) {
+        return _utf8.decode(bytes);
+    }
+    for (i = 0; i < bytes.length; i += 1) {
+        s += String.fromCharCode(bytes[i]);
+    }
+    return decodeURIComponent(escape(s));
+}
+
+function decode_bson(view, pos, array) {
+    /**
+     * Returns the document (or array) at pos in view, a DataView.  Handles
+     * the types message bodies use.
+     */
+    var end = pos + view.getInt32(pos, true) - 1,
+        doc = array ? [] : {},
+        type, k, key, n;
+    pos += 4;
+    while (pos < end) {
+        type = view.getUint8(pos);
+        k = pos + 1;
+        while (view.getUint8(k) !== 0) {
+            k += 1;
+        }
+        key = _decode_utf8(view, pos + 1, k);
+        pos = k + 1;
+        switch (type) {
+        case 0x01: // double
+            doc[key] = view.getFloat64(pos, true);
+            pos += 8;
+            break;
+        case 0x02: // string
+            n = view.getInt32(pos, true);
+            doc[key] = _decode_utf8(view, pos + 4, pos + 3 + n);
+            pos += 4 + n;
+            break;
+        case 0x03: // document
+        case 0x04: // array
+            doc[key] = decode_bson(view, pos, type === 0x04);
+            pos += view.getInt32(pos, true);
+            break;
+        case 0x05: // binary
+            n = view.getInt32(pos, true);
+            doc[key] = view.buffer.slice(view.byteOffset + pos + 5,
+                                         view.byteOffset + pos + 5 + n);
+            pos += 5 + n;
+            break;
+        case 0x08: // bool
+            doc[key] = view.getUint8(pos) === 1;
+            pos += 1;
+            break;
+        case 0x0A: // null
+            doc[key] = null;
+            break;
+        case 0x10: // int32
+            doc[key] = view.getInt32(pos, true);
+            pos += 4;
+            break;
+        case 0x12: // int64, exact up to 2^53
+            doc[key] = view.getInt32(pos + 4, true) * 4294967296 +
+                view.getUint32(pos, true);
+            pos += 8;
+            break;
+        default:
+            throw new Error("unsupported BSON type " + type);
+        }
+    }
+    return doc;
+}
@@ -41,6 +41,7 @@ CellHtml[CellType.CODE] = function (cell) {
     </span>\
   </div>\
   <div class="inspect"></div>\
+  <div class="progress"><div class="bar"></div><span class="label"></span></div>\
   <pre class="output"></pre>\
   <div class="stdin_input">\
     &gt;&gt;&gt; <input class="stdin" type="text" />\
@@ -177,16 +178,67 @@ Cell.prototype = {
     append_output: function (m) {
         var lc = this.output.lastChild;
         if (lc && lc.className == m.type) {
-            lc.innerHTML += strip_output(m.end_bytes);
+            lc.innerHTML += strip_output(m.bytes);
         } else {
             var d = document.createElement('SPAN');
             d.className = m.type;
-            d.innerHTML = strip_output(m.end_bytes);
+            d.innerHTML = strip_output(m.bytes);
             this.output.appendChild(d);
         }
     },
+    append_more: function (m, click) {
+        // a link to fetch the rest of a truncated result
+        var a = $('<a class="more" href="#more"></a>')
+            .text('... (' + m.shown + ' bytes shown, show more)')
+            .click(function () {
+                $(this).remove();
+                return click();
+            });
+        a.appendTo(this.output);
+    },
+    append_display: function (m) {
+        // a rich repr, m.data is an ArrayBuffer
+        var blob = new Blob([m.data], {type: m.mime}), d;
+        if (m.mime === 'text/html') {
+            d = $('<div class="display"></div>');
+            var reader = new FileReader();
+            reader.onload = function () {
+                d.html(reader.result);
+            };
+            reader.readAsText(blob);
+        } else {
+            d = $('<img class="display" />')
+                .attr('src', URL.createObjectURL(blob));
+        }
+        d.appendTo(this.output);
+    },
+    append_display_ref: function (m, click) {
+        // a link to fetch a Display that was too big to send inline
+        var a = $('<a class="more" href="#display"></a>')
+            .text('(' + m.mime + ', ' + m.size + ' bytes, show)')
+            .click(function () {
+                $(this).remove();
+                return click();
+            });
+        a.appendTo(this.output);
+    },
+    append_notice: function (m) {
+        $('<div class="notice"></div>').text(m.text).appendTo(this.output);
+    },
     clear_output: function () {
         this.output.innerHTML = '';
+        this.clear_progress();
+    },
+
+    set_progress: function (m) {
+        // a Progress replaces the previous one
+        var p = this.div.find('.progress');
+        p.find('.bar').css('width', (100 * m.fraction) + '%');
+        p.find('.label').text(m.label);
+        this.div.addClass('progressing');
+    },
+    clear_progress: function () {
+        this.div.removeClass('progressing');
     },
 
     open_stdin: function () {
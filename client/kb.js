@@ -27,6 +27,12 @@ var Kb = {
     evaluate: function (event) {
 	return event.which === 13 && event.shiftKey;
     },
+    evaluate_all: function (event) {
+	return event.which === 13 && event.shiftKey && event.ctrlKey;
+    },
+    evaluate_changed: function (event) {
+	return event.which === 13 && event.shiftKey && event.altKey;
+    },
     inspect: function (event) {
 	return event.which === 9 && !event.shiftKey;
     },
@@ -0,0 +1,47 @@
+/*
+ * THIS FILE IS GENERATED BY msg_generator/generate.py!!!
+ * *** DO NOT EDIT DIRECTLY ***
+ *
+ * Message type -> class name.
+ */
+var MSG_TYPE_NAMES = {
+    100: "No",
+    101: "Yes",
+    110: "Interrupt",
+    111: "Shutdown",
+    120: "ExecCell",
+    121: "ExecBatch",
+    130: "IsComputing",
+    140: "GetCompletions",
+    141: "Completions",
+    142: "GetDoc",
+    143: "Doc",
+    144: "GetSource",
+    145: "Source",
+    146: "FetchMore",
+    147: "FetchDisplay",
+    150: "Snapshot",
+    151: "SnapshotTaken",
+    152: "Rollback",
+    153: "RolledBack",
+    160: "Hibernate",
+    161: "Hibernated",
+    162: "Restore",
+    163: "Restored",
+    0: "Stdin",
+    1: "Stdout",
+    2: "Stderr",
+    5: "Display",
+    10: "Except",
+    80: "MemoryUsage",
+    82: "Progress",
+    83: "Notice",
+    84: "Session",
+    86: "Queued",
+    88: "Rejected",
+    85: "Affected",
+    87: "Truncated",
+    90: "NeedStdin",
+    95: "Skipped",
+    99: "Done"
+};
@@ -9,12 +9,23 @@ function SageServer(host, onopen, onclose) {
     this._onclose = onclose;
     this._last_id = 0;
     this._callbacks = {};
+    // the server's session, and the number of its messages seen
+    this._session = null;
+    this._seq = 0;
     this.connect();
 }
 
 SageServer.prototype = {
     connect: function () {
-        this._socket = new WebSocket('ws://' + this.host + '/');
+        // with "sageserver.bson" the server sends the worker's messages
+        // as they are, decoded by bsonmsg.js
+        var url = 'ws://' + this.host + '/';
+        if (this._session) {
+            // the server sends again what we missed
+            url += '?session=' + this._session + '&seq=' + this._seq;
+        }
+        this._socket = new WebSocket(url, ['sageserver.bson']);
+        this._socket.binaryType = 'arraybuffer';
         this._socket.onopen = $.proxy(this.onopen, this);
         this._socket.onclose = $.proxy(this.onclose, this);
         this._socket.onerror = $.proxy(this.onerror, this);
@@ -39,7 +50,7 @@ SageServer.prototype = {
             if (this._onclose) {
                 this._onclose(this);
             }
-	    this._send_disconnects();
+            // the callbacks wait for the server's Session message
         } else {
             this._ctimer.trynow_failed();
         }
@@ -60,12 +71,47 @@ SageServer.prototype = {
     onmessage: function (event) {
         //console.log("onmessage:", event);
 	var m;
-	try {
-	    m = JSON.parse(event.data);
-	} catch (e) {
-	    console.log("Invalid message received:", event.data);
-	    console.log(e);
-	    return;
+	// numbered by the server, except its Session message
+	this._seq += 1;
+	if (typeof event.data !== "string" &&
+	        this._socket.protocol === "sageserver.bson") {
+	    try {
+		m = decode_msg(event.data);
+	    } catch (e) {
+		console.log("Invalid message received:", event.data);
+		console.log(e);
+		return;
+	    }
+	} else if (typeof event.data !== "string") {
+	    // the payload of the Display before it
+	    m = this._display;
+	    delete this._display;
+	    if (m === undefined) {
+		console.log("binary frame without a Display");
+		return;
+	    }
+	    m.data = event.data;
+	} else {
+	    try {
+		m = JSON.parse(event.data);
+	    } catch (e) {
+		console.log("Invalid message received:", event.data);
+		console.log(e);
+		return;
+	    }
+	    if (m.type === "Session") {
+		if (!m.resumed) {
+		    // a new session, or some of the old one's output is gone
+		    this._send_disconnects();
+		}
+		this._session = m.token;
+		this._seq = m.seq;
+		return;
+	    }
+	    if (m.type === "Display" && m.binary) {
+		this._display = m;
+		return;
+	    }
 	}
 	var id = m.id;
 	if (id === undefined) {
@@ -93,12 +139,48 @@ SageServer.prototype = {
 	 *     message.
 	 * :param callback: (msg, data) returning false if there
 	 *     are no more messages to be received (i.e. after a Done).
-	 *     Note: if the server is lost, then the callback will be called
-	 *     with a Disconnected message.
+	 *     Note: if the session is lost, then the callback will be called
+	 *     with a Disconnect message.  Output sent while the connection
+	 *     was down is sent again when it reconnects.
 	 * :returns: the id of the sent object.
 	 */
-	id = this._last_id + 1;
-	msg.id = id;
+	msg.id = this._register(callback, data);
+	// console.log("sending:", msg)
+	this._socket.send(JSON.stringify(msg));
+	return msg.id;
+    },
+    send_batch: function (cells, incremental, callback, data) {
+	/**
+	 * Sends cells in one ExecBatch message.  The worker runs them in order
+	 * and stops at the first one that raises.
+	 *
+	 * :param cells: a list of {msg: ExecCell fields, callback: ...,
+	 *     data: ...}.  Each cell's callback is called as in send() with
+	 *     its output and its Done (or Skipped if it didn't run).
+	 * :param incremental: if true, only the cells that changed and the
+	 *     cells that depend on them run.
+	 * :param callback: called with the Affected message for an incremental
+	 *     batch and the Done for the whole batch.
+	 * :returns: the id of the batch.
+	 */
+	var batch = [], i, c;
+	for (i = 0; i < cells.length; i += 1) {
+	    c = cells[i];
+	    batch.push($.extend({sid: this._register(c.callback, c.data)},
+				c.msg));
+	}
+	return this.send({
+	    type: "ExecBatch",
+	    cells: batch,
+	    incremental: !!incremental
+	}, callback, data);
+    },
+    _register: function (callback, data) {
+	/**
+	 * Returns a new unique id, calling callback for messages with it.
+	 */
+	// ids are sent back as 16 bit sids in binary messages
+	var id = this._last_id % 0xffff + 1;
 	if (callback) {
 	    this._callbacks[id] = {
 		callback: callback,
@@ -106,8 +188,6 @@ SageServer.prototype = {
 	    };
 	}
 	this._last_id = id;
-	// console.log("sending:", msg)
-	this._socket.send(JSON.stringify(msg));
 	return id;
     }
 };
@@ -226,6 +226,14 @@ var CellEvents = {
 				       line_info);
 	    return false;
         }
+	if (Kb.evaluate_all(event)) { // ctrl + shift + enter
+	    ws.evaluate_all(false);
+	    return false;
+	}
+	if (Kb.evaluate_changed(event)) { // alt + shift + enter
+	    ws.evaluate_all(true);
+	    return false;
+	}
 	if (Kb.evaluate(event)) { // shift + enter
 	    ws.evaluate_cell(cell);
 	    return false;
@@ -337,14 +345,12 @@ Worksheet.prototype = {
 	if (!cell.div.hasClass('computing')) {
             cell.clear_output();
             cell.div.addClass('computing');
-            console.log("Exec:", code);
+            console.log("ExecCell:", code);
             this.server.send({
-		type: "Exec",
-		end_bytes: code,
-		dict: {
-		    name: '__cell_' + cell.id.toString() + '__',
-		    except_msg: true
-		}
+		type: "ExecCell",
+		source: code,
+		cid: cell.id,
+		except_msg: true
 	    }, this.recv_from_Exec, {
 		    ws: this,
 		    cell_id: cell.id
@@ -357,6 +363,59 @@ Worksheet.prototype = {
 	    }
 	}
     },
+    evaluate_all: function (incremental) {
+	/**
+	 * Evaluates every code cell from the top in one ExecBatch, so there's
+	 * no round trip between cells.
+	 *
+	 * incremental -- only evaluate the cells that were edited and the cells
+	 *     that use what they define.  The others keep their output.
+	 */
+	var self = this, cells = [];
+	this.div.find('.cell.code').each(function () {
+	    var cell = get_cell(this);
+	    if (cell.div.hasClass('computing')) {
+		return;
+	    }
+	    if (cell.inspect) {
+		cell.inspect.remove();
+	    }
+	    if (!incremental) {
+		cell.clear_output();
+	    }
+	    cell.div.addClass('computing');
+	    cells.push({
+		msg: {
+		    source: cell.editor.getCode(),
+		    cid: cell.id,
+		    except_msg: true
+		},
+		callback: self.recv_from_Exec,
+		data: {ws: self, cell_id: cell.id}
+	    });
+	});
+	if (cells.length) {
+	    this.server.send_batch(cells, incremental, this.recv_from_ExecBatch,
+				   {ws: this});
+	}
+    },
+    recv_from_ExecBatch: function (msg, data) {
+	/**
+	 * :param msg: Affected or Done.
+	 * :param data: {ws: this worksheet}
+	 */
+	var self = data.ws, i, cell;
+	if (msg.type === "Affected") {
+	    for (i = 0; i < msg.cids.length; i += 1) {
+		cell = self.cells[msg.cids[i]];
+		if (cell) {
+		    cell.clear_output();
+		}
+	    }
+	} else if (msg.type === "Done") {
+	    return false;
+	}
+    },
     remove_cell: function (cell) {
 	/**
 	 * this -- this worksheet.
@@ -391,9 +450,41 @@ Worksheet.prototype = {
             return false;
         }
 	//console.log("recv_Exec:", msg);
-	if (msg.type === "Done") {
+	if (cell.queued && msg.type !== "Queued") {
+	    // its turn has come
+	    cell.queued = false;
+	    cell.clear_progress();
+	}
+	if (msg.type === "Done" || msg.type === "Skipped") {
 	    cell.div.removeClass('computing interrupting need_stdin');
+	    cell.clear_progress();
 	    return false;
+	} else if (msg.type === "Progress") {
+	    cell.set_progress(msg);
+	} else if (msg.type === "Truncated") {
+	    cell.append_more(msg, function () {
+		self.fetch_more(cell, msg.more_id);
+		return false;
+	    });
+	} else if (msg.type === "Display") {
+	    if (msg.data === null) {
+		cell.append_display_ref(msg, function () {
+		    self.fetch_display(cell, msg.ref);
+		    return false;
+		});
+	    } else {
+		cell.append_display(msg);
+	    }
+	} else if (msg.type === "Notice" || msg.type === "Rejected") {
+	    cell.append_notice(msg);
+	} else if (msg.type === "Queued") {
+	    cell.queued = true;
+	    cell.set_progress({
+		fraction: 0,
+		label: 'waiting, ' + (msg.position - 1) + ' ahead' +
+		    (msg.wait === null ? '' :
+		     ', about ' + Math.ceil(msg.wait) + 's')
+	    });
 	} else if (msg.type === "NeedStdin") {
 	    if (!cell.div.hasClass('need_stdin')) {
 		cell.div.addClass('need_stdin');
@@ -427,8 +518,42 @@ Worksheet.prototype = {
 		.css('display', (msg.type === 'Yes')? 'none' : 'inline');
 	cell.div.removeClass('interrupting');
     },
+    fetch_more: function (cell, more_id) {
+	/**
+	 * Asks for more of a result that was truncated.  It's appended to the
+	 * cell's output.
+	 */
+	this.server.send({
+	    type: "FetchMore",
+	    more_id: more_id
+	}, this.recv_from_Exec, {
+	    ws: this,
+	    cell_id: cell.id
+	});
+    },
+    fetch_display: function (cell, ref) {
+	/**
+	 * Asks for a Display that was too big to be sent inline.
+	 */
+	this.server.send({
+	    type: "FetchDisplay",
+	    ref: ref
+	}, function (msg, data) {
+	    var c = data.ws.cells[data.cell_id];
+	    if (c && msg.type === "Display") {
+		c.append_display(msg);
+	    } else if (c) {
+		c.append_output({type: "Stderr",
+				 bytes: "this output is no longer available\n"});
+	    }
+	    return false;
+	}, {
+	    ws: this,
+	    cell_id: cell.id
+	});
+    },
     send_stdin: function (s) {
-        this.server.send({type: "Stdin", end_bytes: s});
+        this.server.send({type: "Stdin", bytes: s});
     },
     dump: function () {
         /**
@@ -178,6 +178,26 @@ Output message types
     f = open(typespath, 'w')
     f.write(template)
     f.close()
+
+    # for client/bsonmsg.js, which names the types of binary messages
+    names = ',\n'.join('    %d: "%s"' % (msgcls.typeval, msgcls.clsname)
+                        for msgcls in request_msgs.msgs + output_msgs.msgs)
+    template = """/*
+ * THIS FILE IS GENERATED BY msg_generator/generate.py!!!
+ * *** DO NOT EDIT DIRECTLY ***
+ *
+ * Message type -> class name.
+ */
+var MSG_TYPE_NAMES = {{
+{names}
+}};
+""".format(**locals())
+
+    jspath = join(dirname(__file__), '..', 'client', 'msgtypes.js')
+    print "Generating", repr(jspath)
+    f = open(jspath, 'w')
+    f.write(template)
+    f.close()
     
     return 0
 
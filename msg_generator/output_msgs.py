@@ -5,6 +5,15 @@ msgs = [
     MsgClass('Stdin', 'STDIN', 0, [Fld('bytes')]),
     MsgClass('Stdout', 'STDOUT', 1, [Fld('bytes')]),
     MsgClass('Stderr', 'STDERR', 2, [Fld('bytes')]),
+
+    MsgClass('Display', 'DISPLAY', 5, [
+        Fld('mime', doc="e.g. 'image/png', 'image/svg+xml' or 'text/html'"),
+        Fld('data', doc='the payload as a bson Binary, or None if it is '
+            'too big to send inline'),
+        Fld('size', doc='length of the payload in bytes'),
+        Fld('ref', False, None, doc='what to ask for with FetchDisplay '
+            'when data is None'),
+    ], doc='Sent for a result with a rich repr such as _repr_png_'),
     
     MsgClass('Except', 'EXCEPT', 10, [
         Fld('stderr'),                              
@@ -14,8 +23,76 @@ msgs = [
         Fld('syntax', False)
     ]),
      
+    MsgClass('MemoryUsage', 'MEMORY_USAGE', 80, [
+        Fld('rss', doc='Resident set size of the worker in bytes'),
+        Fld('limit', doc='RSS limit of the worker in bytes'),
+        Fld('level', doc='''
+            'OK': below the warning threshold.
+            'WARN': approaching the limit.
+            'BREACH': over the limit, the worker should be recycled.'''),
+    ], doc='Sent by the worker when its memory level changes'),
+
+    MsgClass('Progress', 'PROGRESS', 82, [
+        Fld('fraction', doc='how much of the cell is done, from 0.0 to 1.0'),
+        Fld('label', doc='what is being done, may be empty'),
+    ], doc="Sent by progress() in a cell.  Replaces the cell's previous "
+        'Progress rather than adding to its output'),
+
+    MsgClass('Notice', 'NOTICE', 83, [
+        Fld('kind', doc='''
+            'RECYCLE': the worker is being replaced, the namespace is
+            carried over.'''),
+        Fld('text', doc='a message for the user'),
+    ], doc='Sent by the manager about the session rather than a cell'),
+
+    MsgClass('Session', 'SESSION', 84, [
+        Fld('token', doc='connect with ?session=<token>&seq=<n> to resume '
+            'the session'),
+        Fld('seq', doc='the number of the message before the next one, '
+            'messages after this are numbered seq + 1, seq + 2, ...'),
+        Fld('resumed', doc='True if this is the session asked for and no '
+            'messages since the seq asked for were lost'),
+    ], doc='Sent by the manager first on each connection, outside the '
+        'numbering'),
+
+    MsgClass('Queued', 'QUEUED', 86, [
+        Fld('position', doc='requests ahead of this one, plus one'),
+        Fld('wait', doc='estimated seconds until it runs, or None if '
+            'there is too little to go on'),
+    ], doc='Sent by the manager for a request waiting for a worker or for '
+        'its turn to run, and again as it moves up'),
+
+    MsgClass('Rejected', 'REJECTED', 88, [
+        Fld('reason', doc='''
+            'OVERLOADED': the node has too many requests waiting.
+            'USER_QUEUE_FULL': you have too many requests waiting.'''),
+        Fld('text', doc='a message for the user'),
+        Fld('retry_after', doc='seconds after which trying again may '
+            'succeed, or None'),
+    ], doc='Sent by the manager instead of running a request, followed by '
+        'a Done'),
+
+    MsgClass('Affected', 'AFFECTED', 85, [
+        Fld('cids', doc='cids of the cells that will run, in order'),
+    ], doc='Sent first for an incremental ExecBatch'),
+
+    MsgClass('Truncated', 'TRUNCATED', 87, [
+        Fld('more_id', doc='what to ask for with FetchMore'),
+        Fld('shown', doc='bytes of the repr sent so far'),
+    ], doc='Sent after the output of a result whose repr was cut short'),
+
     MsgClass('NeedStdin', 'NEED_STDIN', 90, [
-        Fld('nbytes')
+        Fld('nbytes', doc='bytes a blocked read wants, -1 for all of them, '
+            'or 0 when only granting window'),
+        Fld('window', False, 0, doc='more bytes of Stdin that may be sent '
+            'ahead of demand'),
     ]),
+    MsgClass('Skipped', 'SKIPPED', 95, [
+        Fld('reason', doc='''
+            'ERROR': an earlier cell in the batch raised.
+            'INTERRUPT': the batch was interrupted.
+            'UNCHANGED': an incremental batch didn't need to run it.'''),
+    ], doc='Sent instead of Done for a cell of an ExecBatch that did not '
+        'run'),
     MsgClass('Done', 'DONE', 99),
 ]
\ No newline at end of file
@@ -30,8 +30,47 @@ msgs = [
             'abstract syntax tree before executing.'),
         Fld('except_msg', False, False, doc='If True, send an Except message '
             'when an exception occurs.  If False, print to stderr.'),
+        Fld('timeout', False, None, doc='Wall-clock seconds the cell may '
+            'run before CellTimeout is raised.  None uses the worker '
+            'default.'),
+        Fld('cpu_timeout', False, None, doc='CPU seconds the cell may use '
+            'before CellCPUTimeout is raised.  None uses the worker '
+            'default.'),
+        Fld('cache', False, False, doc='If True, and the cell ran before '
+            'with the same code and the same values of the globals it '
+            'reads, restore what it assigned and replay its output instead '
+            'of executing it.  Usually set with %cache=True.'),
+        Fld('output_rate', False, None, doc='Bytes of stdout and stderr '
+            'a second past which output is dropped.  None uses the worker '
+            'default.'),
+        Fld('output_soft_limit', False, None, doc='Bytes of output past '
+            'which only a line a second is sent.  None uses the worker '
+            'default.'),
+        Fld('output_limit', False, None, doc='Bytes of output past which '
+            'none is sent.  None uses the worker default.'),
+        Fld('output_interrupt', False, None, doc='If True, raise '
+            'OutputLimitExceeded in the cell when it passes output_limit.  '
+            'None uses the worker default.'),
     ]),
     
+    MsgClass('ExecBatch', 'EXEC_BATCH', 121, [
+        Fld('cells', doc='List of cells to execute in order.  Each is a '
+            'dict of ExecCell fields plus "sid", the stream id its output '
+            'and Done are sent with'),
+        Fld('stop_on_error', False, True, doc='If True, the cells after one '
+            'that raises are Skipped'),
+        Fld('incremental', False, False, doc='If True, only run the cells '
+            'that were edited since they last ran, or that depend on one '
+            'that runs.  The cids that will run are sent in Affected '
+            'first'),
+        Fld('parallel', False, False, doc='If True, consecutive cells that '
+            "don't share any globals run at the same time in forked "
+            'children.  Their output is still sent in order, and what they '
+            'assign is merged back if it pickles'),
+    ], doc="Execute several cells back to back.  Cells that don't run get "
+        "Skipped instead of Done, then the batch gets Done.  An Interrupt "
+        "skips the rest of the running batch and all queued batches"),
+
     MsgClass('IsComputing', 'IS_COMPUTING', 130, doc="Returns Yes or No"),
     
     MsgClass('GetCompletions', 'GET_COMPLETIONS', 140, [
@@ -69,5 +108,63 @@ msgs = [
         Fld('source', False, None),
     ]),
 
+    MsgClass('FetchMore', 'FETCH_MORE', 146, [
+        Fld('more_id', doc='from a Truncated'),
+        Fld('nbytes', False, None, doc='about how many more bytes to '
+            'send, None for the worker default'),
+    ], doc="Sends more of a truncated result as Stdout, then a Truncated "
+        "if there's still more, then Done"),
+
+    MsgClass('FetchDisplay', 'FETCH_DISPLAY', 147, [
+        Fld('ref', doc='from a Display'),
+    ], doc='Returns the Display with its payload inline, or No if it is '
+        'no longer available'),
+
+    MsgClass('Snapshot', 'SNAPSHOT', 150, doc="Fork a frozen copy-on-write "
+        "copy of the worker.  Returns SnapshotTaken, or No if snapshots are "
+        "disabled"),
+
+    MsgClass('SnapshotTaken', 'SNAPSHOT_TAKEN', 151, [
+        Fld('snap_id', doc='id to pass to Rollback'),
+        Fld('evicted', doc='ids of the snapshots dropped to stay under the '
+            'cap'),
+    ]),
+
+    MsgClass('Rollback', 'ROLLBACK', 152, [
+        Fld('snap_id'),
+    ], doc="Replace the worker with a snapshot.  Returns RolledBack from the "
+        "new worker process, or No.  Nothing else may be sent to the worker "
+        "until the reply arrives"),
+
+    MsgClass('RolledBack', 'ROLLED_BACK', 153, [
+        Fld('snap_id'),
+        Fld('pid', doc='pid of the worker process that is now live'),
+    ]),
+
+    MsgClass('Hibernate', 'HIBERNATE', 160, [
+        Fld('path', doc='file to write the namespace to'),
+    ], doc="Save the namespace to disk and exit once the current cell is "
+        "done.  Returns Hibernated, then the worker shuts down"),
+
+    MsgClass('Hibernated', 'HIBERNATED', 161, [
+        Fld('path'),
+        Fld('nbytes', doc='size of the file written'),
+        Fld('seconds', doc='time taken to write it'),
+        Fld('n_globals', doc='number of globals saved by value'),
+        Fld('n_cells', doc='number of cells to replay on Restore'),
+    ]),
+
+    MsgClass('Restore', 'RESTORE', 162, [
+        Fld('path', doc='file written by Hibernate'),
+    ], doc="Load a hibernated namespace, replaying cells without output.  "
+        "Returns Restored.  Cells sent after it run in the restored "
+        "namespace"),
+
+    MsgClass('Restored', 'RESTORED', 163, [
+        Fld('path'),
+        Fld('seconds', doc='time taken to restore'),
+        Fld('errors', doc='values that failed to load and replayed cells '
+            'that raised'),
+    ]),
 
 ]
\ No newline at end of file
@@ -1,4 +1,8 @@
 if __name__ == '__main__':
-    from sageserver.compnode.worker.worker import Worker
-    w = Worker()
-    w.loop()
\ No newline at end of file
+    import sys
+    from sageserver.compnode.worker import Worker
+    from sageserver.compnode.worker.msgr import PipeMsgr
+    from sageserver.compnode.worker.options import parse_args, worker_kwargs
+    opts = parse_args(sys.argv[1:])
+    w = Worker(PipeMsgr(opts.rfd, opts.wfd), **worker_kwargs(opts))
+    w.loop_forever()
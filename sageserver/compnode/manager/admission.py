@@ -0,0 +1,260 @@
+"""
+Admission of sessions and cells when the node is busy.
+"""
+
+from time import time as _time
+
+
+class QueueFull(Exception):
+    """
+    Raised by :meth:`FairQueue.push` when a request is turned away.
+    """
+
+    def __init__(self, reason, retry_after=None):
+        Exception.__init__(self, reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class FairQueue(object):
+    """
+    Requests waiting for a slot, served in weighted fair order between
+    users, with quotas on what each user and group may have running.
+
+    A user's next request is tagged with its virtual finish time, the
+    later of the queue's virtual time and the user's last tag, plus one
+    over the user's weight.  The request with the lowest tag whose user and
+    group are under their quotas is served next.  So users share the slots
+    in proportion to their weights however many requests each queues, and
+    a user arriving at a long queue is served after about as many requests
+    as each other user has.
+
+    Requests are turned away once ``max_queued`` are waiting, or
+    ``user_max_queued`` from the user, or if the wait would be more than
+    ``max_wait`` seconds.
+
+    EXAMPLES::
+
+        >>> now = [0.0]
+        >>> q = FairQueue(user_quota=2, clock=lambda: now[0])
+        >>> for i in range(4):
+        ...     q.push('greedy%d' % i, 'greedy', None)
+        1
+        2
+        3
+        4
+        >>> q.push('polite', 'polite', None)      # goes ahead of greedy2
+        2
+        >>> [q.pop()[0] for i in range(3)]
+        ['greedy0', 'polite', 'greedy1']
+        >>> q.pop() is None
+        True
+        >>> q.queued()                            # over greedy's quota
+        ['greedy2', 'greedy3']
+        >>> q.finish('greedy', None)
+        >>> q.pop()[0]
+        'greedy2'
+
+    Weights, groups and turning requests away::
+
+        >>> q = FairQueue(group_quota=1, weights={'vip': 3}, max_queued=6,
+        ...               clock=lambda: now[0])
+        >>> for user in ['a', 'a', 'vip', 'vip', 'vip', 'vip']:
+        ...     p = q.push(user, user, 'g' if user == 'a' else None)
+        >>> q.queued()
+        ['vip', 'vip', 'a', 'vip', 'vip', 'a']
+        >>> q.push('b', 'b', None)
+        Traceback (most recent call last):
+            ...
+        QueueFull: OVERLOADED
+        >>> [q.pop()[0] for i in range(5)]
+        ['vip', 'vip', 'a', 'vip', 'vip']
+        >>> q.pop() is None, q.queued()          # group g is at its quota
+        (True, ['a'])
+        >>> q.remove(lambda item: item == 'a'), len(q)
+        (1, 0)
+
+    The wait is estimated from how often requests were served while some
+    were waiting::
+
+        >>> q = FairQueue(clock=lambda: now[0])
+        >>> for i in range(3):
+        ...     p = q.push(i, 'u', None)
+        >>> q.wait(1) is None
+        True
+        >>> for i in range(3):
+        ...     now[0] += 2
+        ...     r = q.pop()
+        >>> round(q.wait(3), 6)
+        6.0
+    """
+
+    def __init__(self, user_quota=None, group_quota=None, weights=None,
+                 group_weights=None, max_queued=None, user_max_queued=None,
+                 max_wait=None, clock=_time):
+        """
+        :param user_quota: requests a user may have running, None for no
+            limit.
+        :param group_quota: requests a group may have running.
+        :param weights: user -> weight, 1 for users not in it.
+        :param group_weights: group -> weight, for users not in weights.
+        :param max_queued: requests waiting at most.
+        :param user_max_queued: requests waiting from a user at most.
+        :param max_wait: the longest estimated wait a request is queued
+            for, in seconds.
+        """
+        self.user_quota = user_quota
+        self.group_quota = group_quota
+        self.weights = weights or {}
+        self.group_weights = group_weights or {}
+        self.max_queued = max_queued
+        self.user_max_queued = user_max_queued
+        self.max_wait = max_wait
+        self._clock = clock
+        self.running = {} # user -> requests running
+        self.group_running = {}
+        self._queued_by = {} # user -> requests waiting
+        self._q = [] # [tag, n, user, group, item, time pushed], by tag
+        self._vtime = 0.0
+        self._last_tag = {} # user -> tag of their last request
+        self._n = 0
+        # decaying sums of the serves while backlogged and the time they
+        # took, for the wait estimate
+        self._served = 0.0
+        self._spent = 0.0
+        self._last_pop = None
+
+    def __len__(self):
+        return len(self._q)
+
+    def queued(self):
+        """
+        Returns the waiting items, in the order they'd be served if no
+        quotas held them back.
+        """
+        return [e[4] for e in self._q]
+
+    def wait(self, position):
+        """
+        Returns the estimated seconds until the request at position (from
+        1) is served, or None if there's been too little to go on.
+        """
+        if self._served < 1:
+            return None
+        return position * self._spent / self._served
+
+    def can_start(self, user, group):
+        """
+        Returns True if user and group are under their quotas.
+        """
+        return ((self.user_quota is None
+                 or self.running.get(user, 0) < self.user_quota)
+                and (group is None or self.group_quota is None
+                     or self.group_running.get(group, 0) < self.group_quota))
+
+    def start(self, user, group):
+        """
+        Counts a request that runs without queueing.
+        """
+        self.running[user] = self.running.get(user, 0) + 1
+        if group is not None:
+            self.group_running[group] = self.group_running.get(group, 0) + 1
+
+    def finish(self, user, group):
+        """
+        Called when a request that was started has finished.
+        """
+        _decr(self.running, user)
+        if group is not None:
+            _decr(self.group_running, group)
+
+    def push(self, item, user, group):
+        """
+        Queues item.  Returns its position, from 1, or raises
+        :class:`QueueFull`.
+        """
+        n_queued = len(self._q)
+        if self.max_queued is not None and n_queued >= self.max_queued:
+            raise QueueFull('OVERLOADED', self.wait(n_queued))
+        if (self.user_max_queued is not None
+                and self._queued_by.get(user, 0) >= self.user_max_queued):
+            raise QueueFull('USER_QUEUE_FULL', self.wait(n_queued))
+        weight = self.weights.get(user, self.group_weights.get(group, 1.0))
+        tag = max(self._vtime, self._last_tag.get(user, 0.0)) + 1.0 / weight
+        self._last_tag[user] = tag
+        self._n += 1
+        entry = [tag, self._n, user, group, item, self._clock()]
+        i = len(self._q)
+        while i and self._q[i - 1][:2] > entry[:2]:
+            i -= 1
+        if self.max_wait is not None:
+            wait = self.wait(i + 1)
+            if wait is not None and wait > self.max_wait:
+                raise QueueFull('OVERLOADED', wait)
+        self._q.insert(i, entry)
+        self._queued_by[user] = self._queued_by.get(user, 0) + 1
+        return i + 1
+
+    def pop(self):
+        """
+        Starts the next request that's under its quotas.  Returns ``(item,
+        user, group, seconds waited)``, or None if there isn't one.
+        """
+        for i, (tag, n, user, group, item, pushed) in enumerate(self._q):
+            if self.can_start(user, group):
+                break
+        else:
+            return None
+        del self._q[i]
+        _decr(self._queued_by, user)
+        self._vtime = max(self._vtime, tag)
+        self.start(user, group)
+        now = self._clock()
+        if self._last_pop is not None and self._last_pop[1]:
+            # served one after another, so the time since the last is spent
+            # serving (several may be served at once)
+            self._served = 0.9 * self._served + 1
+            self._spent = 0.9 * self._spent + now - self._last_pop[0]
+        self._last_pop = (now, bool(self._q))
+        if not self._q:
+            self._vtime = 0.0
+            self._last_tag.clear()
+        return item, user, group, now - pushed
+
+    def remove(self, match):
+        """
+        Removes the waiting items that match(item) is true for.  Returns how
+        many there were.
+        """
+        keep = []
+        for e in self._q:
+            if match(e[4]):
+                _decr(self._queued_by, e[2])
+            else:
+                keep.append(e)
+        n = len(self._q) - len(keep)
+        self._q = keep
+        return n
+
+    def position(self, match):
+        """
+        Returns the position of the first item match(item) is true for, or
+        None if none is waiting.
+        """
+        for i, e in enumerate(self._q):
+            if match(e[4]):
+                return i + 1
+        return None
+
+
+def _decr(counts, key):
+    n = counts.get(key, 0) - 1
+    if n > 0:
+        counts[key] = n
+    else:
+        counts.pop(key, None)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,232 @@
+"""
+Which CPUs workers run on.
+"""
+
+import ctypes
+import ctypes.util
+import os
+
+POLICIES = ('numa', 'dedicated')
+
+_SETSIZE = 1024 # CPUs in the kernel's cpu_set_t
+_WORD = ctypes.sizeof(ctypes.c_ulong) * 8
+
+
+class _CpuSet(ctypes.Structure):
+    _fields_ = [('bits', ctypes.c_ulong * (_SETSIZE // _WORD))]
+
+
+_libc = None
+
+
+def _libc_fn(name):
+    global _libc
+    if _libc is None:
+        path = ctypes.util.find_library('c')
+        _libc = ctypes.CDLL(path, use_errno=True) if path else False
+    return getattr(_libc, name, None) if _libc else None
+
+
+def _threads(pid):
+    """
+    Returns the thread ids of process pid, which has its own if it has no
+    others or /proc can't be read.
+    """
+    try:
+        return [int(tid) for tid in os.listdir('/proc/%d/task' % (pid,))]
+    except (OSError, ValueError):
+        return [pid]
+
+
+def get_affinity(pid=0):
+    """
+    Returns the CPUs process pid (0 for this one) may run on, or None if
+    that can't be found.
+
+    EXAMPLES::
+
+        >>> cpus = get_affinity()
+        >>> cpus is None or len(cpus) >= 1
+        True
+    """
+    fn = _libc_fn('sched_getaffinity')
+    if fn is None:
+        return None
+    mask = _CpuSet()
+    if fn(pid, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        return None
+    return [cpu for cpu in range(_SETSIZE)
+            if mask.bits[cpu // _WORD] >> (cpu % _WORD) & 1]
+
+
+def set_affinity(pid, cpus):
+    """
+    Restricts every thread of process pid to cpus.  Returns False if it
+    couldn't be done, because the process is gone, say.
+
+    EXAMPLES::
+
+        >>> cpus = get_affinity()
+        >>> cpus is None or set_affinity(os.getpid(), cpus)
+        True
+    """
+    fn = _libc_fn('sched_setaffinity')
+    if fn is None:
+        return False
+    mask = _CpuSet()
+    for cpu in cpus:
+        mask.bits[cpu // _WORD] |= 1 << (cpu % _WORD)
+    ok = True
+    for tid in _threads(pid or os.getpid()):
+        if fn(tid, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+            ok = False
+    return ok
+
+
+class CpuPlanner(object):
+    """
+    Decides the CPUs each worker may run on.
+
+    A worker is given a home NUMA node when it's first seen, the node with
+    the fewest workers, and only runs on that node's CPUs, so the memory it
+    touches is the node's own.  With the ``'numa'`` policy that's all.  With
+    ``'dedicated'`` the first ``shared`` CPUs of each node are a pool that
+    idle workers share, and a computing worker is given one of the others
+    to itself.  When they're all taken it runs on any of the node's CPUs
+    until one is freed.  A worker running a parallel batch (more than one
+    core) runs on all of them.
+
+    :meth:`update` and :meth:`remove` return the ``(worker, cpus)`` to set,
+    which include other workers when a CPU changes hands.
+
+    EXAMPLES::
+
+        >>> p = CpuPlanner({0: [0, 1, 2], 1: [3, 4, 5]}, shared=1)
+        >>> p.update('a', False), p.update('b', False)
+        ([('a', [0])], [('b', [3])])
+        >>> p.update('c', False), p.update('d', False)
+        ([('c', [0])], [('d', [3])])
+        >>> p.update('a', True), p.update('c', True)
+        ([('a', [1])], [('c', [2])])
+        >>> p.update('e', True)                   # node 0's are taken
+        [('e', [0, 1, 2])]
+        >>> p.update('a', True)                   # still computing
+        [('a', [1])]
+        >>> p.update('a', False)                  # e gets a's
+        [('a', [0]), ('e', [1])]
+        >>> p.update('b', True), p.update('d', True)
+        ([('b', [4])], [('d', [5])])
+        >>> p.update('f', True)
+        [('f', [3, 4, 5])]
+        >>> p.remove('d')
+        [('f', [5])]
+        >>> p.update('c', True, cores=None)       # a parallel batch
+        [('c', [0, 1, 2])]
+
+    The CPUs can be limited to those the manager may use::
+
+        >>> p = CpuPlanner({0: [0, 1, 2], 1: [3, 4, 5]}, policy='numa',
+        ...                allowed=[4, 5])
+        >>> p.update('a', True), p.update('b', False)
+        ([('a', [4, 5])], [('b', [4, 5])])
+    """
+
+    def __init__(self, nodes, policy='dedicated', shared=1, allowed=None):
+        """
+        :param nodes: NUMA node -> its CPUs, see ``host.numa_nodes``.
+        :param policy: ``'numa'`` or ``'dedicated'``.
+        :param shared: CPUs of each node kept for idle workers, at least 1.
+        :param allowed: the CPUs that may be used, None for all.
+        """
+        if policy not in POLICIES:
+            raise ValueError("unknown CPU affinity policy %r" % (policy,))
+        self.policy = policy
+        self._cpus = {} # node -> all its CPUs
+        self._shared = {} # node -> the CPUs idle workers share
+        self._own = {} # node -> CPUs that can be given to a worker
+        for node, cpus in nodes.iteritems():
+            if allowed is not None:
+                cpus = [cpu for cpu in cpus if cpu in allowed]
+            if not cpus:
+                continue
+            k = max(1, shared)
+            self._cpus[node] = cpus
+            self._shared[node] = cpus[:k] if len(cpus) > k else cpus
+            self._own[node] = cpus[k:]
+        if not self._cpus:
+            raise ValueError("no CPUs to run workers on")
+        self._home = {} # worker -> node
+        self._homed = dict.fromkeys(self._cpus, 0)
+        self._owner = {} # CPU -> the worker it's given to
+        self._given = {} # worker -> its CPU
+        self._waiting = [] # computing workers without a CPU, first come
+
+    def home(self, w):
+        """
+        Returns w's home node.
+        """
+        node = self._home.get(w)
+        if node is None:
+            node = min(self._homed, key=lambda n: (self._homed[n], n))
+            self._home[w] = node
+            self._homed[node] += 1
+        return node
+
+    def update(self, w, computing, cores=1):
+        """
+        Called when w starts or stops computing, or is new.
+        """
+        node = self.home(w)
+        if computing and cores == 1 and self.policy == 'dedicated':
+            cpu = self._given.get(w)
+            if cpu is None:
+                cpu = self._take(w, node)
+            if cpu is not None:
+                return [(w, [cpu])]
+            if w not in self._waiting:
+                self._waiting.append(w)
+            return [(w, self._cpus[node])]
+        changes = [(w, self._cpus[node] if computing or self.policy == 'numa'
+                       else self._shared[node])]
+        changes.extend(self._release(w))
+        return changes
+
+    def remove(self, w):
+        """
+        Called when w has exited.
+        """
+        changes = self._release(w)
+        node = self._home.pop(w, None)
+        if node is not None:
+            self._homed[node] -= 1
+        return changes
+
+    def _take(self, w, node):
+        for cpu in self._own[node]:
+            if cpu not in self._owner:
+                self._owner[cpu] = w
+                self._given[w] = cpu
+                return cpu
+        return None
+
+    def _release(self, w):
+        """
+        Frees w's CPU, giving it to the first worker waiting on the node.
+        """
+        if w in self._waiting:
+            self._waiting.remove(w)
+        cpu = self._given.pop(w, None)
+        if cpu is None:
+            return []
+        del self._owner[cpu]
+        node = self._home[w]
+        for other in self._waiting:
+            if self._home[other] == node:
+                self._waiting.remove(other)
+                return [(other, [self._take(other, node)])]
+        return []
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,115 @@
+"""
+What the manager knows about the computer it runs on.
+"""
+
+import os
+
+
+def cpu_count():
+    """
+    Returns the number of CPUs, or 1 if that can't be found.
+
+    EXAMPLES::
+
+        >>> cpu_count() >= 1
+        True
+    """
+    try:
+        return os.sysconf('SC_NPROCESSORS_ONLN')
+    except (AttributeError, ValueError, OSError):
+        return 1
+
+
+def numa_nodes(sysdir='/sys/devices/system/node'):
+    """
+    Returns a dict of each NUMA node's number to its CPUs.  If the kernel
+    doesn't say, all the CPUs are node 0.
+
+    EXAMPLES::
+
+        >>> sum(len(cpus) for cpus in numa_nodes().values()) >= 1
+        True
+        >>> numa_nodes('/nonexistent') == {0: range(cpu_count())}
+        True
+    """
+    try:
+        names = os.listdir(sysdir)
+    except OSError:
+        names = []
+    nodes = {}
+    for name in names:
+        if not (name.startswith('node') and name[4:].isdigit()):
+            continue
+        try:
+            with open(os.path.join(sysdir, name, 'cpulist')) as f:
+                cpus = parse_cpulist(f.read())
+        except (IOError, ValueError):
+            continue
+        if cpus: # memory-only nodes have none
+            nodes[int(name[4:])] = cpus
+    return nodes or {0: range(cpu_count())}
+
+
+def parse_cpulist(s):
+    """
+    Returns the CPUs in a list like the kernel's ``cpulist`` files.
+
+    EXAMPLES::
+
+        >>> parse_cpulist('0-3,8,10-11')
+        [0, 1, 2, 3, 8, 10, 11]
+        >>> parse_cpulist('')
+        []
+    """
+    cpus = []
+    for part in s.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def load_average():
+    """
+    Returns the 1 minute load average, or None if it isn't available.
+    """
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+
+
+def free_ram(meminfo='/proc/meminfo'):
+    """
+    Returns the bytes of memory available for new processes without
+    swapping, or None if that can't be found.
+
+    EXAMPLES::
+
+        >>> free_ram() > 0
+        True
+        >>> free_ram('/nonexistent') is None
+        True
+    """
+    try:
+        with open(meminfo) as f:
+            fields = dict(line.split(':', 1) for line in f)
+    except (IOError, ValueError):
+        return None
+    # MemAvailable is only in newer kernels
+    if 'MemAvailable' in fields:
+        kb = _kb(fields['MemAvailable'])
+    else:
+        kb = sum(_kb(fields.get(k, '0')) for k in
+                 ('MemFree', 'Buffers', 'Cached'))
+    return kb * 1024
+
+
+def _kb(value):
+    return int(value.split()[0])
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -1,124 +1,1365 @@
-from twisted.internet.protocol import ProcessProtocol, Factory
-from twisted.internet import reactor
+"""
+The compute node manager.
+
+    python run_compnode.py [port] [node name]
+
+Clients connect over WebSocket and speak JSON messages: ``{"type":
+"ExecCell", "id": 5, "source": "..."}``, where ``type`` is a message class
+name from :mod:`sageserver.msg` and ``id`` is the client's id for the
+request.  Replies carry the same ``id``.
+
+Each client session is given a worker from a pool of idle ones.  Workers
+are spawned with their message pipes on fds 3 and 4 (see
+``run_worker.py``), and a :class:`router.Router` per worker maps the sids
+on its pipe back to the client ids.  Everything runs on one reactor.
+
+``GET /capacity`` (a plain HTTP request on the same port) answers with the
+node's :meth:`WorkerService.capacity` as JSON, for the front-end that
+places sessions on nodes (:mod:`sageserver.frontend`).
+
+A session outlives its connection for a while, so a client that reconnects
+is sent the output it missed and carries on (see :class:`Session`).
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+from collections import deque
+from time import time as _time
+from urlparse import parse_qs, urlparse
+
+from twisted.application import service
+from twisted.internet import protocol, reactor, task
+from twisted.python import log
 
 import sageserver.msg as msg
+from sageserver.msg.decodedmsg import CallbackMsgDecoder, DecodedMsg
+from sageserver.msg.hdr import HDR_LEN
+from sageserver.msg.transcode import bson_to_json, json_to_msg
+from sageserver.compnode.worker.options import format_args
+from admission import FairQueue, QueueFull
+from affinity import CpuPlanner, get_affinity, set_affinity
+from host import cpu_count, free_ram, load_average, numa_nodes
+from pool import AdaptivePool
+from recycle import RecyclePolicy
+from replay import ReplayRing
+from router import Router, RouterFull
+from sendbuffer import SendBuffer
+from stats import Stats
+from stdinwindow import StdinWindow
+from websocket import WebSocketProtocol, CLOSE_PROTOCOL_ERROR
 
-def get_worker_path(rel_path):
-    from sys import argv
-    from os.path import join, dirname
-    return join(dirname(argv[0]), rel_path)
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '..', '..', 'run_worker.py')
 
-WORKER_PATH = get_worker_path('run_worker.py')
+DEFAULT_CONFIG = {
+    'ws_port': 8080,
+    'exc_node_name': None,
+    'exc_worker_script': WORKER_SCRIPT,
+    'exc_start_timeout': 10.0,
+    'exc_cell_timeout': None,
+    'exc_cell_cpu_timeout': None,
+    'exc_max_as': None,
+    'exc_max_rss': None,
+    'exc_rss_warn': None,
+    'exc_hibernate_after': 30 * 60.0,
+    'exc_hibernate_check': 60.0,
+    'exc_hibernate_dir': None,
+    'exc_cache_entries': None,
+    'exc_cache_dir': None,
+    'exc_progress_rate': None,
+    'exc_progress_interval': 0.25,
+    'exc_stdin_window': None,
+    'exc_display_bytes': None,
+    'exc_output_rate': None,
+    'exc_output_soft_limit': None,
+    'exc_output_limit': None,
+    'exc_output_interrupt': None,
+    'exc_min_idle_workers': 1,
+    'exc_max_idle_workers': 16,
+    'exc_pool_check': 5.0,
+    'exc_recycle_cells': 1000,
+    'exc_recycle_age': 6 * 3600.0,
+    'exc_recycle_rss': None,
+    'exc_send_high_water': 1024 * 1024,
+    'exc_send_low_water': 256 * 1024,
+    'exc_send_merge_max': 65536,
+    'exc_session_linger': 60.0,
+    'exc_replay_memory': 1024 * 1024,
+    'exc_replay_disk': 16 * 1024 * 1024,
+    'exc_replay_dir': '/tmp',
+    'exc_user_max_workers': None,
+    'exc_group_max_workers': None,
+    'exc_max_running': None,
+    'exc_user_max_running': None,
+    'exc_group_max_running': None,
+    'exc_user_weights': None,
+    'exc_group_weights': None,
+    'exc_max_queued': 500,
+    'exc_user_max_queued': None,
+    'exc_max_queue_wait': None,
+    'exc_queue_update': 1.0,
+    'exc_cpu_affinity': None,
+    'exc_cpu_shared': 1,
+    'exc_cpus': None,
+}
 
+# offered by clients that take the worker's frames as they are
+BINARY_SUBPROTOCOL = 'sageserver.bson'
 
-def main():
-    WorkerProcessProtocol.spawn_worker()
-    reactor.run()
+# fds of the worker: stdin, stdout, stderr, messages to it and from it
+_CHILD_FDS = {0: 'w', 1: 'r', 2: 'r', 3: 'w', 4: 'r'}
+
+_CLASSES_BY_NAME = dict((cls.__name__, cls)
+                        for cls in msg.TYPE_CLASSES.itervalues())
+# frequent, flat bodies, which are quicker to transcode than to decode and
+# dump (see bench/transcode.py)
+_TRANSCODED = frozenset([msg.STDOUT, msg.STDERR, msg.PROGRESS, msg.DONE,
+                         msg.NO, msg.YES])
+_EXECS = (msg.EXEC_CELL, msg.EXEC_BATCH)
+# what a client may ask of its worker, the rest are the manager's (Shutdown,
+# Hibernate and Restore, which take a path) or replies
+_CLIENT_TYPES = frozenset([msg.EXEC_CELL, msg.EXEC_BATCH, msg.STDIN,
+                           msg.INTERRUPT, msg.IS_COMPUTING,
+                           msg.GET_COMPLETIONS, msg.GET_DOC, msg.GET_SOURCE,
+                           msg.FETCH_MORE, msg.FETCH_DISPLAY, msg.SNAPSHOT,
+                           msg.ROLLBACK])
+_REJECTED_TEXT = {
+    'OVERLOADED': "The server is too busy, try again later.",
+    'USER_QUEUE_FULL': "You have too many cells waiting to run.",
+}
+_TYPE_NAMES_JSON = dict((t, json.dumps(cls.__name__))
+                        for t, cls in msg.TYPE_CLASSES.iteritems())
+
+
+def to_json(m, client_id):
+    """
+    Returns the JSON text sent to a client for m.  The bodies of output
+    from a worker are transcoded straight from their BSON.
+
+    EXAMPLES::
+
+        >>> from sageserver.msg.decodedmsg import MsgDecoder
+        >>> m, = MsgDecoder().feed(str(msg.Stdout('hi').encode()))
+        >>> to_json(m, 7)
+        '{"type": "Stdout", "id": 7, "bytes": "hi"}'
+        >>> json.loads(to_json(msg.Stdout('hi'), 7)) == json.loads(
+        ...     to_json(m, 7))
+        True
+    """
+    head = '"type": %s, "id": %s' % (_TYPE_NAMES_JSON[m.type],
+                                     json.dumps(client_id))
+    if isinstance(m, DecodedMsg):
+        raw = m.raw_body()
+        if raw is not None and m.type in _TRANSCODED:
+            return bson_to_json(raw, head=head, skip='t')
+        body = m.body()
+    else:
+        body = m
+    d = dict(body)
+    del d['t']
+    d['type'] = msg.TYPE_CLASSES[m.type].__name__
+    d['id'] = client_id
+    return json.dumps(d)
+
+
+def to_frame(m, client_id):
+    """
+    Returns the binary message sent to a :data:`BINARY_SUBPROTOCOL` client
+    for m: the header and BSON body as the worker sent them, with the
+    client's id as the sid.  Only the header is rewritten.
+
+    EXAMPLES::
+
+        >>> from sageserver.msg.decodedmsg import MsgDecoder
+        >>> m, = MsgDecoder().feed(str(msg.Stdout('hi', _hsid=3).encode()))
+        >>> f = to_frame(m, 700)
+        >>> m2, = MsgDecoder().feed(f)
+        >>> m2.hdr.sid, m2['bytes'], m.hdr.sid
+        (700, u'hi', 3)
+        >>> to_frame(msg.Done(), 700) == str(msg.Done(_hsid=700).encode())
+        True
+    """
+    body = m.raw_body() if isinstance(m, DecodedMsg) else None
+    if body is None:
+        # made here, or decoded and maybe changed
+        body = str(m.encode())[HDR_LEN:]
+    return m.hdr.encode_with_sid(client_id) + body
+
+
+def _fits_sid(m, client_id):
+    """
+    Returns whether the ids of m can be sent back as sids.
+    """
+    ids = [client_id]
+    if m.type == msg.EXEC_BATCH:
+        ids.extend(cell.get('sid', 0) for cell in m['cells'])
+    return all(isinstance(i, (int, long)) and 0 < i <= 0xffff for i in ids)
+
+
+class Worker(protocol.ProcessProtocol):
+    """
+    A worker process, seen from the manager.
+    """
+
+    def __init__(self, service):
+        self._service = service
+        self._client = None
+        self._running = set() # sids of ExecCells and ExecBatches sent
+        self._parallel = set() # those that are parallel ExecBatches
+        self.router = Router()
+        self._decoder = CallbackMsgDecoder(
+                dict.fromkeys(msg.TYPE_CLASSES, self.msg_recv))
+        self.ready = False # answered the IsComputing sent at startup
+        self.closed = False # its pipe is closed
+        self.rss = 0
+        self.mem_level = 'OK'
+        self.pid = None # changes when a snapshot is rolled back to
+        self.last_active = _time()
+        self.hibernating = False
+        self.started = _time()
+        self.cells_run = 0
+        self.cpus = None # what its affinity was last set to
+
+    @property
+    def computing(self):
+        return bool(self._running)
+
+    @property
+    def parallel(self):
+        return bool(self._parallel)
+
+    def set_client(self, c):
+        self._client = c
 
-class WorkerProcessProtocol(ProcessProtocol):
-    @classmethod
-    def spawn_worker(cls):
-        wpp = cls()
-        childFDs = {0: "w", 1: "r", 2: "r", 3: "w", 4: "r"}
-        reactor.spawnProcess(wpp, "python", ["python", WORKER_PATH],
-                             childFDs=childFDs)
-        print ">>>>> spawned pid %s <<<<<" % (wpp.transport.pid,)
-        wpp._rm_pid = reactor.addSystemEventTrigger('before', 'shutdown',
-                                      _rm_child_proc, wpp.transport.pid)
-        return wpp
-    
-    def __init__(self):
-        print ">>>>> __init__ <<<<<"
-        
     def connectionMade(self):
-        print ">>>>> connectionMade <<<<<"
-        if 0:
-            print ">>>>> closing fd 3 <<<<<"
-            self.transport.closeChildFD(3)
-        if 1:
-            bs = bytes(msg.Interrupt().init().encode())
-            print ">>>>> sending %r <<<<<" % (bs,)
-            self.transport.writeToChild(3, bs)
-        
-    def childDataReceived(self, childFD, data):
-        
-        if childFD != 4:
-            #print "childDataReceived %d:\n%s" % (childFD, data)
-            print data,
-        if childFD == 4:
-            print ">>>>> from send_thread: %r <<<<<" % (data,)
-            self._jbuf.append(data)
-            while len(self._jbuf) >= self._n_needed:
-                if self._state == WP_READING_HEADER:
-                    dbytes = self._jbuf.popleft(self._n_needed)
-                    try:
-                        hdr = msg.Hdr.decode(dbytes)
-                    except HdrDecodeError:
-                        log.err()
-                        self.stopWorker()
-                        return
-                    self._state, self._n_needed = self.msgHeaderReceived(hdr)
-                elif self._state == WP_READING_BODY:
-                    dbytes = self._jbuf.popleft(self._n_needed)
-                    self.msgBodyReceived(dbytes)
-                    self._reset_msg_parser()
-                elif self._state == WP_SKIPPING_BODY:
-                    self._jbuf.popleft(self._n_needed, join=False)
-                    self._reset_msg_parser()
-                    
-
-                    
-    def msgHeaderReceived(self, hdr):
-        """
-        Returns (state, n_needed)
-        """
-        if hdr.type in msg.TYPE_DICT:
-            self._hdr = hdr
-            print ">>>>> Got %d %s header, len %d <<<<<" % (
-                        hdr.type, msg.TYPE_STRS[hdr.type], hdr.length)
-            return (WP_READING_BODY, hdr.length)
+        self.pid = self.transport.pid
+        # answered once the worker is up
+        self.msg_send(msg.IsComputing())
+
+    def childDataReceived(self, fd, data):
+        if fd == 4:
+            self._decoder.feed(data)
         else:
-            print ">>>>> Got Unknown type %d header, len %d <<<<<" % (
-                        hdr.type, hdr.length)
-            return (WP_SKIPPING_BODY, hdr.length)
-        
-    def msgBodyReceived(self, bodybytes):
-        print ">>>>> Got message body: %r <<<<<" % (bodybytes,)
-        
-        
-            
-        
-                        
-                        
-    def stopWorker(self):
-        print ">>>>> stopWorker <<<<<"
-        self.transport.closeChildFD(3)
-        self.transport.signalProcess('KILL')
-        
-                
-                
-            
-            
-    def childConnectionLost(self, childFD):
-        print ">>>>> childConnectionLost %d <<<<<" % (childFD,)
-                
-    def processExited(self, reason):
-        print ">>>>> processExited, status %d <<<<<" % (reason.value.exitCode,)
+            log.msg("worker %s: %s" % (self.pid, data.rstrip()))
+
+    def childConnectionLost(self, fd):
+        if fd == 3:
+            self.closed = True
+
     def processEnded(self, reason):
-        print ">>>>> processEnded, status %d <<<<<" % (reason.value.exitCode,)
-        reactor.removeSystemEventTrigger(self._rm_pid)
-        reactor.stop()
-        
-        
+        self.closed = True
+        self._service.worker_exited(self)
+
+    def msg_recv(self, m):
+        """
+        Called with each message from the worker.
+        """
+        self.last_active = _time()
+        if m.hdr.sid == 0:
+            self._manager_msg(m)
+            return
+        if m.type == msg.ROLLED_BACK:
+            self.pid = m['pid']
+            # the process forked from may have moved CPUs since
+            self._service.worker_computing(self, force=True)
+        if (m.type == msg.DONE and self._running == set([m.hdr.sid])
+                and self.mem_level != 'BREACH'):
+            # nothing else is running: a safe point to switch workers, with
+            # a Notice ahead of the Done
+            self._service.worker_settled(self, m.hdr.sid)
+        r = self.router.route(m.hdr.sid, m.hdr.flags)
+        if r is not None:
+            client, client_id = r
+            client.msg_send(m, client_id)
+        if m.type == msg.DONE:
+            before = (self.computing, self.parallel)
+            self._running.discard(m.hdr.sid)
+            self._parallel.discard(m.hdr.sid)
+            if (self.computing, self.parallel) != before:
+                self._service.worker_computing(self)
+            if not self.computing and self.mem_level == 'BREACH':
+                # the Except has been passed on, now replace the worker
+                self._service.recycle_worker(self)
+
+    def _manager_msg(self, m):
+        """
+        Handles messages that aren't part of a client's stream.
+        """
+        if m.type in (msg.YES, msg.NO) and not self.ready:
+            self.ready = True
+            self._service.worker_ready(self)
+        elif m.type == msg.HIBERNATED:
+            self._service.worker_hibernated(self, m)
+        elif m.type == msg.RESTORED:
+            self._service.worker_restored(self, m)
+        elif m.type == msg.NO and self.hibernating:
+            # couldn't write the file, carry on with what the client sent
+            self.hibernating = False
+            if self._client:
+                self._client.set_worker(self)
+        elif m.type == msg.MEMORY_USAGE:
+            self.rss = m['rss']
+            self.mem_level = m['level']
+            self._service.worker_memory(self)
+
+    def msg_send(self, m):
+        """
+        Writes a message to the worker's pipe.
+        """
+        if self.closed:
+            return
+        self.last_active = _time()
+        if m.type == msg.EXEC_CELL:
+            self.cells_run += 1
+        elif m.type == msg.EXEC_BATCH:
+            self.cells_run += len(m['cells'])
+        if m.type in (msg.EXEC_CELL, msg.EXEC_BATCH):
+            before = (self.computing, self.parallel)
+            self._running.add(m.hdr.sid)
+            if m.type == msg.EXEC_BATCH and m['parallel']:
+                self._parallel.add(m.hdr.sid)
+            if (self.computing, self.parallel) != before:
+                self._service.worker_computing(self)
+        self.transport.writeToChild(3, str(m.encode()))
+
+    def pause_reading(self):
+        """
+        Stops reading the worker's pipes, so it blocks once they're full.
+        """
+        self.transport.pauseProducing()
+
+    def resume_reading(self):
+        self.transport.resumeProducing()
+
+    def stop(self):
+        """
+        Kills the worker process.
+        """
+        if self.pid != self.transport.pid:
+            _rm_child_proc(self.pid)
+        try:
+            self.transport.signalProcess('KILL')
+        except Exception:
+            pass # already gone
+
+
 def _rm_child_proc(pid):
     from os import kill
     from signal import SIGKILL
-    print "killing pid %s" % (pid,)
     try:
         kill(pid, SIGKILL)
     except OSError:
         pass
-        
-    
+
+
+class Session(object):
+    """
+    A client's session.  It gets a worker with its first ExecCell or
+    ExecBatch and keeps it until it's closed or the worker is replaced.
+
+    A session outlives its connection by ``exc_session_linger`` seconds, so
+    a client that reconnects in time carries on where it was (see
+    :class:`WebSocketClient`).  The messages written to the client are
+    numbered from 1 and the last of them kept in a :class:`ReplayRing`, to
+    be sent again if the connection dropped before they got through.
+
+    A session with a :data:`BINARY_SUBPROTOCOL` connection is sent the
+    worker's frames as binary messages (see :func:`to_frame`).
+
+    Sessions belong to a user and maybe a group, who share the node's
+    workers and the cells running on them fairly (see
+    :class:`admission.FairQueue`).  A request that has to wait is answered
+    with Queued messages, one that's turned away with a Rejected and a
+    Done.
+
+    The session is its connection's push producer.  While the connection's
+    buffer is full, or there's no connection, output is held in a
+    :class:`SendBuffer`, and once that is over its high watermark the
+    worker's pipe isn't read until the client catches up.
+    """
+
+    def __init__(self, service, token, binary, user, group=None):
+        self._service = service
+        self.token = token
+        self.binary = binary
+        self.user = user
+        self.group = group
+        self._conn = None
+        self._linger_call = None
+        self._worker = None
+        self._waiting = False # for get_worker
+        self._pending = [] # (message, client id) for the next worker
+        # client id of a Rollback not answered yet, the requests after it
+        # wait in _pending for the promoted worker
+        self._rollback = None
+        self._hibernated = None # path of our hibernated namespace
+        self._progress = {} # client id -> latest Progress not sent yet
+        self._progress_call = None
+        self._stdin = StdinWindow()
+        self._holding = False # a worker, as far as the quotas go
+        self._running = set() # client ids of the Execs let run
+        self._positions = {} # client id -> last Queued position sent
+        self._blocked = True # no connection, or its buffer is full
+        self._paused_worker = None # not being read from
+        config = service.config
+        self._sendbuf = SendBuffer()
+        buf = self._sendbuf
+        buf.high = config.get('exc_send_high_water', buf.high)
+        buf.low = config.get('exc_send_low_water', buf.low)
+        buf.merge_max = config.get('exc_send_merge_max', buf.merge_max)
+        self._ring = ReplayRing(
+                memory=config.get('exc_replay_memory', 1024 * 1024),
+                disk=config.get('exc_replay_disk', 0),
+                spill_dir=config.get('exc_replay_dir'))
+
+    @property
+    def buffered_bytes(self):
+        """
+        The bytes of output held back from the client.
+        """
+        return self._sendbuf.nbytes
+
+    def attach(self, conn, after=None):
+        """
+        Makes conn the session's connection.  The messages numbered after
+        after are sent again first, if they're all kept.  The client is
+        told how it went with a Session message.
+        """
+        if self._linger_call is not None:
+            self._linger_call.cancel()
+            self._linger_call = None
+        if self._conn is not None:
+            # the client noticed the old one was gone before we did
+            old, self._conn = self._conn, None
+            old.session = None
+            old.close()
+        self._conn = conn
+        stats = self._service.stats
+        replay = None
+        if after is not None and after <= self._ring.seq:
+            replay = self._ring.replay(after)
+            if replay is None:
+                stats.incr('replay_gaps')
+        if replay is None:
+            conn.sendMessage(to_json(msg.Session(
+                    self.token, self._ring.seq, False), 0))
+            replay = []
+        else:
+            conn.sendMessage(to_json(msg.Session(self.token, after, True),
+                                     0))
+        self._blocked = False
+        for data, binary in replay:
+            conn.sendMessage(data, binary)
+        stats.incr('replayed_messages', len(replay))
+        self._flush()
+
+    def detach(self, conn):
+        """
+        Called when conn is lost.  The session is closed unless the client
+        comes back within ``exc_session_linger`` seconds.
+        """
+        if self._conn is not conn:
+            return
+        self._conn = None
+        self._blocked = True
+        linger = self._service.config.get('exc_session_linger')
+        if linger:
+            self._linger_call = reactor.callLater(linger, self.close)
+        else:
+            self.close()
+
+    def close(self):
+        """
+        Shuts down the session's worker and forgets it.
+        """
+        self._linger_call = None
+        if self._progress_call is not None:
+            self._progress_call.cancel()
+            self._progress_call = None
+        self._service.stats.incr('send_buffered_bytes',
+                                 -self._sendbuf.nbytes)
+        self._sendbuf.clear()
+        self._ring.close()
+        if self._paused_worker is not None:
+            self._paused_worker.resume_reading()
+            self._paused_worker = None
+        self._service.session_closed(self)
+        for client_id in self._running:
+            self._service.cell_finished(self)
+        self._running.clear()
+        if self._worker:
+            self._worker.router.close_client(self)
+            self._worker.msg_send(msg.Shutdown())
+        self._release_worker()
+        if self._hibernated is not None:
+            self._service.discard_hibernated(self._hibernated)
+
+    def pauseProducing(self):
+        self._blocked = True
+
+    def resumeProducing(self):
+        if self._conn is not None:
+            self._blocked = False
+            self._flush()
+
+    def stopProducing(self):
+        pass
+
+    def set_worker(self, worker):
+        self._waiting = False
+        self._holding = True
+        self._positions.clear()
+        self._worker = worker
+        worker.set_client(self)
+        if self._hibernated is not None:
+            # queued in the worker ahead of the pending Exec
+            worker.msg_send(msg.Restore(self._hibernated))
+            self._hibernated = None
+        self._send_pending()
+
+    def worker_lost(self, worker):
+        """
+        Called when the worker is recycled or exits.  Requests it hadn't
+        answered are ended with a Stderr and a Done.  The next Exec gets a
+        new worker.
+        """
+        if self._worker is worker:
+            self._worker = None
+            self._rollback = None
+            self._release_worker()
+        if self._paused_worker is worker:
+            self._paused_worker = None
+        for client_id in worker.router.close_client(self):
+            self.msg_send(msg.Stderr("the worker was lost\n"), client_id)
+            self.msg_send(msg.Done(), client_id)
+        if self._worker is None and self._pending:
+            self._get_worker()
+
+    def hibernated(self, worker, path):
+        """
+        Called when our idle worker has saved the namespace to path and
+        exited.  It's restored into a new worker on the next request.
+        """
+        if self._worker is worker:
+            self._worker = None
+            self._release_worker()
+        if self._paused_worker is worker:
+            self._paused_worker = None
+        self._hibernated = path
+        if self._pending:
+            self._get_worker()
+
+    def _get_worker(self):
+        if self._waiting:
+            return
+        self._waiting = True
+        try:
+            self._service.get_worker(self)
+        except QueueFull, e:
+            self._waiting = False
+            pending, self._pending = self._pending, []
+            for m, client_id in pending:
+                if m.type in _EXECS:
+                    self.rejected(e, client_id)
+                else:
+                    self.msg_send(msg.No(), client_id)
+
+    def _release_worker(self):
+        if self._holding:
+            self._holding = False
+            self._service.worker_released(self)
+
+    def queued(self, position, wait, client_id=None):
+        """
+        Tells the client where its request is in the queue, the request
+        with client_id or, without, the Execs waiting for a worker.  Only
+        changes are sent.
+        """
+        if client_id is None:
+            ids = [cid for m, cid in self._pending if m.type in _EXECS]
+        else:
+            ids = [client_id]
+        for cid in ids:
+            if self._positions.get(cid) != position:
+                self._positions[cid] = position
+                self.msg_send(msg.Queued(position, wait), cid)
+
+    def rejected(self, e, client_id):
+        """
+        Tells the client its request with client_id was turned away with
+        QueueFull e.
+        """
+        self._service.stats.incr('rejected_' + e.reason.lower())
+        self._positions.pop(client_id, None)
+        self.msg_send(msg.Rejected(e.reason, _REJECTED_TEXT[e.reason],
+                                   e.retry_after), client_id)
+        self.msg_send(msg.Done(), client_id)
+
+    def start_cell(self, m, client_id):
+        """
+        Called when an Exec's turn has come.
+        """
+        self._positions.pop(client_id, None)
+        if (self._worker is None or self._worker.hibernating
+                or self._rollback is not None):
+            # lost the worker while it waited, or it's being replaced: it
+            # queues again once there's a new one
+            self._service.cell_finished(self)
+            self._pending.append((m, client_id))
+            if self._worker is None:
+                self._get_worker()
+            return
+        self._running.add(client_id)
+        if not self._forward(m, client_id):
+            self._running.discard(client_id)
+            self._service.cell_finished(self)
+
+    def msg_send(self, m, client_id):
+        """
+        Sends a message from the worker (or the manager) to the client.
+        """
+        if m.type == msg.PROGRESS:
+            # a Progress replaces the last one, so only the latest of each
+            # cell is sent every exc_progress_interval
+            if client_id in self._progress:
+                self._service.stats.incr('progress_coalesced')
+            self._progress[client_id] = m
+            if self._progress_call is None:
+                self._progress_call = reactor.callLater(
+                        self._service.config.get('exc_progress_interval',
+                                                 0.25),
+                        self._send_progress)
+            return
+        if m.type == msg.NEED_STDIN:
+            to_send, relay = self._stdin.need(m['nbytes'], m['window'])
+            self._send_stdin(to_send)
+            if not relay:
+                return
+            self._service.stats.incr('stdin_round_trips')
+        if (self._rollback is not None and client_id == self._rollback
+                and m.type in (msg.ROLLED_BACK, msg.NO)):
+            self._rollback = None
+            self._send(m, client_id)
+            self._send_pending()
+            return
+        if m.type == msg.DONE:
+            self._progress.pop(client_id, None)
+            self._stdin.reset()
+            self._positions.pop(client_id, None)
+            if client_id in self._running:
+                self._running.discard(client_id)
+                self._service.cell_finished(self)
+        self._send(m, client_id)
+
+    def _send(self, m, client_id):
+        stats = self._service.stats
+        stats.incr('send_msgs')
+        buf = self._sendbuf
+        if not (self._blocked or buf):
+            self._write(m, client_id)
+            return
+        before = buf.nbytes
+        buf.push(m, client_id)
+        stats.incr('send_buffered_bytes', buf.nbytes - before)
+        if (buf.nbytes > buf.high and self._paused_worker is None
+                and self._worker is not None):
+            # the worker blocks once its pipe fills, other sessions carry on
+            self._paused_worker = self._worker
+            self._paused_worker.pause_reading()
+            stats.incr('backpressure_pauses')
+            stats.observe('client_buffered_bytes', buf.nbytes)
+
+    def _flush(self):
+        """
+        Writes held back output until the connection's buffer is full again.
+        """
+        buf = self._sendbuf
+        before = buf.nbytes
+        while buf and not self._blocked:
+            m, client_id = buf.pop()
+            self._write(m, client_id)
+        self._service.stats.incr('send_buffered_bytes', buf.nbytes - before)
+        if self._paused_worker is not None and buf.nbytes <= buf.low:
+            self._paused_worker.resume_reading()
+            self._paused_worker = None
+
+    def _write(self, m, client_id):
+        self._service.stats.incr('send_frames')
+        if self.binary:
+            self._emit(to_frame(m, client_id), True)
+            return
+        if m.type == msg.DISPLAY and m['data'] is not None:
+            # the payload follows its Display as a binary frame instead of
+            # being base64'd into the json
+            data = str(m['data'])
+            m['data'] = None
+            m['binary'] = True
+            self._emit(to_json(m, client_id))
+            self._emit(data, True)
+            return
+        self._emit(to_json(m, client_id))
+
+    def _emit(self, data, binary=False):
+        """
+        Numbers a message and writes it to the connection.
+        """
+        self._ring.append(data, binary)
+        self._conn.sendMessage(data, binary)
+
+    def _send_stdin(self, to_send):
+        for bytes in to_send:
+            self._worker.msg_send(msg.Stdin(bytes))
+
+    def _send_progress(self):
+        self._progress_call = None
+        progress, self._progress = self._progress, {}
+        for client_id, m in progress.iteritems():
+            self._send(m, client_id)
+
+    def _send_pending(self):
+        """
+        Sends the requests that waited for the worker, up to a Rollback.
+        """
+        pending, self._pending = self._pending, []
+        for i, (m, client_id) in enumerate(pending):
+            if self._rollback is not None:
+                self._pending = pending[i:]
+                return
+            self._send_to_worker(m, client_id)
+
+    def _send_to_worker(self, m, client_id):
+        """
+        Sends m to the worker, an Exec once it's its turn.
+        """
+        if m.type in _EXECS:
+            self._service.queue_cell(self, m, client_id)
+        elif m.type == msg.STDIN:
+            # held back until the cell's reads grant the window for it
+            self._send_stdin(self._stdin.push(m['bytes']))
+        elif self._forward(m, client_id) and m.type == msg.ROLLBACK:
+            # the worker is replaced by the snapshot, which should get
+            # nothing until it has taken over
+            self._rollback = client_id
+
+    def _forward(self, m, client_id):
+        """
+        Opens streams on the worker for m (and the cells of a batch) and
+        sends it.  Returns False if there weren't enough.
+        """
+        router = self._worker.router
+        try:
+            if m.type == msg.EXEC_BATCH:
+                for cell in m['cells']:
+                    cell['sid'] = router.open(self, cell.get('sid', 0))
+            m.hdr.sid = router.open(self, client_id)
+        except RouterFull:
+            log.msg("worker %s: no free stream ids" % (self._worker.pid,))
+            self.msg_send(msg.No(), client_id)
+            return False
+        self._worker.msg_send(m)
+        return True
+
+    def request(self, m, client_id):
+        """
+        Called with each message from the client.
+        """
+        if m.type not in _CLIENT_TYPES:
+            log.msg("session %s: refused a %s" % (self.token,
+                                                  type(m).__name__))
+            self._service.stats.incr('requests_refused')
+            self._send(msg.No(), client_id)
+            return
+        if (self._worker and not self._worker.hibernating
+                and self._rollback is None and not self._pending):
+            self._send_to_worker(m, client_id)
+        elif m.type in _EXECS or self._pending or self._worker:
+            # the worker is being hibernated or rolled back, or there isn't
+            # one yet
+            self._pending.append((m, client_id))
+            if self._worker is None:
+                # assign ourselves to a worker
+                self._get_worker()
+        elif m.type != msg.STDIN:
+            # there's nothing running to answer it
+            self.msg_send(msg.No(), client_id)
+
+
+class WebSocketClient(WebSocketProtocol):
+    """
+    A client's connection, to a new :class:`Session` or, with
+    ``?session=<token>&seq=<n>`` in the URL, to the session the client was
+    disconnected from.  A Session message is sent first either way.
+
+    A client that offers the :data:`BINARY_SUBPROTOCOL` still sends JSON.
+    Its ids must fit in a sid.
+    """
+
+    subprotocols = (BINARY_SUBPROTOCOL,)
+    session = None
+
+    def connectionOpened(self):
+        service = self.factory.service
+        binary = self.subprotocol == BINARY_SUBPROTOCOL
+        query = parse_qs(urlparse(self.path or '').query)
+        session = service.sessions.get(query.get('session', [None])[0])
+        after = None
+        if session is not None and session.binary == binary:
+            try:
+                after = int(query['seq'][0])
+            except (KeyError, ValueError):
+                after = 0
+            service.stats.incr('sessions_resumed')
+        else:
+            # who the session is for, as the client says
+            user = query.get('user', [self.transport.getPeer().host])[0]
+            session = service.new_session(binary, user,
+                                          query.get('group', [None])[0])
+        self.session = session
+        self.transport.registerProducer(self, True)
+        session.attach(self, after)
+
+    def pauseProducing(self):
+        if self.session is not None:
+            self.session.pauseProducing()
+
+    def resumeProducing(self):
+        if self.session is not None:
+            self.session.resumeProducing()
+
+    def stopProducing(self):
+        pass
+
+    def plainRequest(self, path):
+        if urlparse(path).path == '/capacity':
+            return ('application/json',
+                    json.dumps(self.factory.service.capacity()))
+        return None
+
+    def messageReceived(self, data, binary):
+        try:
+            m, client_id = json_to_msg(data, _CLASSES_BY_NAME)
+        except ValueError, e:
+            log.msg("bad message from client: %s" % (e,))
+            self.close(CLOSE_PROTOCOL_ERROR)
+            return
+        if self.subprotocol == BINARY_SUBPROTOCOL and not _fits_sid(
+                m, client_id):
+            log.msg("client id too big for a sid: %r" % (client_id,))
+            self.close(CLOSE_PROTOCOL_ERROR)
+            return
+        if self.session is not None:
+            self.session.request(m, client_id)
+
+    def connectionLost(self, reason):
+        if self.session is not None:
+            self.session.detach(self)
+            self.session = None
+
+
+class WebSocketFactory(protocol.ServerFactory):
+    protocol = WebSocketClient
+
+    def __init__(self, service):
+        self.service = service
+
+
+_RECYCLE_REASONS = {
+    'CELLS': 'it has run many cells',
+    'AGE': 'it has been running a long time',
+    'RSS': 'it is using a lot of memory',
+}
+
+
+class WorkerService(service.Service):
+
+    def __init__(self, config):
+        self.config = config
+        self._starting = {} # worker -> (start timeout, spawn time)
+        self._idle = deque()
+        self._worker_queue = self._fair_queue('workers') # of sessions
+        # of (session, Exec, client id)
+        self._cell_queue = self._fair_queue('running')
+        self._cells_running = 0
+        self._assigned = set() # workers handed out by get_worker
+        self._hibernated = {} # path -> bytes
+        self._hibernate_dir = None # made by startService, ours alone
+        self._queue_loop = self._pool_loop = self._hibernate_loop = None
+        self.sessions = {} # token -> Session
+        self.stats = Stats()
+        self._pool = AdaptivePool(
+                min_idle=config.get('exc_min_idle_workers', 1),
+                max_idle=config.get('exc_max_idle_workers', 16),
+                headroom=config.get('exc_pool_headroom', 2.0),
+                tau=config.get('exc_pool_tau', 60.0),
+                reap_after=config.get('exc_pool_reap_after', 120.0))
+        self._recycle = RecyclePolicy(
+                max_cells=config.get('exc_recycle_cells'),
+                max_age=config.get('exc_recycle_age'),
+                max_rss=config.get('exc_recycle_rss'))
+        self._cpus = None
+        if config.get('exc_cpu_affinity'):
+            self._cpus = CpuPlanner(numa_nodes(), config['exc_cpu_affinity'],
+                                    shared=config.get('exc_cpu_shared', 1),
+                                    allowed=(config.get('exc_cpus')
+                                             or get_affinity()))
+
+    def _fair_queue(self, what):
+        c = self.config
+        return FairQueue(user_quota=c.get('exc_user_max_' + what),
+                         group_quota=c.get('exc_group_max_' + what),
+                         weights=c.get('exc_user_weights'),
+                         group_weights=c.get('exc_group_weights'),
+                         max_queued=c.get('exc_max_queued'),
+                         user_max_queued=c.get('exc_user_max_queued'),
+                         max_wait=c.get('exc_max_queue_wait'))
+
+    def startService(self):
+        service.Service.startService(self)
+        # other users' processes can't read the hibernated namespaces or
+        # plant their own for a Restore; None puts it in the system's temp
+        # directory
+        self._hibernate_dir = tempfile.mkdtemp(
+                prefix='sageserver-hibernate-',
+                dir=self.config.get('exc_hibernate_dir'))
+        self._spawn_workers()
+        self._queue_loop = task.LoopingCall(self._send_positions)
+        self._queue_loop.start(self.config.get('exc_queue_update', 1.0),
+                               now=False)
+        self._pool_loop = task.LoopingCall(self._resize_pool)
+        self._pool_loop.start(self.config.get('exc_pool_check', 5.0),
+                              now=False)
+        if self.config.get('exc_hibernate_after'):
+            self._hibernate_loop = task.LoopingCall(self._hibernate_idle)
+            self._hibernate_loop.start(self.config['exc_hibernate_check'],
+                                       now=False)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        for loop in (self._queue_loop, self._pool_loop,
+                     self._hibernate_loop):
+            if loop is not None and loop.running:
+                loop.stop()
+        for session in self.sessions.values():
+            session.close()
+        for w in list(self._starting) + list(self._idle) + list(
+                self._assigned):
+            w.stop()
+        shutil.rmtree(self._hibernate_dir, ignore_errors=True)
+
+    def new_session(self, binary, user, group=None):
+        """
+        Returns a new :class:`Session` for user in group.
+        """
+        token = os.urandom(16).encode('hex')
+        name = self.config.get('exc_node_name')
+        if name:
+            # so the front-end can send a reconnect to this node
+            token = '%s-%s' % (name, token)
+        session = Session(self, token, binary, user, group)
+        self.sessions[session.token] = session
+        self.stats.incr('sessions')
+        return session
+
+    def session_closed(self, session):
+        """
+        Forgets session and its requests still waiting.
+        """
+        self.sessions.pop(session.token, None)
+        self.stats.incr('sessions', -1)
+        self._worker_queue.remove(lambda s: s is session)
+        self._cell_queue.remove(lambda item: item[0] is session)
+
+    def _spawn_workers(self):
+        """
+        Starts idle worker processes to fill the idle pool up to the size
+        the pool wants.
+        """
+        n = self._pool.to_spawn(len(self._idle), len(self._starting),
+                                len(self._worker_queue))
+        if n <= 0:
+            return
+        self.stats.incr('workers_spawned', n)
+        for i in range(n):
+            self._start_worker()
+
+    def _start_worker(self):
+        w = Worker(self)
+        timeout = reactor.callLater(self.config['exc_start_timeout'],
+                                    self._start_timeout, w)
+        self._starting[w] = (timeout, _time())
+        script = self.config['exc_worker_script']
+        reactor.spawnProcess(w, sys.executable,
+                             args=[sys.executable, script,
+                                   '--rfd=3', '--wfd=4']
+                                  + self._worker_args(),
+                             env=os.environ,
+                             childFDs=_CHILD_FDS)
+        # pinned before the worker has touched much memory, which then
+        # comes from its home node
+        self.worker_computing(w)
+        return w
+
+    def _worker_args(self):
+        """
+        Returns the per-deployment worker options from the config.
+        """
+        c = self.config
+        return format_args(timeout=c.get('exc_cell_timeout'),
+                           cpu_timeout=c.get('exc_cell_cpu_timeout'),
+                           output_rate=c.get('exc_output_rate'),
+                           output_soft_limit=c.get('exc_output_soft_limit'),
+                           output_limit=c.get('exc_output_limit'),
+                           output_interrupt=c.get('exc_output_interrupt'),
+                           max_as=c.get('exc_max_as'),
+                           max_rss=c.get('exc_max_rss'),
+                           rss_warn=c.get('exc_rss_warn'),
+                           cache_entries=c.get('exc_cache_entries'),
+                           cache_dir=c.get('exc_cache_dir'),
+                           progress_rate=c.get('exc_progress_rate'),
+                           stdin_window=c.get('exc_stdin_window'),
+                           display_bytes=c.get('exc_display_bytes'))
+
+    def worker_ready(self, w):
+        """
+        Called when a new worker has answered, it joins the idle pool.
+        """
+        timeout, spawned = self._starting.pop(w)
+        timeout.cancel()
+        seconds = _time() - spawned
+        self._pool.spawned(seconds)
+        self.stats.observe('spawn_seconds', seconds)
+        self._idle.append(w)
+        self._assign_workers()
+
+    def _start_timeout(self, w):
+        """
+        Called when a worker hasn't answered in time.
+        """
+        if self._starting.pop(w, None) is None:
+            return
+        log.err("worker %s didn't start in time" % (w.pid,))
+        w.stop()
+        self._spawn_workers()
+
+    def worker_exited(self, w):
+        """
+        Called when a worker process has exited, for whatever reason.
+        """
+        entry = self._starting.pop(w, None)
+        if entry is not None:
+            entry[0].cancel()
+        if self._cpus is not None:
+            for other, cpus in self._cpus.remove(w):
+                self._set_cpus(other, cpus)
+        if w in self._idle:
+            self._idle.remove(w)
+        if w in self._assigned:
+            log.msg("worker %s exited" % (w.pid,))
+            self._assigned.discard(w)
+            if w._client is not None:
+                w._client.worker_lost(w)
+        if self.running:
+            self._spawn_workers()
+
+    def get_worker(self, session):
+        """
+        Queues session for a worker, which it's given with
+        ``session.set_worker``.  Raises QueueFull if it's turned away.
+        """
+        hit = self._idle and not self._worker_queue
+        position = self._worker_queue.push(session, session.user,
+                                           session.group)
+        self._pool.arrival()
+        self.stats.incr('pool_hits' if hit else 'pool_misses')
+        self._assign_workers()
+        if self._worker_queue.position(lambda s: s is session) is not None:
+            session.queued(position, self._worker_queue.wait(position))
+
+    def worker_released(self, session):
+        """
+        Called when session no longer has the worker it was given.
+        """
+        self._worker_queue.finish(session.user, session.group)
+        self._assign_workers()
+
+    def queue_cell(self, session, m, client_id):
+        """
+        Runs an Exec of session's when it's its turn, with
+        ``session.start_cell``.
+        """
+        item = (session, m, client_id)
+        try:
+            position = self._cell_queue.push(item, session.user,
+                                             session.group)
+        except QueueFull, e:
+            session.rejected(e, client_id)
+            return
+        self._run_cells()
+        if self._cell_queue.position(lambda i: i is item) is not None:
+            self.stats.incr('cells_queued')
+            session.queued(position, self._cell_queue.wait(position),
+                           client_id)
+
+    def cell_finished(self, session):
+        """
+        Called when an Exec that was let run is done.
+        """
+        self._cells_running -= 1
+        self._cell_queue.finish(session.user, session.group)
+        self._run_cells()
+
+    def _run_cells(self):
+        limit = self.config.get('exc_max_running')
+        while limit is None or self._cells_running < limit:
+            entry = self._cell_queue.pop()
+            if entry is None:
+                break
+            (session, m, client_id), user, group, waited = entry
+            self._cells_running += 1
+            self.stats.observe('cell_queue_wait', waited)
+            session.start_cell(m, client_id)
+
+    def _send_positions(self):
+        """
+        Called periodically.  Tells clients whose requests have moved up
+        the queues where they are now.
+        """
+        q = self._worker_queue
+        for position, session in enumerate(q.queued(), 1):
+            session.queued(position, q.wait(position))
+        q = self._cell_queue
+        for position, (session, m, client_id) in enumerate(q.queued(), 1):
+            session.queued(position, q.wait(position), client_id)
+
+    def pool_hit_rate(self):
+        """
+        Returns the fraction of get_worker calls that found an idle worker.
+        """
+        hits = self.stats.get('pool_hits')
+        total = hits + self.stats.get('pool_misses')
+        return float(hits) / total if total else 1.0
+
+    def capacity(self):
+        """
+        Returns a dict of what the node has room for: its ``name``, its
+        ``sessions``, its ``idle_workers`` and ``workers`` in all, the
+        sessions ``waiting`` for a worker, the ``queued_cells``, the 1
+        minute ``load`` average, ``cpus`` and ``free_ram`` in bytes.
+        """
+        return {
+            'name': self.config.get('exc_node_name'),
+            'sessions': len(self.sessions),
+            'idle_workers': len(self._idle),
+            'workers': (len(self._idle) + len(self._starting)
+                        + len(self._assigned)),
+            'waiting': len(self._worker_queue),
+            'queued_cells': len(self._cell_queue),
+            'load': load_average(),
+            'cpus': cpu_count(),
+            'free_ram': free_ram(),
+        }
+
+    def coalescing_ratio(self):
+        """
+        Returns the messages sent to clients per message written, which is
+        over 1 when held back output has been merged.
+        """
+        frames = self.stats.get('send_frames')
+        return float(self.stats.get('send_msgs')) / frames if frames else 1.0
+
+    def _assign_workers(self):
+        """
+        Tries to service any get_worker calls.
+        """
+        while self._idle:
+            # the next session whose turn it is gets the worker using the
+            # least memory
+            entry = self._worker_queue.pop()
+            if entry is None:
+                break
+            session, user, group, waited = entry
+            w = min(self._idle, key=lambda w: w.rss)
+            self._idle.remove(w)
+            self._assigned.add(w)
+            self.stats.observe('get_worker_wait', waited)
+            session.set_worker(w)
+        self._spawn_workers()
+
+    def _resize_pool(self):
+        """
+        Called periodically.  Starts workers ahead of demand, and stops idle
+        workers the pool has had too many of for a while, the biggest first.
+        """
+        for w in list(self._idle):
+            reason = self._recycle.reason(w)
+            if reason is not None:
+                self._note_recycle(w, reason)
+                self.recycle_worker(w)
+        self._spawn_workers()
+        n = self._pool.to_reap(len(self._idle))
+        for w in sorted(self._idle, key=lambda w: -w.rss)[:n]:
+            log.msg("reaping idle worker %s" % (w.pid,))
+            self._idle.remove(w)
+            self.stats.incr('workers_reaped')
+            w.stop()
+
+    def worker_computing(self, w, force=False):
+        """
+        Called when a worker is spawned, or starts or stops computing.  With
+        ``exc_cpu_affinity`` set, moves it to the CPUs it should run on now
+        (see :class:`affinity.CpuPlanner`).
+        """
+        if self._cpus is None:
+            return
+        changes = self._cpus.update(w, w.computing,
+                                    cores=None if w.parallel else 1)
+        for other, cpus in changes:
+            self._set_cpus(other, cpus, force and other is w)
+
+    def _set_cpus(self, w, cpus, force=False):
+        if w.closed or w.pid is None or (cpus == w.cpus and not force):
+            return
+        w.cpus = cpus
+        if set_affinity(w.pid, cpus):
+            self.stats.incr('affinity_changes')
+        else:
+            self.stats.incr('affinity_errors')
+
+    def worker_memory(self, w):
+        """
+        Called when a worker reports a new memory level.  Idle workers that
+        are approaching their limit are replaced with fresh ones; workers over
+        their limit are replaced as soon as they aren't computing.
+        """
+        log.msg("worker %s: rss %d level %s" % (w.pid, w.rss, w.mem_level))
+        if w.mem_level == 'OK':
+            return
+        if w in self._idle or (w.mem_level == 'BREACH' and not w.computing):
+            self.recycle_worker(w)
+
+    def worker_settled(self, w, sid):
+        """
+        Called when the last cell running in a session worker is done.  If
+        the worker is due to be replaced, the client is told and the
+        namespace is hibernated, to be restored into a fresh worker with the
+        next cell.
+        """
+        if w._client is None or w.hibernating:
+            return
+        reason = self._recycle.reason(w)
+        if reason is None:
+            return
+        self._note_recycle(w, reason)
+        w._client.msg_send(msg.Notice('RECYCLE',
+                "Replacing the worker (%s), your variables are kept."
+                % (_RECYCLE_REASONS[reason],)), w.router.client_id(sid))
+        self._hibernate(w)
+
+    def _note_recycle(self, w, reason):
+        log.msg("recycling worker %s: %s, %d cells, %.0fs old, rss %d" % (
+                w.pid, reason, w.cells_run, _time() - w.started, w.rss))
+        self.stats.incr('recycled_' + reason.lower())
+        self.stats.incr('recycled_rss_bytes', w.rss)
+        self.stats.observe('recycled_rss', w.rss)
+        self.stats.observe('recycled_cells', w.cells_run)
+
+    def recycle_worker(self, w):
+        """
+        Kills w and spawns a replacement.
+        """
+        log.msg("recycling worker %s (rss %d)" % (w.pid, w.rss))
+        if w in self._idle:
+            self._idle.remove(w)
+        self._assigned.discard(w)
+        if w._client is not None:
+            w._client.worker_lost(w)
+        w.stop()
+        self._spawn_workers()
+
+    def _hibernate_idle(self):
+        """
+        Called periodically.  Tells session workers that have been idle for
+        longer than ``exc_hibernate_after`` seconds to hibernate.
+        """
+        now = _time()
+        idle_after = self.config['exc_hibernate_after']
+        for w in self._assigned:
+            if (w._client is None or w.computing or w.hibernating
+                    or now - w.last_active < idle_after):
+                continue
+            self._hibernate(w)
+
+    def _hibernate(self, w):
+        """
+        Tells w to save its namespace and exit.
+        """
+        name = '%d-%s.hib' % (w.pid, os.urandom(6).encode('hex'))
+        path = os.path.join(self._hibernate_dir, name)
+        w.hibernating = True
+        w.msg_send(msg.Hibernate(path))
+
+    def worker_hibernated(self, w, m):
+        """
+        Called when a worker has written its namespace to disk.  The worker
+        exits by itself.
+        """
+        log.msg("worker %s hibernated to %s (%d bytes, %.3fs)" % (
+                w.pid, m['path'], m['nbytes'], m['seconds']))
+        self._assigned.discard(w)
+        self._hibernated[m['path']] = m['nbytes']
+        self.stats.incr('hibernated')
+        self.stats.incr('hibernated_bytes', m['nbytes'])
+        self.stats.observe('hibernate_seconds', m['seconds'])
+        self.stats.observe('hibernate_nbytes', m['nbytes'])
+        client = w._client
+        w.set_client(None)
+        if client is not None:
+            client.hibernated(w, m['path'])
+        else:
+            self.discard_hibernated(m['path'])
+
+    def worker_restored(self, w, m):
+        """
+        Called when a worker has loaded a hibernated namespace.
+        """
+        if m['errors']:
+            log.msg("worker %s restore errors: %r" % (w.pid, m['errors']))
+        self.stats.incr('restored')
+        self.stats.observe('restore_seconds', m['seconds'])
+        self.discard_hibernated(m['path'])
+
+    def discard_hibernated(self, path):
+        """
+        Deletes a hibernated namespace that's been restored or whose client is
+        gone.
+        """
+        nbytes = self._hibernated.pop(path, 0)
+        self.stats.incr('hibernated_bytes', -nbytes)
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    config = dict(DEFAULT_CONFIG)
+    if argv:
+        config['ws_port'] = int(argv[0])
+    if len(argv) > 1:
+        config['exc_node_name'] = argv[1]
+    log.startLogging(sys.stdout)
+    s = WorkerService(config)
+    s.startService()
+    reactor.addSystemEventTrigger('before', 'shutdown', s.stopService)
+    reactor.listenTCP(config['ws_port'], WebSocketFactory(s))
+    reactor.run()
+
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    import doctest
+    doctest.testmod()
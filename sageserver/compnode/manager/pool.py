@@ -0,0 +1,123 @@
+"""
+Sizing of the pool of idle workers.
+"""
+
+from math import ceil, exp
+from time import time as _time
+
+
+class AdaptivePool(object):
+    """
+    Decides how many idle workers the manager keeps, from how often workers
+    are asked for and how long a worker takes to start.
+
+    Enough workers are kept to cover the requests expected while a new one
+    starts, times ``headroom``, between ``min_idle`` and ``max_idle``.  A
+    shortage is made up at once, but idle workers are only reaped once
+    there have been more than the target for ``reap_after`` seconds, so a
+    lull between two bursts doesn't throw away warm workers.
+
+    The arrival rate decays exponentially with a time constant of ``tau``
+    seconds, and the start time is a moving average.
+
+    EXAMPLES::
+
+        >>> now = [0.0]
+        >>> pool = AdaptivePool(min_idle=1, max_idle=8, spawn_seconds=2.0,
+        ...                     reap_after=60, clock=lambda: now[0])
+        >>> pool.target()
+        1
+        >>> for i in range(60):         # a burst of a request a second
+        ...     now[0] += 1
+        ...     pool.arrival()
+        >>> round(pool.rate(), 2), pool.target()
+        (0.64, 3)
+        >>> pool.to_spawn(n_idle=1, n_starting=0, n_waiting=1)
+        3
+        >>> now[0] += 300               # quiet again
+        >>> pool.target(), pool.to_reap(3)
+        (1, 0)
+        >>> now[0] += 60
+        >>> pool.to_reap(3)
+        2
+    """
+
+    def __init__(self, min_idle=1, max_idle=16, headroom=2.0, tau=60.0,
+                 reap_after=120.0, spawn_seconds=1.0, clock=_time):
+        """
+        :param min_idle: idle workers kept however quiet it is.
+        :param max_idle: idle workers kept however busy it is.
+        :param headroom: how many times the expected requests to keep.
+        :param tau: seconds over which the arrival rate is averaged.
+        :param reap_after: seconds there must have been too many idle
+            workers before some are reaped.
+        :param spawn_seconds: the start time assumed before any worker has
+            started.
+        :param clock: returns the time in seconds.
+        """
+        self.min_idle = min_idle
+        self.max_idle = max_idle
+        self.headroom = headroom
+        self.tau = tau
+        self.reap_after = reap_after
+        self.spawn_seconds = spawn_seconds
+        self._clock = clock
+        self._rate = 0.0
+        self._rate_at = clock()
+        self._excess_since = None
+
+    def arrival(self):
+        """
+        Records a request for a worker.
+        """
+        self._rate = self.rate() + 1.0 / self.tau
+
+    def rate(self):
+        """
+        Returns the requests a second.
+        """
+        now = self._clock()
+        self._rate *= exp(-(now - self._rate_at) / self.tau)
+        self._rate_at = now
+        return self._rate
+
+    def spawned(self, seconds):
+        """
+        Records how long a worker took to start.
+        """
+        self.spawn_seconds += 0.2 * (seconds - self.spawn_seconds)
+
+    def target(self):
+        """
+        Returns how many idle workers to keep.
+        """
+        n = int(ceil(self.rate() * self.spawn_seconds * self.headroom))
+        return max(self.min_idle, min(self.max_idle, n))
+
+    def to_spawn(self, n_idle, n_starting, n_waiting=0):
+        """
+        Returns how many workers to start now, given how many are idle, how
+        many are starting and how many requests are waiting for one.
+        """
+        return max(0, self.target() + n_waiting - n_idle - n_starting)
+
+    def to_reap(self, n_idle):
+        """
+        Returns how many idle workers to stop now.
+        """
+        excess = n_idle - self.target()
+        if excess <= 0:
+            self._excess_since = None
+            return 0
+        now = self._clock()
+        if self._excess_since is None:
+            self._excess_since = now
+        if now - self._excess_since < self.reap_after:
+            return 0
+        self._excess_since = None
+        return excess
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,62 @@
+"""
+When to replace long-lived workers.
+"""
+
+from time import time as _time
+
+
+class RecyclePolicy(object):
+    """
+    Workers get slower as they run cells: heaps fragment and modules leak
+    state.  A worker is replaced once it has run ``max_cells`` cells, is
+    ``max_age`` seconds old, or last reported an RSS over ``max_rss``.
+    Limits that are None aren't checked.
+
+    EXAMPLES::
+
+        >>> class W(object):
+        ...     cells_run, started, rss = 0, 0.0, 10
+        >>> w = W()
+        >>> policy = RecyclePolicy(max_cells=100, max_age=3600, max_rss=1000)
+        >>> policy.reason(w, now=60) is None
+        True
+        >>> w.cells_run = 100
+        >>> policy.reason(w, now=60)
+        'CELLS'
+        >>> policy.reason(W(), now=7200)
+        'AGE'
+        >>> w = W(); w.rss = 2000; policy.reason(w, now=60)
+        'RSS'
+        >>> RecyclePolicy().reason(w) is None
+        True
+    """
+
+    def __init__(self, max_cells=None, max_age=None, max_rss=None):
+        """
+        :param max_cells: cells a worker may run.
+        :param max_age: seconds a worker may live.
+        :param max_rss: resident set size in bytes.
+        """
+        self.max_cells = max_cells
+        self.max_age = max_age
+        self.max_rss = max_rss
+
+    def reason(self, w, now=None):
+        """
+        Returns why w should be replaced, ``'CELLS'``, ``'AGE'`` or
+        ``'RSS'``, or None if it shouldn't.
+        """
+        if self.max_cells is not None and w.cells_run >= self.max_cells:
+            return 'CELLS'
+        if now is None:
+            now = _time()
+        if self.max_age is not None and now - w.started >= self.max_age:
+            return 'AGE'
+        if self.max_rss is not None and w.rss > self.max_rss:
+            return 'RSS'
+        return None
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,150 @@
+"""
+Output kept for clients that reconnect.
+"""
+
+import os
+from collections import deque
+from tempfile import mkstemp
+
+
+class ReplayRing(object):
+    """
+    The last messages sent to a client, numbered from 1, so that a client
+    that reconnects can be sent what it missed.
+
+    The newest ``memory`` bytes are kept in memory.  Older messages are
+    spilled to files in ``spill_dir``, ``segment`` bytes a file, and the
+    oldest files are deleted to keep under ``disk`` bytes.  Without a
+    ``spill_dir`` older messages are dropped.
+
+    EXAMPLES::
+
+        >>> import tempfile, shutil
+        >>> d = tempfile.mkdtemp()
+        >>> r = ReplayRing(memory=10, disk=20, spill_dir=d, segment=10)
+        >>> [r.append('msg %d' % i, i == 2) for i in range(1, 7)]
+        [1, 2, 3, 4, 5, 6]
+        >>> r.nbytes, r.disk_bytes, len(os.listdir(d))
+        (10, 20, 2)
+        >>> r.replay(4)
+        [('msg 5', False), ('msg 6', False)]
+        >>> r.replay(1)
+        [('msg 2', True), ('msg 3', False), ('msg 4', False), ('msg 5', False), ('msg 6', False)]
+        >>> r.replay(6), r.first_seq
+        ([], 1)
+        >>> r.append('msg 7', False)      # the file of 1 and 2 goes
+        7
+        >>> r.replay(1) is None, r.first_seq
+        (True, 3)
+        >>> r.close()
+        >>> os.listdir(d)
+        []
+        >>> shutil.rmtree(d)
+
+    Without somewhere to spill to::
+
+        >>> r = ReplayRing(memory=10)
+        >>> [r.append('msg %d' % i, False) for i in range(1, 4)]
+        [1, 2, 3]
+        >>> r.first_seq, r.replay(2)
+        (2, [('msg 3', False)])
+    """
+
+    def __init__(self, memory=1024 * 1024, disk=0, spill_dir=None,
+                 segment=1024 * 1024):
+        """
+        :param memory: bytes of messages kept in memory.
+        :param disk: bytes of messages kept in spill files.
+        :param spill_dir: where spill files go.
+        :param segment: bytes in a spill file before the next is started.
+        """
+        self.memory = memory
+        self.disk = disk
+        self.spill_dir = spill_dir
+        self.segment = segment
+        self.seq = 0 # of the last message
+        self.nbytes = 0
+        self.disk_bytes = 0
+        self._mem = deque() # (seq, data, binary)
+        # [path, file, [(seq, offset, length, binary)], bytes], oldest first
+        self._segments = deque()
+
+    @property
+    def first_seq(self):
+        """
+        The number of the oldest message kept.
+        """
+        if self._segments:
+            return self._segments[0][2][0][0]
+        if self._mem:
+            return self._mem[0][0]
+        return self.seq + 1
+
+    def append(self, data, binary):
+        """
+        Keeps a message.  Returns its number.
+        """
+        self.seq += 1
+        self._mem.append((self.seq, data, binary))
+        self.nbytes += len(data)
+        while self.nbytes > self.memory and len(self._mem) > 1:
+            seq, old, old_binary = self._mem.popleft()
+            self.nbytes -= len(old)
+            if self.spill_dir is not None and self.disk > 0:
+                self._spill(seq, old, old_binary)
+        return self.seq
+
+    def _spill(self, seq, data, binary):
+        segs = self._segments
+        if not segs or segs[-1][3] >= self.segment:
+            fd, path = mkstemp(prefix='replay-', dir=self.spill_dir)
+            segs.append([path, os.fdopen(fd, 'w+b'), [], 0])
+        seg = segs[-1]
+        f = seg[1]
+        f.seek(0, 2)
+        seg[2].append((seq, f.tell(), len(data), binary))
+        f.write(data)
+        seg[3] += len(data)
+        self.disk_bytes += len(data)
+        while self.disk_bytes > self.disk and len(segs) > 1:
+            self._drop_segment()
+
+    def _drop_segment(self):
+        path, f, entries, nbytes = self._segments.popleft()
+        f.close()
+        os.unlink(path)
+        self.disk_bytes -= nbytes
+
+    def replay(self, after):
+        """
+        Returns a list of ``(data, binary)`` of the messages numbered after
+        after, or None if some of them aren't kept any more.
+        """
+        if after + 1 < self.first_seq:
+            return None
+        out = []
+        for path, f, entries, nbytes in self._segments:
+            if entries[-1][0] <= after:
+                continue
+            f.flush()
+            for seq, offset, length, binary in entries:
+                if seq > after:
+                    f.seek(offset)
+                    out.append((f.read(length), binary))
+        out.extend((data, binary) for seq, data, binary in self._mem
+                   if seq > after)
+        return out
+
+    def close(self):
+        """
+        Forgets the messages and deletes the spill files.
+        """
+        while self._segments:
+            self._drop_segment()
+        self._mem.clear()
+        self.nbytes = 0
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,99 @@
+"""
+Routing of messages between clients and a worker by stream id.
+"""
+
+from sageserver.msg.hdr import HDRF_SCLOSE
+
+
+class RouterFull(Exception):
+    """
+    Raised when all the stream ids of a worker are in use.
+    """
+
+
+class Router(object):
+    """
+    The streams open on one worker's pipe.
+
+    Clients pick their own ids for requests, which needn't fit in the 16
+    bits of a header's sid or be unique across clients.  Each request sent
+    to the worker is given a free sid, and messages from the worker are
+    routed back to ``(client, client id)`` by their sid.  A stream is
+    closed by a message with the sclose flag (a Done, Skipped or the reply
+    to a one-off request).
+
+    Sid 0 isn't routed: the manager uses it for its own requests, and the
+    worker for messages such as MemoryUsage.
+
+    EXAMPLES::
+
+        >>> r = Router(max_sid=3)
+        >>> r.open('a', 100), r.open('a', 101), r.open('b', 100)
+        (1, 2, 3)
+        >>> r.open('b', 101)
+        Traceback (most recent call last):
+            ...
+        RouterFull: no free stream ids
+        >>> r.route(2, 0)
+        ('a', 101)
+        >>> r.route(2, HDRF_SCLOSE)     # closes the stream
+        ('a', 101)
+        >>> r.route(2, 0) is None
+        True
+        >>> r.open('c', 7)
+        2
+        >>> r.close_client('a'), len(r)
+        ([100], 2)
+    """
+
+    def __init__(self, max_sid=0xffff):
+        self.max_sid = max_sid
+        self._routes = {} # sid -> (client, client id)
+        self._next = 1
+
+    def __len__(self):
+        return len(self._routes)
+
+    def open(self, client, client_id):
+        """
+        Returns a free sid for a request from client.
+        """
+        routes = self._routes
+        if len(routes) >= self.max_sid:
+            raise RouterFull("no free stream ids")
+        sid = self._next
+        while sid in routes:
+            sid = sid % self.max_sid + 1
+        self._next = sid % self.max_sid + 1
+        routes[sid] = (client, client_id)
+        return sid
+
+    def route(self, sid, flags=0):
+        """
+        Returns the ``(client, client id)`` of sid, or None if it isn't
+        open.  Closes the stream if flags has :data:`HDRF_SCLOSE`.
+        """
+        if flags & HDRF_SCLOSE:
+            return self._routes.pop(sid, None)
+        return self._routes.get(sid)
+
+    def client_id(self, sid):
+        """
+        Returns the client id of an open sid, or None.
+        """
+        r = self._routes.get(sid)
+        return r and r[1]
+
+    def close_client(self, client):
+        """
+        Closes the streams of client.  Returns the client ids that were
+        open.
+        """
+        sids = [sid for sid, (c, _) in self._routes.iteritems()
+                if c is client]
+        return [self._routes.pop(sid)[1] for sid in sids]
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
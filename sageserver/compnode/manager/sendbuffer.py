@@ -0,0 +1,112 @@
+"""
+Output held back from a client that isn't keeping up.
+"""
+
+from collections import deque
+
+import sageserver.msg as msg
+from sageserver.msg.decodedmsg import DecodedMsg
+from sageserver.msg.hdr import HDR_LEN
+
+# output that's merged with the one before it for the same request
+_MERGED = {msg.STDOUT: msg.Stdout, msg.STDERR: msg.Stderr}
+
+
+class SendBuffer(object):
+    """
+    Messages waiting for a client's connection to drain.
+
+    A Stdout (or Stderr) pushed right after another for the same request is
+    merged into it, up to ``merge_max`` bytes, so a backlog goes out as a
+    few big messages rather than many small ones.  The manager stops reading
+    from the worker when more than ``high`` bytes are held, and starts again
+    once there are ``low`` or fewer.
+
+    EXAMPLES::
+
+        >>> b = SendBuffer(high=1000, low=100, merge_max=120)
+        >>> for s in ['a\\n', 'b\\n', 'c\\n']:
+        ...     b.push(msg.Stdout(s), 1)
+        >>> b.push(msg.Stdout('d\\n'), 2)
+        >>> b.push(msg.Done(), 1)
+        >>> len(b), b.pushed
+        (3, 5)
+        >>> m, cid = b.pop()
+        >>> m['bytes'], cid
+        ('a\\nb\\nc\\n', 1)
+        >>> [(m.type, cid) for m, cid in [b.pop(), b.pop()]]
+        [(1, 2), (99, 1)]
+        >>> b.nbytes, b.popped
+        (0, 3)
+        >>> b.push(msg.Stdout('x' * 50), 1)
+        >>> b.push(msg.Stdout('y' * 50), 1)   # would be over merge_max
+        >>> len(b)
+        2
+    """
+
+    def __init__(self, high=1024 * 1024, low=256 * 1024, merge_max=65536):
+        """
+        :param high: bytes held when the worker is paused.
+        :param low: bytes held when it's resumed.
+        :param merge_max: the largest output a merge makes, in bytes.
+        """
+        self.high = high
+        self.low = low
+        self.merge_max = merge_max
+        self.nbytes = 0
+        self.pushed = 0 # messages pushed
+        self.popped = 0 # messages popped, after merging
+        # [message, client id, merged bytes or None, size]
+        self._q = deque()
+
+    def __len__(self):
+        return len(self._q)
+
+    def push(self, m, client_id):
+        """
+        Holds back m for client_id.
+        """
+        self.pushed += 1
+        size = _size(m)
+        self.nbytes += size
+        q = self._q
+        if m.type in _MERGED and q:
+            last = q[-1]
+            if (last[0].type == m.type and last[1] == client_id
+                    and last[3] + size <= self.merge_max):
+                if last[2] is None:
+                    last[2] = [last[0]['bytes']]
+                last[2].append(m['bytes'])
+                last[3] += size
+                return
+        q.append([m, client_id, None, size])
+
+    def pop(self):
+        """
+        Returns the oldest ``(message, client id)``.
+        """
+        m, client_id, merged, size = self._q.popleft()
+        self.nbytes -= size
+        self.popped += 1
+        if merged is not None:
+            m = _MERGED[m.type](''.join(merged))
+        return m, client_id
+
+    def clear(self):
+        self._q.clear()
+        self.nbytes = 0
+
+
+def _size(m):
+    """
+    Returns the encoded size of m.
+    """
+    if isinstance(m, DecodedMsg):
+        return HDR_LEN + m.hdr.length
+    # made by the manager, these are few
+    return len(m.encode())
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,79 @@
+"""
+Counters and timings kept by the manager.
+"""
+
+from collections import deque
+
+
+class Stats(object):
+    """
+    Named counters (which can also be used as gauges by incrementing by a
+    negative amount) and observed values such as timings or sizes.  Only the
+    last ``n_samples`` values of each observation are kept for percentiles.
+
+    EXAMPLES::
+
+        >>> s = Stats()
+        >>> s.incr('hibernated')
+        >>> for v in [0.3, 0.1, 0.2]:
+        ...     s.observe('hibernate_seconds', v)
+        >>> snap = s.snapshot()
+        >>> snap['hibernated']
+        1
+        >>> t = snap['hibernate_seconds']
+        >>> (t['count'], t['max'], t['p50'])
+        (3, 0.3, 0.2)
+        >>> s.get('restored')
+        0
+    """
+
+    def __init__(self, n_samples=1000):
+        self._n_samples = n_samples
+        self._counters = {}
+        self._observed = {} # name -> [count, total, max, samples]
+
+    def incr(self, name, n=1):
+        self._counters[name] = self._counters.get(name, 0) + n
+
+    def get(self, name):
+        """
+        Returns the value of a counter.
+        """
+        return self._counters.get(name, 0)
+
+    def observe(self, name, value):
+        o = self._observed.get(name)
+        if o is None:
+            o = self._observed[name] = [0, 0, value,
+                                        deque(maxlen=self._n_samples)]
+        o[0] += 1
+        o[1] += value
+        o[2] = max(o[2], value)
+        o[3].append(value)
+
+    def snapshot(self):
+        """
+        Returns a dict of the counters and, for each observation, a dict of
+        its ``count``, ``mean``, ``max``, ``p50`` and ``p99``.
+        """
+        snap = dict(self._counters)
+        for name, (count, total, max_, samples) in self._observed.iteritems():
+            samples = sorted(samples)
+            snap[name] = {
+                'count': count,
+                'mean': float(total) / count,
+                'max': max_,
+                'p50': _percentile(samples, 0.50),
+                'p99': _percentile(samples, 0.99),
+            }
+        return snap
+
+
+def _percentile(sorted_samples, p):
+    return sorted_samples[min(len(sorted_samples) - 1,
+                              int(p * len(sorted_samples)))]
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
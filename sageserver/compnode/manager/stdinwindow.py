@@ -0,0 +1,98 @@
+"""
+Flow control of Stdin from a client to its worker.
+"""
+
+from collections import deque
+
+
+class StdinWindow(object):
+    """
+    Stdin a client sent that's on its way to the running cell.
+
+    A cell's reads grant credit with the ``window`` of their
+    :class:`msg.NeedStdin` messages (see :class:`queuefile.QueueFileIn`).
+    Stdin is passed on as long as there's credit and held back otherwise, so
+    a big paste is streamed to the worker as it reads it instead of one
+    client round trip per read.  A NeedStdin only needs to reach the client
+    when a read is blocked and there's nothing held back for it.
+
+    Workers that grant no window get Stdin as soon as it arrives.
+
+    EXAMPLES::
+
+        >>> w = StdinWindow()
+        >>> w.need(-1, 8)           # blocked, nothing to send: ask the client
+        ([], True)
+        >>> w.push('line 1\\nline 2\\n')
+        ['line 1\\nl']
+        >>> w.push('')              # EOF is held back behind the rest
+        []
+        >>> w.need(0, 8)            # half the window was read
+        (['ine 2\\n', ''], False)
+        >>> w.reset()
+        >>> w.need(5, 0)            # a worker without read-ahead
+        ([], True)
+        >>> w.push('abc')
+        ['abc']
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the credit and what's held back.  Called when a cell is
+        done, since the next one starts without a window.
+        """
+        self.credit = 0
+        self.metered = None # unknown until the cell's first NeedStdin
+        self._pending = deque()
+
+    def push(self, bytes):
+        """
+        Holds back Stdin from the client.  Returns a list of the bytes to
+        send to the worker now.
+        """
+        self._pending.append(bytes)
+        return self._take()
+
+    def need(self, nbytes, window):
+        """
+        Handles a NeedStdin from the worker.  Returns ``(to_send, relay)``,
+        the bytes to send to the worker now and whether to pass the
+        NeedStdin on to the client.
+        """
+        if self.metered is None and nbytes:
+            self.metered = window > 0
+        self.credit += window
+        to_send = self._take()
+        return to_send, bool(nbytes) and not to_send
+
+    def _take(self):
+        pending = self._pending
+        if not self.metered:
+            to_send = list(pending)
+            pending.clear()
+            return to_send
+        to_send = []
+        while pending:
+            bytes = pending[0]
+            if not bytes:
+                # EOF doesn't use any credit
+                to_send.append(pending.popleft())
+                continue
+            if self.credit <= 0:
+                break
+            if len(bytes) > self.credit:
+                to_send.append(bytes[:self.credit])
+                pending[0] = bytes[self.credit:]
+                self.credit = 0
+                break
+            to_send.append(pending.popleft())
+            self.credit -= len(bytes)
+        return to_send
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,370 @@
+"""
+A minimal WebSocket (RFC 6455) server protocol for Twisted.
+
+Only what the manager needs is implemented: the opening handshake, text and
+binary messages (fragmented or not), ping/pong and the closing handshake.
+A subprotocol is chosen from :attr:`WebSocketProtocol.subprotocols`;
+extensions aren't negotiated.  A plain GET can be answered too, see
+:meth:`WebSocketProtocol.plainRequest`.
+"""
+
+from base64 import b64encode
+from binascii import hexlify, unhexlify
+from hashlib import sha1
+from struct import pack, unpack, unpack_from
+
+from twisted.internet import protocol
+
+from sageserver.util import JoinBuffer
+
+_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+CLOSE_NORMAL = 1000
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_TOO_BIG = 1009
+
+_MAX_HANDSHAKE = 8192
+_MAX_HEADER = 14 # with a 64 bit length and a masking key
+_MAX_CONTROL = 125 # payload bytes of a control frame
+
+
+def accept_key(key):
+    """
+    Returns the ``Sec-WebSocket-Accept`` for a ``Sec-WebSocket-Key``.
+
+    EXAMPLES::
+
+        >>> accept_key('dGhlIHNhbXBsZSBub25jZQ==')    # from RFC 6455
+        's3pPLMBiTxaQ9kYGzzhZRbK+xOo='
+    """
+    return b64encode(sha1(key + _GUID).digest())
+
+
+def mask(data, key):
+    """
+    Returns data XORed with the 4 byte key repeated, which both masks and
+    unmasks.  The XOR is done on one long integer rather than a byte at a
+    time.
+
+    EXAMPLES::
+
+        >>> m = mask('Hello', '\\x37\\xfa\\x21\\x3d')   # from RFC 6455
+        >>> m == '\\x7f\\x9f\\x4d\\x51\\x58'
+        True
+        >>> mask(m, '\\x37\\xfa\\x21\\x3d')
+        'Hello'
+        >>> mask('\\x00\\x00', 'abcd'), mask('', 'abcd')
+        ('ab', '')
+    """
+    n = len(data)
+    if not n:
+        return ''
+    key = (key * (n // 4 + 1))[:n]
+    x = int(hexlify(data), 16) ^ int(hexlify(key), 16)
+    return unhexlify('%0*x' % (2 * n, x))
+
+
+def encode_frame(opcode, payload, fin=True):
+    """
+    Returns a server (unmasked) frame.
+
+    EXAMPLES::
+
+        >>> encode_frame(OP_TEXT, 'Hello')
+        '\\x81\\x05Hello'
+        >>> len(encode_frame(OP_BINARY, 'x' * 300)), len(encode_frame(
+        ...     OP_BINARY, 'x' * 70000))
+        (304, 70010)
+    """
+    b0 = (0x80 if fin else 0) | opcode
+    n = len(payload)
+    if n < 126:
+        hdr = pack('!BB', b0, n)
+    elif n < 65536:
+        hdr = pack('!BBH', b0, 126, n)
+    else:
+        hdr = pack('!BBQ', b0, 127, n)
+    return hdr + payload
+
+
+def decode_header(data, offset=0):
+    """
+    Returns ``(fin, opcode, payload length, masking key, payload offset)``
+    for the frame header at offset in data, or None if it isn't all there
+    yet.  The key is None for an unmasked (server) frame.
+
+    EXAMPLES::
+
+        >>> decode_header('\\x81\\x85\\x37\\xfa\\x21\\x3d')
+        (True, 1, 5, '7\\xfa!=', 6)
+        >>> decode_header('\\x02\\x7f' + '\\x00' * 4 + '\\x01' + '\\x00' * 3)
+        (False, 2, 16777216, None, 10)
+        >>> decode_header('\\x81\\xfe\\x01') is None
+        True
+    """
+    avail = len(data) - offset
+    if avail < 2:
+        return None
+    b0, b1 = unpack_from('!BB', data, offset)
+    n = b1 & 0x7f
+    pos = offset + 2
+    if n == 126:
+        if avail < 4:
+            return None
+        n, = unpack_from('!H', data, pos)
+        pos += 2
+    elif n == 127:
+        if avail < 10:
+            return None
+        n, = unpack_from('!Q', data, pos)
+        pos += 8
+    key = None
+    if b1 & 0x80:
+        if len(data) < pos + 4:
+            return None
+        key = data[pos:pos + 4]
+        pos += 4
+    return bool(b0 & 0x80), b0 & 0x0f, n, key, pos
+
+
+def decode_frame(data, offset=0):
+    """
+    Returns ``(fin, opcode, payload, next offset)`` for the frame at offset
+    in data, or None if it isn't all there yet.  A masked payload is
+    returned unmasked.
+
+    EXAMPLES::
+
+        >>> f = '\\x81\\x85\\x37\\xfa\\x21\\x3d\\x7f\\x9f\\x4d\\x51\\x58'
+        >>> decode_frame(f)
+        (True, 1, 'Hello', 11)
+        >>> decode_frame(f[:8]) is None
+        True
+    """
+    hdr = decode_header(data, offset)
+    if hdr is None:
+        return None
+    fin, opcode, n, key, pos = hdr
+    end = pos + n
+    if len(data) < end:
+        return None
+    payload = data[pos:end]
+    if key is not None:
+        payload = mask(payload, key)
+    return fin, opcode, payload, end
+
+
+class WebSocketProtocol(protocol.Protocol):
+    """
+    A server side WebSocket connection.  Subclasses override
+    :meth:`messageReceived` and send with :meth:`sendMessage`.
+    """
+
+    max_message_size = 16 * 1024 * 1024
+    # the subprotocols the server speaks, in order of preference
+    subprotocols = ()
+
+    def __init__(self):
+        self._buf = '' # the handshake, until it's answered
+        self._in = JoinBuffer() # then what's received of the frames
+        # bytes of the next frame popped off _in: its header, until that's
+        # decoded, and then the start of its payload
+        self._head = ''
+        self._header = None # decode_header() of the frame being received
+        self._open = False
+        self._frags = [] # payloads of a fragmented message
+        self._frag_binary = False
+        self._frag_len = 0
+        self.headers = {}
+        self.path = None
+        self.subprotocol = None # the one chosen in the handshake
+
+    def dataReceived(self, data):
+        if not self._open:
+            # at most _MAX_HANDSHAKE bytes are joined
+            self._buf += data
+            if not self._handshake():
+                return
+            data, self._buf = self._buf, ''
+        self._in.extend(data)
+        self._process_frames()
+
+    def _handshake(self):
+        """
+        Answers the opening handshake once it's all been received.  Returns
+        True if the connection is open.
+        """
+        end = self._buf.find('\r\n\r\n')
+        if end < 0:
+            if len(self._buf) > _MAX_HANDSHAKE:
+                self.transport.loseConnection()
+            return False
+        lines = self._buf[:end].split('\r\n')
+        self._buf = self._buf[end + 4:]
+        try:
+            method, self.path, _ = lines[0].split(' ', 2)
+        except ValueError:
+            method = None
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            self.headers[name.strip().lower()] = value.strip()
+        key = self.headers.get('sec-websocket-key')
+        if (method == 'GET' and key is None
+                and 'upgrade' not in self.headers):
+            self._answer(self.plainRequest(self.path))
+            return False
+        if (method != 'GET' or key is None
+                or 'websocket' not in self.headers.get('upgrade', '').lower()):
+            self.transport.write('HTTP/1.1 400 Bad Request\r\n'
+                                 'Content-Length: 0\r\n\r\n')
+            self.transport.loseConnection()
+            return False
+        offered = [p.strip() for p in self.headers.get(
+                'sec-websocket-protocol', '').split(',')]
+        extra = ''
+        for p in self.subprotocols:
+            if p in offered:
+                self.subprotocol = p
+                extra = 'Sec-WebSocket-Protocol: %s\r\n' % (p,)
+                break
+        self.transport.write('HTTP/1.1 101 Switching Protocols\r\n'
+                             'Upgrade: websocket\r\n'
+                             'Connection: Upgrade\r\n'
+                             'Sec-WebSocket-Accept: %s\r\n%s\r\n'
+                             % (accept_key(key), extra))
+        self._open = True
+        self.connectionOpened()
+        return True
+
+    def _answer(self, reply):
+        if reply is None:
+            self.transport.write('HTTP/1.1 404 Not Found\r\n'
+                                 'Content-Length: 0\r\n\r\n')
+        else:
+            content_type, body = reply
+            self.transport.write('HTTP/1.1 200 OK\r\n'
+                                 'Content-Type: %s\r\n'
+                                 'Content-Length: %d\r\n'
+                                 'Connection: close\r\n\r\n%s'
+                                 % (content_type, len(body), body))
+        self.transport.loseConnection()
+
+    def _process_frames(self):
+        """
+        Handles the frames received, each payload being joined once it's
+        all there.
+        """
+        buf = self._in
+        while self._open:
+            if self._header is None:
+                take = min(len(buf), _MAX_HEADER - len(self._head))
+                if take:
+                    self._head += buf.popleft(take)
+                hdr = decode_header(self._head)
+                if hdr is None:
+                    break
+                error = self._check_header(*hdr[:4])
+                if error is not None:
+                    return self.close(error)
+                self._header = hdr
+                self._head = self._head[hdr[4]:]
+            fin, opcode, n, key, _ = self._header
+            if len(self._head) >= n:
+                payload, self._head = self._head[:n], self._head[n:]
+            else:
+                rest = buf.popleft(n - len(self._head))
+                if rest is None:
+                    break
+                payload, self._head = self._head + rest, ''
+            self._header = None
+            self._frame(fin, opcode, mask(payload, key))
+
+    def _check_header(self, fin, opcode, n, key):
+        """
+        Returns the close code for a frame that's refused, before its payload
+        is buffered, or None.
+        """
+        if key is None:
+            # clients must mask what they send
+            return CLOSE_PROTOCOL_ERROR
+        if opcode >= OP_CLOSE:
+            if not fin or n > _MAX_CONTROL:
+                return CLOSE_PROTOCOL_ERROR
+        elif self._frag_len + n > self.max_message_size:
+            return CLOSE_TOO_BIG
+        return None
+
+    def _frame(self, fin, opcode, payload):
+        if opcode >= OP_CLOSE:
+            if opcode == OP_PING:
+                self.transport.write(encode_frame(OP_PONG, payload))
+            elif opcode == OP_CLOSE:
+                if len(payload) == 1:
+                    self.close(CLOSE_PROTOCOL_ERROR)
+                elif payload:
+                    # echo the client's code
+                    self.close(unpack('!H', payload[:2])[0])
+                else:
+                    self.close()
+            return
+        if opcode == OP_CONTINUATION:
+            if not self._frags:
+                return self.close(CLOSE_PROTOCOL_ERROR)
+        elif self._frags:
+            return self.close(CLOSE_PROTOCOL_ERROR)
+        else:
+            self._frag_binary = opcode == OP_BINARY
+        self._frag_len += len(payload)
+        self._frags.append(payload)
+        if fin:
+            data = ''.join(self._frags)
+            self._frags = []
+            self._frag_len = 0
+            self.messageReceived(data, self._frag_binary)
+
+    def sendMessage(self, data, binary=False):
+        """
+        Sends data as one text (UTF-8 ``str``) or binary message.
+        """
+        if self._open:
+            self.transport.write(encode_frame(
+                    OP_BINARY if binary else OP_TEXT, data))
+
+    def close(self, code=CLOSE_NORMAL):
+        """
+        Starts (or answers) the closing handshake and drops the connection.
+        """
+        if self._open:
+            self._open = False
+            self.transport.write(encode_frame(OP_CLOSE, pack('!H', code)))
+        self.transport.loseConnection()
+
+    def connectionOpened(self):
+        """
+        Called when the handshake is done.
+        """
+
+    def plainRequest(self, path):
+        """
+        Called for a GET of path that isn't a WebSocket handshake.  Returns
+        ``(content type, body)`` to answer with, or None for a 404.  The
+        connection is closed after the answer.
+        """
+        return None
+
+    def messageReceived(self, data, binary):
+        """
+        Called with each whole message.
+        """
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
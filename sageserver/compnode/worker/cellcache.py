@@ -0,0 +1,263 @@
+"""
+Memoized cell results.
+
+A cell run with ``%cache=True`` is looked up by :func:`cell_key`, a hash of
+its compiled code and of the globals it reads.  On a hit the names it
+assigned last time are put back and its output is sent again instead of
+running it.
+
+Values of simple immutable types (numbers, strings, and tuples and
+frozensets of them) are hashed by content; anything else by identity.  So a
+cell that reads an object that was mutated in place since (``a.append(1)``)
+gets a stale hit, and cached values are the same objects as the ones the
+cell assigned, not copies.  An entry keeps the objects its key identifies
+by id alive, so the ids can't be reused by new objects while it's cached,
+and it isn't spilled to disk.
+"""
+
+from collections import OrderedDict
+from cPickle import dump, load, HIGHEST_PROTOCOL
+from hashlib import sha1
+import marshal
+import os
+import shutil
+import tempfile
+
+_CONTENT_TYPES = (int, long, float, complex, bool, str, unicode, type(None))
+
+
+def _fingerprint(value):
+    """
+    EXAMPLES::
+
+        >>> _fingerprint((1, 'a')) == _fingerprint((1, 'a'))
+        True
+        >>> a, b = [1], [1]
+        >>> _fingerprint(a) == _fingerprint(b)
+        False
+    """
+    if isinstance(value, _CONTENT_TYPES):
+        return '%s:%r' % (type(value).__name__, value)
+    if isinstance(value, (tuple, frozenset)):
+        items = value if isinstance(value, tuple) else sorted(value)
+        parts = [_fingerprint(v) for v in items]
+        if all(p[0] != '@' for p in parts):
+            return '%s(%s)' % (type(value).__name__, ','.join(parts))
+    return '@%s:%x' % (type(value).__name__, id(value))
+
+
+def cell_key(code, reads, globals_, opts=()):
+    """
+    Returns the cache key of a cell.
+
+    :param code: the compiled code of the cell.
+    :param reads: the global names the cell reads, from
+        :func:`dataflow.global_names`.
+    :param opts: anything else that changes what the cell outputs.
+
+    EXAMPLES::
+
+        >>> code = compile('b = a * 2', 'cell_1.py', 'exec')
+        >>> k1 = cell_key(code, ['a'], {'a': 1})
+        >>> k1 == cell_key(code, ['a'], {'a': 1})
+        True
+        >>> k1 == cell_key(code, ['a'], {'a': 2})
+        False
+    """
+    h = sha1(marshal.dumps(code))
+    for name in sorted(reads):
+        h.update('\0%s=' % (name,))
+        if name in globals_:
+            h.update(_fingerprint(globals_[name]))
+    h.update('\0%r' % (tuple(opts),))
+    return h.hexdigest()
+
+
+def identity_reads(reads, globals_):
+    """
+    Returns the values of reads that :func:`cell_key` hashes by identity.
+
+    EXAMPLES::
+
+        >>> a = [1]
+        >>> identity_reads(['a', 'b', 'c'], {'a': a, 'b': 2}) == [a]
+        True
+    """
+    return [globals_[name] for name in sorted(reads)
+            if name in globals_ and _fingerprint(globals_[name])[0] == '@']
+
+
+class OutputRecorder(object):
+    """
+    Stands in for the send queue of a cell's stdout and stderr, keeping a
+    copy of what it sends.
+    """
+
+    def __init__(self, send_q):
+        self._send_q = send_q
+        self.msgs = []
+
+    def put(self, m):
+        self.msgs.append(m)
+        self._send_q.put(m)
+
+
+class CacheEntry(object):
+
+    def __init__(self, values, outputs, reads=()):
+        """
+        :param values: a dict of the names the cell assigned.
+        :param outputs: the Stdout and Stderr messages the cell sent.
+        :param reads: the values of the entry's key that are hashed by
+            identity, from :func:`identity_reads`.
+        """
+        self.values = values
+        self.outputs = [(type(m), m['bytes']) for m in outputs]
+        self.reads = list(reads)
+
+    def replay(self, globals_, send_q, sid):
+        """
+        Assigns the cached names in globals_ and sends the output again as
+        sid.
+        """
+        globals_.update(self.values)
+        for msg_cls, bytes in self.outputs:
+            send_q.put(msg_cls(bytes, _hsid=sid))
+
+
+class CellCache(object):
+    """
+    An LRU of :class:`CacheEntry` objects.  Entries pushed out of memory are
+    pickled (when ``spill_dir`` is given and they pickle) to a directory of
+    the process's own in ``spill_dir``, which holds up to ``max_spilled`` of
+    them.  It's made readable by the process's user only, on the first
+    spill, and :meth:`close` removes it.  A forked process (a snapshot)
+    starts a directory of its own.
+
+    EXAMPLES::
+
+        >>> import tempfile, shutil
+        >>> d = tempfile.mkdtemp()
+        >>> c = CellCache(max_entries=1, spill_dir=d)
+        >>> c.put('k1', CacheEntry({'a': 1}, []))
+        >>> c.put('k2', CacheEntry({'b': lambda: 2}, []))
+        >>> c.get('k1').values         # read back from spill_dir
+        {'a': 1}
+        >>> c.get('k2') is None        # the lambda couldn't be spilled
+        True
+        >>> c.put('k3', CacheEntry({'c': 3}, [], reads=[[1]]))
+        >>> c.put('k4', CacheEntry({'d': 4}, []))
+        >>> c.get('k3') is None        # its key is only good in memory
+        True
+        >>> [oct(os.stat(os.path.join(d, n)).st_mode & 0777)
+        ...  for n in os.listdir(d)]
+        ['0700']
+        >>> c.close()
+        >>> os.listdir(d)
+        []
+        >>> shutil.rmtree(d)
+    """
+
+    def __init__(self, max_entries=32, spill_dir=None, max_spilled=256):
+        self.max_entries = max_entries
+        self.spill_dir = spill_dir
+        self.max_spilled = max_spilled
+        self._entries = OrderedDict() # key -> CacheEntry, oldest first
+        self._spilled = OrderedDict() # key -> None, oldest first
+        self._dir = None # ours in spill_dir
+        self._dir_pid = None # the process that made _dir
+
+    def get(self, key):
+        """
+        Returns the :class:`CacheEntry` for key, or None.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None and key in self._spilled:
+            del self._spilled[key]
+            entry = self._unspill(key)
+        if entry is not None:
+            self.put(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        self._entries.pop(key, None)
+        self._entries[key] = entry
+        while len(self._entries) > self.max_entries:
+            old_key, old_entry = self._entries.popitem(last=False)
+            if self.spill_dir is not None:
+                self._spill(old_key, old_entry)
+
+    def close(self):
+        """
+        Removes the spilled entries, if this process wrote them.
+        """
+        if self._dir_pid == os.getpid():
+            shutil.rmtree(self._dir, ignore_errors=True)
+        self._dir = self._dir_pid = None
+        self._spilled.clear()
+
+    def _own_dir(self):
+        """
+        Returns this process's directory in spill_dir, or None if it can't
+        be made.
+        """
+        pid = os.getpid()
+        if self._dir_pid != pid:
+            # the spilled files are the parent's, which removes them
+            self._spilled.clear()
+            try:
+                self._dir = tempfile.mkdtemp(prefix='cells-%d-' % (pid,),
+                                             dir=self.spill_dir)
+            except OSError:
+                self._dir = None
+            self._dir_pid = pid
+        return self._dir
+
+    def _path(self, key):
+        return os.path.join(self._dir, key + '.cell')
+
+    def _spill(self, key, entry):
+        if entry.reads or self._own_dir() is None:
+            # unpickled, the reads would be copies with new ids
+            return
+        path = self._path(key)
+        try:
+            f = open(path, 'wb')
+            try:
+                dump(entry, f, HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+        except Exception:
+            _unlink(path)
+            return
+        self._spilled[key] = None
+        while len(self._spilled) > self.max_spilled:
+            old_key, _ = self._spilled.popitem(last=False)
+            _unlink(self._path(old_key))
+
+    def _unspill(self, key):
+        if self._own_dir() is None:
+            return None
+        path = self._path(key)
+        try:
+            f = open(path, 'rb')
+            try:
+                return load(f)
+            finally:
+                f.close()
+        except Exception:
+            return None
+        finally:
+            _unlink(path)
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
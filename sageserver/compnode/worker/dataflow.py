@@ -0,0 +1,279 @@
+"""
+Dataflow between cells.
+
+:func:`global_names` finds the global names a cell reads and writes, and
+:class:`CellGraph` uses them to work out which cells of a worksheet need to
+run again after some of them have been edited.  The analysis is static, so
+it can't see ``exec``, ``globals()[...]`` or attribute mutation
+(``a.append(1)`` reads ``a`` but doesn't write it).
+"""
+
+import ast
+
+
+def global_names(tree):
+    """
+    Returns ``(reads, writes)``, frozensets of the global names that the
+    module-level ast tree reads before writing them and writes.  Names read
+    inside functions count as reads of the cell, since calling the function
+    later reads them.
+
+    EXAMPLES::
+
+        >>> def names(s):
+        ...     r, w = global_names(ast.parse(s))
+        ...     return sorted(r), sorted(w)
+        >>> names('x = y + 1')
+        (['y'], ['x'])
+        >>> names('x = 1\\nprint x')
+        ([], ['x'])
+        >>> names('x += 1')
+        (['x'], ['x'])
+        >>> names('import numpy as np, os.path')
+        ([], ['np', 'os'])
+        >>> names('def f(a, b=c):\\n    d = a\\n    return d + e')
+        (['c', 'e'], ['f'])
+        >>> names('def g():\\n    global h\\n    h = 1')
+        ([], ['g', 'h'])
+        >>> names('class A(B):\\n    x = 1\\n    y = x + z')
+        (['B', 'z'], ['A'])
+        >>> names('for i in range(n): t = i')
+        (['n', 'range'], ['i', 't'])
+        >>> names('f = lambda a: a + k')
+        (['k'], ['f'])
+    """
+    v = _GlobalNames()
+    v.visit(tree)
+    return (frozenset(v.reads), frozenset(v.writes))
+
+
+def source_names(source):
+    """
+    Returns :func:`global_names` for the source of a cell.
+
+    :raises: SyntaxError
+    """
+    return global_names(parse_cell(source))
+
+
+def parse_cell(source):
+    """
+    Returns the ast of the source of a cell, ignoring its leading ``%``
+    directives.
+
+    :raises: SyntaxError
+    """
+    lines = source.splitlines(True)
+    for i, line in enumerate(lines):
+        if not line.startswith('%'):
+            break
+        lines[i] = '#' + line
+    return ast.parse(''.join(lines))
+
+
+class _GlobalNames(ast.NodeVisitor):
+    """
+    Walks a module keeping a stack of scopes.  ``self._locals`` is None at
+    module level, otherwise the set of names local to the function or class
+    being visited.
+    """
+
+    def __init__(self):
+        self.reads = set()
+        self.writes = set()
+        self._locals = None
+        self._globals_decl = set()
+
+    def _load(self, name):
+        if self._locals is None:
+            if name not in self.writes:
+                self.reads.add(name)
+        elif name not in self._locals:
+            self.reads.add(name)
+
+    def _store(self, name):
+        if self._locals is None or name in self._globals_decl:
+            self.writes.add(name)
+        else:
+            self._locals.add(name)
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load):
+            self._load(node.id)
+        else:
+            self._store(node.id)
+
+    def visit_Assign(self, node):
+        # the value is evaluated before the targets are bound
+        self.visit(node.value)
+        for target in node.targets:
+            self.visit(target)
+
+    def visit_AugAssign(self, node):
+        self.visit(node.value)
+        if isinstance(node.target, ast.Name):
+            self._load(node.target.id)
+        self.visit(node.target)
+
+    def visit_For(self, node):
+        self.visit(node.iter)
+        self.visit(node.target)
+        for stmt in node.body + node.orelse:
+            self.visit(stmt)
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            self._store(alias.asname or alias.name.partition('.')[0])
+
+    def visit_ImportFrom(self, node):
+        for alias in node.names:
+            if alias.name != '*':
+                self._store(alias.asname or alias.name)
+
+    def visit_Global(self, node):
+        self._globals_decl.update(node.names)
+
+    def visit_FunctionDef(self, node):
+        for d in node.decorator_list:
+            self.visit(d)
+        self._visit_function(node.args, node.body)
+        self._store(node.name)
+
+    def visit_Lambda(self, node):
+        self._visit_function(node.args, [node.body])
+
+    def visit_ClassDef(self, node):
+        for b in node.bases:
+            self.visit(b)
+        for d in node.decorator_list:
+            self.visit(d)
+        self._in_scope(set(), node.body)
+        self._store(node.name)
+
+    def _visit_function(self, args, body):
+        # defaults are evaluated in the enclosing scope
+        for d in args.defaults:
+            self.visit(d)
+        local = set(_arg_names(args))
+        # a name assigned anywhere in a function is local to all of it
+        for stmt in body:
+            local.update(_bound_names(stmt))
+        self._in_scope(local, body)
+
+    def _in_scope(self, local, body):
+        saved = (self._locals, self._globals_decl)
+        self._locals = local
+        self._globals_decl = set(self._globals_decl)
+        for stmt in body:
+            if isinstance(stmt, ast.Global):
+                self._globals_decl.update(stmt.names)
+        self._locals.difference_update(self._globals_decl)
+        try:
+            for stmt in body:
+                self.visit(stmt)
+        finally:
+            self._locals, self._globals_decl = saved
+
+
+def _arg_names(args):
+    names = []
+    for a in args.args:
+        names.extend(n.id for n in ast.walk(a) if isinstance(n, ast.Name))
+    names.extend(n for n in (args.vararg, args.kwarg) if n)
+    return names
+
+
+def _bound_names(stmt):
+    """
+    Yields the names bound by stmt, not looking inside nested functions or
+    classes.
+    """
+    todo = [stmt]
+    while todo:
+        node = todo.pop()
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            yield node.name
+            continue
+        if isinstance(node, ast.Lambda):
+            continue
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            yield node.id
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                if alias.name != '*':
+                    yield alias.asname or alias.name.partition('.')[0]
+        todo.extend(ast.iter_child_nodes(node))
+
+
+class CellGraph(object):
+    """
+    The reads and writes of the last run of each cell, by cell id.
+
+    EXAMPLES::
+
+        >>> g = CellGraph()
+        >>> cells = [(1, 'a = 1'), (2, 'b = a * 2'), (3, 'c = 3'),
+        ...          (4, 'print b, c')]
+        >>> g.affected(cells)
+        [1, 2, 3, 4]
+        >>> for cid, source in cells:
+        ...     g.record(cid, source, source_names(source), True)
+        >>> g.affected(cells)
+        []
+        >>> cells[0] = (1, 'a = 5')
+        >>> g.affected(cells)
+        [1, 2, 4]
+        >>> g.record(2, 'b = a * 2', source_names('b = a * 2'), False)
+        >>> g.affected([(2, 'b = a * 2'), (3, 'c = 3'), (4, 'print b, c')])
+        [2, 4]
+    """
+
+    def __init__(self):
+        self._cells = {} # cid -> (source, reads, writes, ok)
+
+    def record(self, cid, source, names, ok):
+        """
+        Records a run of a cell.
+
+        :param names: ``(reads, writes)`` from :func:`global_names`.
+        :param ok: False if the cell raised.
+        """
+        reads, writes = names
+        self._cells[cid] = (source, reads, writes, ok)
+
+    def affected(self, cells):
+        """
+        Returns the cids of the cells that need to run, in order.
+
+        :param cells: a list of ``(cid, source)`` in the order the cells
+            run.
+
+        A cell needs to run if it's new, its source changed, its last run
+        raised, or it reads or writes a name written by an earlier cell that
+        needs to run.
+        """
+        dirty = set()
+        run = []
+        for cid, source in cells:
+            last = self._cells.get(cid)
+            if last is not None and last[0] == source:
+                reads, writes = last[1:3]
+            else:
+                try:
+                    reads, writes = source_names(source)
+                except SyntaxError:
+                    reads = writes = frozenset()
+            if (last is None or last[0] != source or not last[3]
+                    or not dirty.isdisjoint(reads)
+                    or not dirty.isdisjoint(writes)):
+                run.append(cid)
+                dirty.update(writes)
+                if last is not None:
+                    # names the old version wrote may be gone now
+                    dirty.update(last[2])
+        return run
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
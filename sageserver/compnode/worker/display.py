@@ -0,0 +1,358 @@
+"""
+Displaying the results of expressions.
+
+:class:`DisplayHook` replaces ``sys.displayhook`` as ``__displayhook__``.
+Instead of building the whole repr of a result and sending it as one
+Stdout, it renders the repr piece by piece with :func:`iter_repr` and sends
+it in chunks until a budget of bytes is used up.  The rest of the repr isn't
+rendered: it's kept as a paused generator and a :class:`msg.Truncated` is
+sent, so the client can ask for more with a :class:`msg.FetchMore`.
+
+The remainder is rendered when it's fetched, so it shows the object as it
+is then, and fetching it may fail if a container changed size.
+
+Objects with a rich repr (see :func:`rich_repr`) are sent as a
+:class:`msg.Display` with the bytes as a BSON binary instead.  Payloads
+bigger than ``inline_bytes`` are kept in the worker and the Display only
+has a ``ref`` for a :class:`msg.FetchDisplay`, so a big plot doesn't hold
+up the rest of the output and isn't sent to clients that never show it.
+"""
+
+import __builtin__
+from collections import OrderedDict
+from itertools import chain
+import sys
+import threading
+from types import ClassType
+
+from bson.binary import Binary
+
+import sageserver.msg as msg
+
+# strings longer than this are repr'd in pieces of this size
+_STR_PIECE = 4096
+
+# elements numpy shows before summarizing an array
+_NUMPY_THRESHOLD = 1000
+
+# the rich reprs looked for, best first
+RICH_REPRS = (
+    ('_repr_png_', 'image/png'),
+    ('_repr_jpeg_', 'image/jpeg'),
+    ('_repr_svg_', 'image/svg+xml'),
+    ('_repr_html_', 'text/html'),
+)
+
+_CONTAINERS = {
+    list: ('[', ']'),
+    tuple: ('(', ')'),
+    dict: ('{', '}'),
+    set: ('set([', '])'),
+    frozenset: ('frozenset([', '])'),
+}
+
+
+def iter_repr(obj, _active=None):
+    """
+    Yields the pieces of ``repr(obj)``.  Lists, tuples, dicts, sets and long
+    strings are rendered a piece at a time, NumPy arrays are summarized and
+    anything else is repr'd in one go.
+
+    EXAMPLES::
+
+        >>> def r(obj):
+        ...     s = ''.join(iter_repr(obj))
+        ...     assert s == repr(obj), (s, repr(obj))
+        ...     return s
+        >>> r([1, (2,), {'a': set([3])}, frozenset(), ()])
+        "[1, (2,), {'a': set([3])}, frozenset([]), ()]"
+        >>> l = [1]; l.append(l); r(l)
+        '[1, [...]]'
+        >>> s = "it's" + 'x' * 5000 + '"'
+        >>> len(r(s)), len(r(u'\\xe9' * 5000))
+        (5008, 20003)
+        >>> len(list(iter_repr(range(10000)))) > 10000
+        True
+    """
+    t = type(obj)
+    if t in _CONTAINERS:
+        if _active is None:
+            _active = set()
+        if id(obj) in _active:
+            yield '{...}' if t is dict else '[...]'
+            return
+        _active.add(id(obj))
+        try:
+            start, end = _CONTAINERS[t]
+            yield start
+            if t is dict:
+                for i, (k, v) in enumerate(obj.iteritems()):
+                    if i:
+                        yield ', '
+                    for piece in iter_repr(k, _active):
+                        yield piece
+                    yield ': '
+                    for piece in iter_repr(v, _active):
+                        yield piece
+            else:
+                for i, item in enumerate(obj):
+                    if i:
+                        yield ', '
+                    for piece in iter_repr(item, _active):
+                        yield piece
+                if t is tuple and len(obj) == 1:
+                    yield ','
+            yield end
+        finally:
+            _active.discard(id(obj))
+    elif t in (str, unicode) and len(obj) > _STR_PIECE:
+        for piece in _iter_str_repr(obj):
+            yield piece
+    elif _is_ndarray(obj):
+        yield _ndarray_repr(obj)
+    else:
+        yield repr(obj)
+
+
+def rich_repr(obj):
+    """
+    Returns ``(mime, bytes)`` from the first method of :data:`RICH_REPRS`
+    that obj has and that doesn't return None, or None.  Unicode is encoded
+    as UTF-8.
+
+    EXAMPLES::
+
+        >>> class Plot(object):
+        ...     def _repr_png_(self):
+        ...         return None         # e.g. no backend
+        ...     def _repr_svg_(self):
+        ...         return u'<svg>\\u2026</svg>'
+        >>> rich_repr(Plot())
+        ('image/svg+xml', '<svg>\\xe2\\x80\\xa6</svg>')
+        >>> rich_repr(Plot) is None     # the class isn't displayed richly
+        True
+        >>> rich_repr([1, 2]) is None
+        True
+    """
+    if isinstance(obj, (type, ClassType)):
+        return None
+    for name, mime in RICH_REPRS:
+        method = getattr(obj, name, None)
+        if method is None:
+            continue
+        data = method()
+        if data is None:
+            continue
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        return mime, data
+    return None
+
+
+def _iter_str_repr(s):
+    # repr picks the quote from the whole string
+    q = '"' if "'" in s and '"' not in s else "'"
+    prefix = 'u' if isinstance(s, unicode) else ''
+    yield prefix + q
+    for i in xrange(0, len(s), _STR_PIECE):
+        r = repr(s[i:i + _STR_PIECE])[len(prefix):]
+        inner = r[1:-1]
+        if r[0] != q:
+            # the piece had no ' so repr quoted it with ", and the whole
+            # string has a " so its ' are escaped
+            inner = inner.replace("'", "\\'")
+        yield inner
+    yield q
+
+
+def _is_ndarray(obj):
+    numpy = sys.modules.get('numpy')
+    return numpy is not None and isinstance(obj, numpy.ndarray)
+
+
+def _ndarray_repr(a):
+    import numpy
+    opts = numpy.get_printoptions()
+    numpy.set_printoptions(threshold=min(opts['threshold'], _NUMPY_THRESHOLD))
+    try:
+        return repr(a)
+    finally:
+        numpy.set_printoptions(**opts)
+
+
+class DisplayHook(object):
+    """
+    ``__displayhook__`` in the exec globals.
+
+    EXAMPLES::
+
+        >>> import Queue, StringIO
+        >>> q = Queue.Queue()
+        >>> out = StringIO.StringIO()
+        >>> dh = DisplayHook(max_bytes=20, chunk_size=8)
+        >>> dh.bind(q, 5)
+        >>> saved, sys.stdout = sys.stdout, out
+        >>> try:
+        ...     dh(range(100))
+        ...     shown = out.getvalue()
+        ...     m = q.get()
+        ...     fetched = dh.fetch(m['more_id'], 1000, q, 6)
+        ... finally:
+        ...     sys.stdout = saved
+        >>> shown
+        '[0, 1, 2, 3, 4, 5, 6'
+        >>> m['shown'], m.hdr.sid
+        (20, 5)
+        >>> out.getvalue() == repr(range(100)) + '\\n'
+        True
+        >>> q.empty()                  # no more to fetch
+        True
+
+    Rich reprs::
+
+        >>> class Image(object):
+        ...     def __init__(self, n):
+        ...         self.n = n
+        ...     def _repr_png_(self):
+        ...         return '\\x89PNG' + '\\x00' * self.n
+        >>> dh.inline_bytes = 100
+        >>> dh(Image(2)); dh.display(Image(1000))
+        >>> small, big = q.get(), q.get()
+        >>> small['mime'], str(small['data']), small['ref']
+        ('image/png', '\\x89PNG\\x00\\x00', None)
+        >>> big['data'], big['size']
+        (None, 1004)
+        >>> dh.fetch_display(big['ref'])[1] == Image(1000)._repr_png_()
+        True
+    """
+
+    def __init__(self, max_bytes=65536, chunk_size=8192, max_pending=8,
+                 inline_bytes=262144, max_displays=16):
+        """
+        :param max_bytes: about how much of a repr is sent before it's
+            truncated, and by default for each :class:`msg.FetchMore`.
+        :param chunk_size: about how many bytes are sent in each Stdout.
+        :param max_pending: how many truncated reprs can be fetched from;
+            older ones are dropped.
+        :param inline_bytes: the biggest rich repr sent in its
+            :class:`msg.Display`; bigger ones are sent by reference.
+        :param max_displays: how many rich reprs sent by reference can be
+            fetched; older ones are dropped.
+        """
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.max_pending = max_pending
+        self.inline_bytes = inline_bytes
+        self.max_displays = max_displays
+        self._pending = OrderedDict() # more_id -> (pieces, bytes shown)
+        self._displays = OrderedDict() # ref -> (mime, bytes)
+        # FetchDisplay is answered by the receiving thread
+        self._displays_lock = threading.Lock()
+        self._last_id = 0
+        self._send_q = None
+        self._sid = None
+
+    def bind(self, send_q, sid):
+        """
+        Sends :class:`msg.Truncated` and :class:`msg.Display` for the cell
+        sid from now on.
+        """
+        self._send_q = send_q
+        self._sid = sid
+
+    def __call__(self, obj):
+        if obj is None:
+            return
+        __builtin__._ = obj
+        self.display(obj)
+
+    def display(self, obj):
+        """
+        display(obj)
+
+        Shows obj as the result of a cell would be shown, with its rich repr
+        if it has one, without setting ``_``.
+        """
+        rich = rich_repr(obj) if self._send_q is not None else None
+        if rich is not None:
+            self._send_display(*rich)
+        else:
+            self._show(iter(iter_repr(obj)), 0, self.max_bytes, self._sid)
+
+    def fetch_display(self, ref):
+        """
+        Returns the ``(mime, bytes)`` of a Display sent by reference, or None
+        if it was dropped.
+        """
+        with self._displays_lock:
+            return self._displays.get(ref)
+
+    def fetch(self, more_id, nbytes, send_q, sid):
+        """
+        Sends up to about nbytes more of a truncated repr, as sid.  Returns
+        False if more_id was dropped or fully fetched.
+        """
+        p = self._pending.pop(more_id, None)
+        if p is None:
+            return False
+        self.bind(send_q, sid)
+        pieces, shown = p
+        self._show(pieces, shown, nbytes or self.max_bytes, sid, more_id)
+        return True
+
+    def _show(self, pieces, shown, budget, sid, more_id=None):
+        """
+        Writes pieces to stdout in chunks until budget bytes are written,
+        then keeps the rest and sends a Truncated.
+        """
+        out = sys.stdout
+        chunk = []
+        chunk_len = 0
+        sent = 0
+        for piece in pieces:
+            if sent + chunk_len + len(piece) > budget:
+                # split the piece at the budget, keep the rest
+                n = max(0, budget - sent - chunk_len)
+                chunk.append(piece[:n])
+                out.write(''.join(chunk))
+                sent += chunk_len + n
+                pieces = chain([piece[n:]], pieces)
+                self._truncated(pieces, shown + sent, sid, more_id)
+                return
+            chunk.append(piece)
+            chunk_len += len(piece)
+            if chunk_len >= self.chunk_size:
+                out.write(''.join(chunk))
+                sent += chunk_len
+                chunk = []
+                chunk_len = 0
+        chunk.append('\n')
+        out.write(''.join(chunk))
+
+    def _send_display(self, mime, data):
+        if len(data) <= self.inline_bytes:
+            m = msg.Display(mime, Binary(data, 0), len(data), _hsid=self._sid)
+        else:
+            with self._displays_lock:
+                self._last_id += 1
+                ref = self._last_id
+                self._displays[ref] = (mime, data)
+                while len(self._displays) > self.max_displays:
+                    self._displays.popitem(last=False)
+            m = msg.Display(mime, None, len(data), ref, _hsid=self._sid)
+        self._send_q.put(m)
+
+    def _truncated(self, pieces, shown, sid, more_id=None):
+        if more_id is None:
+            self._last_id += 1
+            more_id = self._last_id
+        self._pending[more_id] = (pieces, shown)
+        while len(self._pending) > self.max_pending:
+            self._pending.popitem(last=False)
+        if self._send_q is not None:
+            self._send_q.put(msg.Truncated(more_id, shown, _hsid=sid))
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
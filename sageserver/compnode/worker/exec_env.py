@@ -3,38 +3,87 @@ The execution environment.
 """
 
 from ast import parse as ast_parse
+from functools import partial
+import linecache
 import logging
 import os
 from Queue import Queue
 from time import time as _time, sleep as _sleep
+from traceback import format_exc
+
+from bson.binary import Binary
 
 
 import sageserver.msg as msg
 from transforms import transform_source, transform_ast, assignhook
 from queuefile import QueueFileOut, QueueFileIn
+from limits import CellTimer, OutputLimiter
+from hibernate import dump_namespace, load_namespace
+from dataflow import CellGraph, global_names, source_names
+from cellcache import cell_key, identity_reads, CacheEntry, OutputRecorder
+from parallel import run_parallel, ParallelMap
+from progress import ProgressReporter
+from display import DisplayHook
 #from sageloader import SageLoader
 
+def remember_source(fname, source):
+    """
+    Puts source in :mod:`linecache` as the contents of fname, rather than
+    writing a file: cells are numbered per worker, so files would be
+    overwritten by other workers and forked children sharing a directory.
+    """
+    # with no mtime, checkcache() leaves the entry alone
+    linecache.cache[fname] = (len(source), None,
+                              source.splitlines(True), fname)
+
+
 class ExecEnv(object):
 
-    def __init__(self, msgr):
+    # memory that's freed so that an Except can be built after a MemoryError
+    _MEM_RESERVE_SIZE = 256 * 1024
+
+    # globals set up by the environment rather than by cells
+    _ENV_NAMES = frozenset(['__builtins__', '__displayhook__',
+                            '__assignhook__', '__exec_msg__',
+                            'parallel_map', 'parallel_for', 'progress',
+                            'display'])
+
+    def __init__(self, msgr, exec_defaults=None, mem_watcher=None,
+                 cell_cache=None, max_procs=1, progress_rate=4.0,
+                 stdin_window=0, display_bytes=65536):
         """
         Sets up this execution session's environment.
-        """
-        self._send_q = msgr.get_send_queue()
-        
-        msgr.recv_handlers.update({
-            msg.STDIN: self._recv_Stdin,
-            msg.GET_COMPLETIONS: self._recv_GetCompletions,
-            msg.GET_DOC: self._recv_GetDoc,
-            msg.GET_SOURCE: self._recv_GetSource,
-        })
 
-        self._log = logging.getLogger(
-            "%s[pid=%s]" % (self.__class__.__name__, os.getpid()) )
+        :param exec_defaults: a dict of :class:`msg.ExecCell` options (e.g.
+            ``timeout``) to use when the message leaves them as None.
+        :param mem_watcher: a :class:`limits.MemoryWatcher` to arm while cells
+            execute, or None.
+        :param cell_cache: a :class:`cellcache.CellCache` for cells run with
+            ``cache=True``, or None to always execute them.
+        :param max_procs: the number of processes ``parallel_map`` and
+            ``parallel_for`` use by default.
+        :param progress_rate: the most :class:`msg.Progress` messages a
+            cell sends a second.
+        :param stdin_window: bytes of Stdin that may be sent ahead of the
+            reads of a cell (see :class:`queuefile.QueueFileIn`).
+        :param display_bytes: about how much of the repr of a result is
+            sent before it's truncated (see :mod:`display`).
+        """
+        self._stdin_window = stdin_window
+        self._exec_defaults = exec_defaults or {}
+        self._cell_cache = cell_cache
+        self._mem_reserve = bytearray(self._MEM_RESERVE_SIZE)
+        self.bind(msgr, mem_watcher)
         self._globals = {}
+        # (cid, source, bound_names) of the cells that built the namespace
+        self._history = []
+        self.executing = False # True while a cell's code is running
+        self.dataflow = CellGraph()
 
         self.MAIN_HANDLERS = {
-            msg.EXEC_CELL: self._main_ExecCell,
+            msg.EXEC_CELL: self.exec_cell,
+            msg.RESTORE: self._main_Restore,
+            msg.FETCH_MORE: self._main_FetchMore,
             #msg.EXEC_INTERACT: self.exec_,
         }
             
@@ -64,8 +113,16 @@ import sageserver.msg as msg
         self._mod_time.__sleep__ = self._mod_time.sleep
         self._mod_time.sleep = _fake_sleep
 
-        self._globals["__displayhook__"] = self._mod_sys.displayhook
+        self._displayhook = DisplayHook(display_bytes)
+        self._globals["__displayhook__"] = self._displayhook
+        self._globals["display"] = self._displayhook.display
         self._globals["__assignhook__"] = assignhook
+        self._progress = ProgressReporter(progress_rate)
+        self._globals["progress"] = self._progress
+        self._parallel_map = ParallelMap(max_procs,
+                                         progress=self._parallel_progress)
+        self._globals["parallel_map"] = self._parallel_map.map
+        self._globals["parallel_for"] = self._parallel_map.for_each
 
         #self._loader = SageLoader(sys=self._mod_sys, append=True,
         #       log=logging.getLogger("SageLoader[pid=%d]" % (os.getpid(),) ) )
@@ -74,9 +131,26 @@ import sageserver.msg as msg
         #b["__reload__"] = b["reload"]
         #b["reload"] = self._loader.reload
 
-    def _main_ExecCell(self, exec_msg):
+    def bind(self, msgr, mem_watcher=None):
         """
-        Executes a multi-line block of code.
+        Sends and receives through msgr from now on.  Called again when a
+        snapshot of this environment takes over as the worker.
+        """
+        self._log = logging.getLogger(
+            "%s[pid=%s]" % (self.__class__.__name__, os.getpid()) )
+        self._send_q = msgr.get_send_queue()
+        self._mem_watcher = mem_watcher
+        msgr.recv_handlers.update({
+            msg.STDIN: self._recv_Stdin,
+            msg.GET_COMPLETIONS: self._recv_GetCompletions,
+            msg.GET_DOC: self._recv_GetDoc,
+            msg.GET_SOURCE: self._recv_GetSource,
+            msg.FETCH_DISPLAY: self._recv_FetchDisplay,
+        })
+
+    def exec_cell(self, exec_msg):
+        """
+        Executes a multi-line block of code.  Returns False if it raised.
         """
         sid = exec_msg.hdr.sid
         send_q = self._send_q
@@ -84,14 +158,17 @@ import sageserver.msg as msg
         self._mod_msg._send_q = send_q
         self._mod_msg._exec_id = id
         
-        self._stdout = QueueFileOut(send_q, msg.Stdout, sid)
-        self._stderr = QueueFileOut(send_q, msg.Stderr, sid)
+        limiter = OutputLimiter(send_q, sid,
+                                self._exec_opt(exec_msg, 'output_rate'),
+                                self._exec_opt(exec_msg, 'output_soft_limit'),
+                                self._exec_opt(exec_msg, 'output_limit'),
+                                self._exec_opt(exec_msg, 'output_interrupt'))
+        self._set_output(send_q, sid, limiter)
+        self._progress.bind(send_q, sid)
+        self._displayhook.bind(send_q, sid)
         self._stdin_q = Queue()
         self._stdin = QueueFileIn(self._stdin_q, send_q, sid,
-                                  exec_msg['echo_stdin'])
-
-        self._mod_sys.stdout = self._stdout
-        self._mod_sys.stderr = self._stderr
+                                  exec_msg['echo_stdin'], self._stdin_window)
         self._mod_sys.stdin = self._stdin
 
         #name = exec_msg["name", "__cell_%s__" % (id,))
@@ -99,17 +176,18 @@ import sageserver.msg as msg
         #self._globals.update(mod.__dict__)
         fname = 'cell_%d.py' % (exec_msg['cid'],)
 
+        ok = True
+        names = (frozenset(), frozenset())
         try:
             # apply source and ast transformations
             source = transform_source(exec_msg, self._globals)
             
-            # write to file so that introspection works
-            f = open(fname, 'w')
-            f.write(source)
-            f.close()
+            # so that introspection and tracebacks find it
+            remember_source(fname, source)
             
             #self._loader.set_source(name, source)
             source_ast = ast_parse(source, filename=fname, mode='exec')
+            names = global_names(source_ast)
             source_ast = transform_ast(exec_msg, source_ast, source,
                                        self._globals)
             # compile and execute
@@ -117,11 +195,216 @@ import sageserver.msg as msg
             #self._loader.set_code(name, code)
             exec_msg['transformed_source'] = source
             self._globals["__exec_msg__"] = exec_msg
-            exec code in self._globals
+            timer = CellTimer(self._exec_opt(exec_msg, 'timeout'),
+                              self._exec_opt(exec_msg, 'cpu_timeout'))
+            mem_watcher = self._mem_watcher
+            before = _name_ids(self._globals)
+            key = recorder = None
+            if exec_msg.get('cache') and self._cell_cache is not None:
+                key = cell_key(code, names[0], self._globals,
+                               (exec_msg['displayhook'],
+                                exec_msg['assignhook']))
+                reads = identity_reads(names[0], self._globals)
+                entry = self._cell_cache.get(key)
+                if entry is not None:
+                    self._log.debug("[exec_cell] cache hit for cell %d",
+                                    exec_msg['cid'])
+                    entry.replay(self._globals, send_q, sid)
+                    self._record_cell(exec_msg['cid'], source, before)
+                    return ok
+                recorder = OutputRecorder(send_q)
+                self._set_output(recorder, sid, limiter)
+            try:
+                if mem_watcher is not None:
+                    mem_watcher.arm()
+                timer.start()
+                self.executing = True
+                exec code in self._globals
+            finally:
+                self.executing = False
+                timer.cancel()
+                if mem_watcher is not None:
+                    mem_watcher.disarm()
+                bound = self._record_cell(exec_msg['cid'], source, before)
+            if recorder is not None:
+                self._cell_cache.put(key, CacheEntry(
+                        dict((name, self._globals[name]) for name in bound),
+                        recorder.msgs, reads))
         except:
+            ok = False
+            self._mem_reserve = None
             send_q.put(_get_except_msg(exec_msg))
         finally:
+            self.dataflow.record(exec_msg['cid'], exec_msg['source'], names,
+                                 ok)
+            if self._mem_reserve is None:
+                try:
+                    self._mem_reserve = bytearray(self._MEM_RESERVE_SIZE)
+                except MemoryError:
+                    pass
+            if self._mem_watcher is not None:
+                # report the level after the cell before the manager sees Done
+                self._mem_watcher.check()
+            self._progress.finish()
+            limiter.finish()
             send_q.put(msg.Done().as_reply_to(exec_msg))
+        return ok
+
+    def exec_parallel(self, exec_msgs, max_procs):
+        """
+        Executes cells that don't depend on each other at the same time, in
+        forked children (see :mod:`parallel`).  What they assign is merged
+        back into the namespace if it pickles.  Returns a list with False
+        for each cell that raised or was interrupted.
+        """
+        oks = [False] * len(exec_msgs)
+
+        def child_run(exec_msg, writer):
+            self._send_q = writer
+            before = _name_ids(self._globals)
+            ok = self.exec_cell(exec_msg)
+            writer.result(ok, self._globals, self._bound_names(before))
+
+        def on_result(i, ok, values, failed):
+            exec_msg = exec_msgs[i]
+            oks[i] = ok
+            before = _name_ids(self._globals)
+            self._globals.update(values)
+            if failed:
+                self._send_q.put(msg.Stderr(
+                        "not merged back from the parallel run: %s\n"
+                        % (', '.join(sorted(failed)),),
+                        _hsid=exec_msg.hdr.sid))
+            try:
+                names = source_names(exec_msg['source'])
+            except SyntaxError:
+                names = (frozenset(), frozenset())
+            self.dataflow.record(exec_msg['cid'], exec_msg['source'], names,
+                                 ok)
+            self._record_cell(exec_msg['cid'], exec_msg['source'], before)
+
+        self.executing = True
+        try:
+            interrupted = run_parallel(
+                    [partial(child_run, m) for m in exec_msgs], max_procs,
+                    self._send_q, on_result)
+        finally:
+            self.executing = False
+        for i in interrupted:
+            self._send_q.put(msg.Skipped('INTERRUPT')
+                                .as_reply_to(exec_msgs[i]))
+        return oks
+
+    def _parallel_progress(self, done, total):
+        self._progress(float(done) / total, 'parallel_map: %d of %d'
+                                             % (done, total))
+
+    def _set_output(self, send_q, sid, limiter=None):
+        """
+        Points stdout and stderr at send_q, as sid, through limiter if it's
+        given.
+        """
+        self._stdout = QueueFileOut(send_q, msg.Stdout, sid, limiter)
+        self._stderr = QueueFileOut(send_q, msg.Stderr, sid, limiter)
+        self._mod_sys.stdout = self._stdout
+        self._mod_sys.stderr = self._stderr
+
+    def _record_cell(self, cid, source, before):
+        """
+        Adds a cell to the history if it bound any names, and forgets the
+        cells whose names it all rebound.  Returns the names it bound.
+        """
+        bound = self._bound_names(before)
+        if not bound:
+            return bound
+        bound_set = frozenset(bound)
+        self._history = [h for h in self._history
+                         if not bound_set.issuperset(h[2])]
+        self._history.append((cid, source, bound))
+        return bound
+
+    def _bound_names(self, before):
+        """
+        Returns the names bound since ``before = _name_ids(self._globals)``.
+        """
+        after = _name_ids(self._globals)
+        return [name for name, oid in after.iteritems()
+                if before.get(name) != oid and name not in self._ENV_NAMES]
+
+    def hibernate(self, path):
+        """
+        Writes the namespace to path.  Returns the info dict from
+        :func:`hibernate.dump_namespace`.
+        """
+        return dump_namespace(path, self._globals, self._history,
+                              skip=self._ENV_NAMES)
+
+    def _main_Restore(self, m):
+        """
+        Loads a namespace written by :func:`hibernate`.  Output of the
+        replayed cells is thrown away.
+        """
+        start = _time()
+        sys = self._mod_sys
+        saved = (sys.stdin, sys.stdout, sys.stderr)
+        devnull = open(os.devnull, 'r+')
+        sys.stdin = sys.stdout = sys.stderr = devnull
+        try:
+            errors = load_namespace(m['path'], self._globals, self._history)
+        except Exception, e:
+            errors = ["%s: %s" % (type(e).__name__, e)]
+        finally:
+            sys.stdin, sys.stdout, sys.stderr = saved
+            devnull.close()
+        if errors:
+            self._log.warning("[_main_Restore] %r: %s", m['path'], errors)
+        self._send_q.put(msg.Restored(m['path'], _time() - start, errors)
+                            .as_reply_to(m))
+
+    def _main_FetchMore(self, m):
+        """
+        Sends more of a result that was truncated by the displayhook.
+        """
+        sid = m.hdr.sid
+        self._set_output(self._send_q, sid)
+        try:
+            if not self._displayhook.fetch(m['more_id'], m['nbytes'],
+                                           self._send_q, sid):
+                self._send_q.put(msg.Stderr("the rest of this output is no "
+                                            "longer available\n", _hsid=sid))
+        except Exception:
+            # e.g. a dict that changed size since it was truncated
+            self._send_q.put(msg.Stderr(format_exc(), _hsid=sid))
+        self._send_q.put(msg.Done().as_reply_to(m))
+
+    def _recv_FetchDisplay(self, m):
+        """
+        Returns the :class:`msg.Display` of m['ref'] with its payload, or a
+        :class:`msg.No` if it was dropped.
+        """
+        d = self._displayhook.fetch_display(m['ref'])
+        if d is None:
+            rm = msg.No()
+        else:
+            mime, data = d
+            rm = msg.Display(mime, Binary(data, 0), len(data), m['ref'])
+        self._send_q.put(rm.as_reply_to(m))
+
+    def _exec_opt(self, exec_msg, key):
+        """
+        Returns ``exec_msg[key]``, or the worker default if it's None.
+        """
+        v = exec_msg.get(key)
+        if v is None:
+            v = self._exec_defaults.get(key)
+        return v
+
+    @property
+    def globals(self):
+        """
+        The namespace cells run in.
+        """
+        return self._globals
 
     @property
     def waiting_on_stdin(self):
@@ -197,6 +480,14 @@ def _fake_sleep(t, sleep_time=0.25):
     _sleep(t)
 
 
+def _name_ids(globals_):
+    """
+    Returns a dict of name -> id(value), used to find the names a cell
+    bound.
+    """
+    return dict((name, id(value)) for name, value in globals_.iteritems())
+
+
 def _get_except_msg(exec_msg):
     """
     Returns either:
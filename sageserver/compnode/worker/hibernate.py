@@ -0,0 +1,148 @@
+"""
+Saving an idle worker's namespace to disk and restoring it in a new worker.
+
+The file is a zlib-compressed pickle of::
+
+    {
+        'version': 1,
+        'globals': {name: pickled value, ...},
+        'replay': [(cid, source), ...],
+        'history': [(cid, source, bound_names), ...],
+    }
+
+Every global that pickles is stored by value.  The rest (modules, functions
+and classes defined in cells, open files, ...) are rebuilt by running the
+cells that last bound them again, in the order they originally ran.
+"""
+
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
+import linecache
+import os
+from types import ModuleType
+from zlib import compress, decompress
+
+_VERSION = 1
+
+
+def dump_namespace(path, globals_, history, skip=()):
+    """
+    Writes globals_ to path.
+
+    :param history: a list of (cid, source, bound_names) in the order the
+        cells ran.
+    :param skip: names in globals_ that shouldn't be saved.
+    :returns: a dict with the ``nbytes`` written, the number of
+        ``n_globals`` stored by value and the number of ``n_cells`` to
+        replay.
+
+    EXAMPLES::
+
+        >>> import os, tempfile
+        >>> path = tempfile.mktemp()
+        >>> g = {}
+        >>> src = 'import os\\nx = [1, 2]\\ndef f(): return x'
+        >>> exec src in g
+        >>> info = dump_namespace(path, g, [(1, src, ['os', 'x', 'f'])],
+        ...                       skip=('__builtins__',))
+        >>> (info['n_globals'], info['n_cells'])
+        (1, 1)
+        >>> g2 = {}
+        >>> load_namespace(path, g2)
+        []
+        >>> g2['f'](), g2['os'] is os
+        ([1, 2], True)
+        >>> oct(os.stat(path).st_mode & 0777)
+        '0600'
+        >>> os.unlink(path)
+    """
+    skip = frozenset(skip)
+    pickled = {}
+    unpicklable = set()
+    for name, value in globals_.iteritems():
+        if name in skip:
+            continue
+        if isinstance(value, ModuleType):
+            # the import is replayed, a reducer registered with copy_reg
+            # (twisted has one) wouldn't be there in the new worker
+            unpicklable.add(name)
+            continue
+        try:
+            pickled[name] = dumps(value, HIGHEST_PROTOCOL)
+        except Exception:
+            unpicklable.add(name)
+
+    # the last cell to bind each unpicklable name is replayed
+    last_binder = {}
+    for i, (cid, source, bound) in enumerate(history):
+        for name in bound:
+            if name in unpicklable:
+                last_binder[name] = i
+    replay = [history[i][:2] for i in sorted(set(last_binder.values()))]
+
+    data = compress(dumps({
+        'version': _VERSION,
+        'globals': pickled,
+        'replay': replay,
+        'history': list(history),
+    }, HIGHEST_PROTOCOL), 1)
+    tmp_path = path + '.tmp'
+    # only the worker's user may read it, the namespace is theirs
+    f = os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                          0600), 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
+    return {
+        'nbytes': len(data),
+        'n_globals': len(pickled),
+        'n_cells': len(replay),
+    }
+
+
+def load_namespace(path, globals_, history=None):
+    """
+    Restores a namespace written by :func:`dump_namespace` into globals_.
+
+    :param history: a list that the saved cell history is appended to, or
+        None.
+    :returns: a list of error strings for values that couldn't be unpickled
+        and cells that raised when replayed.
+    """
+    f = open(path, 'rb')
+    try:
+        data = loads(decompress(f.read()))
+    finally:
+        f.close()
+    if data['version'] != _VERSION:
+        raise ValueError("unknown hibernate file version %r"
+                         % (data['version'],))
+    errors = []
+    values = {}
+    for name, bytes in data['globals'].iteritems():
+        try:
+            values[name] = loads(bytes)
+        except Exception, e:
+            errors.append("%s: %s: %s" % (name, type(e).__name__, e))
+    globals_.update(values)
+    for cid, source in data['replay']:
+        try:
+            fname = 'cell_%d.py' % (cid,)
+            # see exec_env.remember_source
+            linecache.cache[fname] = (len(source), None,
+                                      source.splitlines(True), fname)
+            code = compile(source, fname, 'exec')
+            exec code in globals_
+        except Exception, e:
+            errors.append("cell %d: %s: %s" % (cid, type(e).__name__, e))
+    # replayed cells may have rebound names to older values
+    globals_.update(values)
+    if history is not None:
+        history.extend(data['history'])
+    return errors
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
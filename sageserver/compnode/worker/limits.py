@@ -0,0 +1,377 @@
+"""
+Resource limits for cell execution.
+
+Time limits are enforced by the kernel (interval timers) and delivered to
+the main thread as signals, so nothing has to poll while a cell runs.  The
+exceptions raised derive from :class:`BaseException` so that a cell's own
+``except Exception:`` blocks don't swallow them.
+
+Memory is limited in two ways: a hard address-space rlimit, which makes
+allocations fail with :class:`MemoryError`, and a soft RSS limit watched by
+:class:`MemoryWatcher`, which reports to the manager and raises
+:class:`MemoryLimitExceeded` in a running cell.
+
+Output is limited by :class:`OutputLimiter`, which stdout and stderr check
+before each write so a runaway ``print`` loop can't flood the manager and
+the browser.
+"""
+
+import logging
+import os
+import resource
+import signal
+import thread
+import threading
+from time import sleep as _sleep, time as _time
+
+import sageserver.msg as msg
+
+
+class CellTimeout(BaseException):
+    """
+    Raised in the main thread when a cell runs past its wall-clock timeout.
+    """
+
+
+class CellCPUTimeout(CellTimeout):
+    """
+    Raised in the main thread when a cell uses more than its CPU timeout.
+    """
+
+
+class CellTimer(object):
+    """
+    Arms ``ITIMER_REAL`` (wall-clock) and ``ITIMER_PROF`` (CPU time) for the
+    duration of a cell.  Must be started and cancelled from the main thread,
+    since that's where the signal handlers run.
+
+    ``ITIMER_PROF`` counts the CPU time of the whole process, which includes
+    the (mostly idle) communication threads.
+
+    EXAMPLES::
+
+        >>> t = CellTimer(timeout=0.05)
+        >>> t.start()
+        >>> try:
+        ...     while 1: pass
+        ... except CellTimeout, e:
+        ...     print e
+        ... finally:
+        ...     t.cancel()
+        cell exceeded its wall-clock timeout of 0.05s
+        >>> t = CellTimer(cpu_timeout=0.05)
+        >>> t.start()
+        >>> try:
+        ...     while 1: pass
+        ... except CellTimeout, e:
+        ...     print type(e).__name__
+        ... finally:
+        ...     t.cancel()
+        CellCPUTimeout
+    """
+
+    def __init__(self, timeout=None, cpu_timeout=None):
+        """
+        :param timeout: wall-clock seconds, or None (or 0) for no limit.
+        :param cpu_timeout: CPU seconds, or None (or 0) for no limit.
+        """
+        self.timeout = timeout
+        self.cpu_timeout = cpu_timeout
+        self._old_handlers = {}
+
+    def start(self):
+        if self.timeout:
+            self._arm(signal.ITIMER_REAL, signal.SIGALRM, self.timeout,
+                      self._on_SIGALRM)
+        if self.cpu_timeout:
+            self._arm(signal.ITIMER_PROF, signal.SIGPROF, self.cpu_timeout,
+                      self._on_SIGPROF)
+
+    def cancel(self):
+        """
+        Disarms the timers and restores the previous signal handlers.  Safe to
+        call more than once.
+        """
+        if signal.SIGALRM in self._old_handlers:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        if signal.SIGPROF in self._old_handlers:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+        for signum, handler in self._old_handlers.items():
+            signal.signal(signum, handler)
+        self._old_handlers.clear()
+
+    def _arm(self, which, signum, seconds, handler):
+        self._old_handlers[signum] = signal.signal(signum, handler)
+        signal.setitimer(which, seconds)
+
+    def _on_SIGALRM(self, signum, frame):
+        raise CellTimeout("cell exceeded its wall-clock timeout of %gs"
+                          % (self.timeout,))
+
+    def _on_SIGPROF(self, signum, frame):
+        raise CellCPUTimeout("cell exceeded its CPU timeout of %gs"
+                             % (self.cpu_timeout,))
+
+
+class MemoryLimitExceeded(MemoryError):
+    """
+    Raised in the main thread when the worker's RSS goes over its limit while
+    a cell is executing.
+    """
+
+
+def set_address_space_limit(nbytes):
+    """
+    Sets the soft ``RLIMIT_AS`` to nbytes (capped at the hard limit).
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        nbytes = min(nbytes, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (nbytes, hard))
+
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+def get_rss():
+    """
+    Returns the current resident set size of this process in bytes.  Falls
+    back to the peak RSS where ``/proc`` isn't available.
+
+    EXAMPLES::
+
+        >>> get_rss() > 0
+        True
+    """
+    try:
+        f = open('/proc/self/statm')
+        try:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+MEM_OK = 'OK'
+MEM_WARN = 'WARN'
+MEM_BREACH = 'BREACH'
+
+
+class MemoryWatcher(object):
+    """
+    Watches the RSS of the worker from a background thread and sends a
+    :class:`msg.MemoryUsage` whenever the level changes.  While a cell is
+    executing (between :func:`arm` and :func:`disarm`), a breach sends
+    ``SIGUSR1`` to the process, whose handler raises
+    :class:`MemoryLimitExceeded` in the main thread.
+
+    The handler stays installed once armed and ignores the signal while
+    disarmed: the watching thread can send it just after :func:`disarm`,
+    and with the default handler back that would kill the worker.
+
+    EXAMPLES::
+
+        >>> import Queue
+        >>> q = Queue.Queue()
+        >>> w = MemoryWatcher(q, max_rss=1)
+        >>> w.check()
+        'BREACH'
+        >>> m = q.get(); (m.type == msg.MEMORY_USAGE, m['level'], m['limit'])
+        (True, 'BREACH', 1)
+        >>> w.check(); q.empty()
+        'BREACH'
+        True
+    """
+
+    def __init__(self, send_q, max_rss, warn_fraction=0.8, interval=0.5):
+        """
+        :param send_q: the :class:`Queue.Queue` to put messages onto.
+        :param max_rss: the RSS limit in bytes.
+        :param warn_fraction: fraction of max_rss that is reported as
+            ``'WARN'``.
+        :param interval: seconds between checks in the watching thread.
+        """
+        self._log = logging.getLogger(
+            "%s[pid=%s]" % (self.__class__.__name__, os.getpid()) )
+        self._send_q = send_q
+        self.max_rss = max_rss
+        self.warn_rss = int(max_rss * warn_fraction)
+        self.interval = interval
+        self.level = MEM_OK
+        self._armed = False
+        self._handling = False # the SIGUSR1 handler is installed
+
+    def start(self, shutdown_test):
+        """
+        Starts the watching thread, which exits when shutdown_test() is true.
+        """
+        thread.start_new_thread(self._watch_thread, (shutdown_test,))
+
+    def _watch_thread(self, shutdown_test):
+        try:
+            while not shutdown_test():
+                self.check()
+                _sleep(self.interval)
+        finally:
+            self._log.debug("[_watch_thread] Exiting.")
+
+    def check(self):
+        """
+        Checks the RSS now and returns the level.
+        """
+        rss = get_rss()
+        if rss > self.max_rss:
+            level = MEM_BREACH
+        elif rss > self.warn_rss:
+            level = MEM_WARN
+        else:
+            level = MEM_OK
+        if level != self.level:
+            self.level = level
+            self._send_q.put(msg.MemoryUsage(rss, self.max_rss, level))
+            if level == MEM_BREACH and self._armed:
+                os.kill(os.getpid(), signal.SIGUSR1)
+        return level
+
+    def arm(self):
+        """
+        Called from the main thread before a cell executes.
+        """
+        if not self._handling:
+            signal.signal(signal.SIGUSR1, self._on_SIGUSR1)
+            self._handling = True
+        self._armed = True
+        if self.level == MEM_BREACH:
+            # already over the limit, don't let the cell make it worse
+            os.kill(os.getpid(), signal.SIGUSR1)
+
+    def disarm(self):
+        """
+        Called from the main thread after a cell executes.
+        """
+        self._armed = False
+
+    def _on_SIGUSR1(self, signum, frame):
+        if self._armed:
+            raise MemoryLimitExceeded(
+                "worker RSS exceeded its limit of %d bytes" % (self.max_rss,))
+
+
+class OutputLimitExceeded(BaseException):
+    """
+    Raised in a cell that writes past its hard output limit when it was run
+    with ``output_interrupt``.
+    """
+
+
+class OutputLimiter(object):
+    """
+    The output budget of a cell, shared by its stdout and stderr.
+
+    * Past ``rate`` bytes a second (with a burst of a second's worth),
+      writes are dropped.
+    * Past ``soft_limit`` bytes in total, output is sampled: one line is let
+      through every ``sample_interval`` seconds.
+    * Past ``limit`` bytes in total, all output is dropped, and with
+      ``interrupt`` the write raises :class:`OutputLimitExceeded`.
+
+    Writes are let through or dropped a line at a time, so a ``print`` that
+    makes several writes isn't cut in the middle.  Nothing is said about
+    dropped output until :meth:`finish`, which sends one Stderr summing it
+    up.
+
+    EXAMPLES::
+
+        >>> import Queue
+        >>> q = Queue.Queue()
+        >>> lim = OutputLimiter(q, 3, soft_limit=20, limit=40,
+        ...                     sample_interval=3600)
+        >>> [lim.admit('line %d\\n' % (i,)) for i in range(8)]
+        [True, True, True, False, False, False, False, False]
+        >>> lim.finish(); print q.get()['bytes'],
+        [output limited: 21 of 56 bytes shown]
+        >>> lim = OutputLimiter(q, 3, limit=10, interrupt=True)
+        >>> lim.admit('x' * 11)
+        Traceback (most recent call last):
+            ...
+        OutputLimitExceeded: cell output exceeded 10 bytes
+    """
+
+    def __init__(self, send_q, sid, rate=None, soft_limit=None, limit=None,
+                 interrupt=False, sample_interval=1.0):
+        """
+        :param send_q: where the summary Stderr is put.
+        :param sid: the sid of the cell.
+        :param rate: bytes a second, or None (or 0) for no limit.
+        :param soft_limit: bytes after which output is sampled, or None.
+        :param limit: bytes after which output is dropped, or None.
+        :param interrupt: raise :class:`OutputLimitExceeded` in the writing
+            thread when limit is passed.
+        """
+        self._send_q = send_q
+        self._sid = sid
+        self.rate = rate
+        self.soft_limit = soft_limit
+        self.limit = limit
+        self.interrupt = interrupt
+        self.sample_interval = sample_interval
+        self.written = 0 # bytes the cell wrote
+        self.shown = 0 # bytes let through
+        self._lock = threading.Lock()
+        self._tokens = rate
+        self._refilled = _time()
+        self._next_sample = 0
+        self._line_start = True
+        self._passing = True
+
+    def admit(self, s):
+        """
+        Returns True if s should be sent.
+        """
+        with self._lock:
+            n = len(s)
+            self.written += n
+            if self.limit and self.written > self.limit:
+                self._passing = False
+                if self.interrupt and self.written - n <= self.limit:
+                    raise OutputLimitExceeded(
+                            "cell output exceeded %d bytes" % (self.limit,))
+                return False
+            now = _time()
+            if self.rate:
+                self._tokens = min(self.rate, self._tokens
+                                   + (now - self._refilled) * self.rate)
+                self._refilled = now
+            if self._line_start:
+                self._passing = self._decide(n, now)
+            self._line_start = s.endswith('\n')
+            if self._passing:
+                if self.rate:
+                    # the rest of a line may overdraw the bucket
+                    self._tokens -= n
+                self.shown += n
+            return self._passing
+
+    def _decide(self, n, now):
+        if self.rate and self._tokens < n:
+            return False
+        if self.soft_limit and self.written > self.soft_limit:
+            if now < self._next_sample:
+                return False
+            self._next_sample = now + self.sample_interval
+        return True
+
+    def finish(self):
+        """
+        Sends a Stderr saying how much output was dropped, if any.  Called
+        before the cell's Done.
+        """
+        if self.shown < self.written:
+            self._send_q.put(msg.Stderr(
+                    "[output limited: %d of %d bytes shown]\n"
+                    % (self.shown, self.written), _hsid=self._sid))
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -2,6 +2,7 @@ import logging
 import os
 from Queue import Queue
 import thread
+from threading import Event
 from traceback import format_exc
 
 from sageserver.msg.decodedmsg import CallbackMsgDecoder
@@ -11,21 +12,50 @@ class ShutdownNow(Exception):
     pass
 
 
+class HandOff(Exception):
+    """
+    Raised by a receive handler to stop receiving without shutting down.  Once
+    everything queued before it has been sent, the send thread calls
+    ``func(leftover)``, which hands the pipes to another process and exits.
+    leftover is what was read after the message that raised, which the
+    other process must decode first.  If ``func()`` returns False, receiving
+    starts again.
+    """
+    def __init__(self, func):
+        Exception.__init__(self)
+        self.func = func
+        self.leftover = ''
+
+
 class PipeMsgr(object):
-    def __init__(self, readfd, writefd):
+    def __init__(self, readfd, writefd, leftover=''):
+        """
+        :param leftover: bytes already read from readfd, which are decoded
+            before anything else.
+        """
         self._log = logging.getLogger(
             "%s[pid=%s]" % (self.__class__.__name__, os.getpid()) )
         self._readfd = readfd
         self._writefd = writefd
+        self._leftover = leftover
         self._recv_handlers = {}
         self._shutdown_test = lambda: True
         self._on_shutdown = lambda: False
         self._send_q = Queue()
+        self._send_done = Event()
         
     @property
     def recv_handlers(self):
         return self._recv_handlers
 
+    def reopen(self, leftover=''):
+        """
+        Returns a new :class:`PipeMsgr` on the same fds, e.g. in a forked
+        process that takes over from this one, with the bytes this one read
+        but didn't decode.
+        """
+        return self.__class__(self._readfd, self._writefd, leftover)
+
     def set_shutdown_test(self, shutdown_test):
         """
         shutdown_test should return True when we should stop receving/sending
@@ -46,15 +76,26 @@ class PipeMsgr(object):
         """
         Runs the io.
         """
-        thread.start_new_thread(self._recv_thread, ())
+        thread.start_new_thread(self._recv_thread, (self._leftover,))
+        self._leftover = ''
         thread.start_new_thread(self._send_thread, ())
         
-    def _recv_thread(self):
+    def wait_sent(self, timeout=None):
         """
-        Receives messages.
+        Waits up to timeout seconds for the send thread to send everything
+        queued before shutdown.  Returns True if it did.
         """
+        self._send_done.wait(timeout)
+        return self._send_done.is_set()
+
+    def _recv_thread(self, leftover=''):
+        """
+        Receives messages, the leftover bytes first.
+        """
+        decoder = CallbackMsgDecoder(self._recv_handlers, self._log)
         try:
-            decoder = CallbackMsgDecoder(self._recv_handlers, self._log)
+            if leftover:
+                decoder.feed(leftover)
             while not self._shutdown_test():
                 rbytes = os.read(self._readfd, 4096)
                 if not rbytes:
@@ -64,19 +105,30 @@ class PipeMsgr(object):
         except ShutdownNow:
             # raised by the Shutdown msg handler
             pass
+        except HandOff, e:
+            self._log.debug("[_recv_thread] Handing off.")
+            e.leftover = decoder.leftover()
+            self._send_q.put(e)
+            return
         except:
             self._log.error("[_recv_thread] %s", format_exc())
-        finally:
-            self._log.debug("[_recv_thread] Exiting.")
-            self._on_shutdown()
+        self._log.debug("[_recv_thread] Exiting.")
+        self._on_shutdown()
     
     def _send_thread(self):
         """
         Sends messages.
         """
         try:
-            while not self._shutdown_test():
+            # messages queued before shutdown (e.g. the Shutdown itself) are
+            # still sent
+            while not (self._shutdown_test() and self._send_q.empty()):
                 m = self._send_q.get()
+                if isinstance(m, HandOff):
+                    if not m.func(m.leftover):
+                        thread.start_new_thread(self._recv_thread,
+                                                (m.leftover,))
+                    continue
                 self._log.debug("[_send_thread] Got %r", m)
                 self._blocking_write(m.encode())
         except:
@@ -84,10 +136,11 @@ class PipeMsgr(object):
         finally:
             self._log.debug("[_send_thread] Exiting.")
             self._on_shutdown()
+            self._send_done.set()
             
     def _blocking_write(self, bytes):
         i = 0
-        while not self._shutdown_test() and i < len(bytes):
+        while i < len(bytes):
             i += os.write(self._writefd, buffer(bytes, i))
         
         
\ No newline at end of file
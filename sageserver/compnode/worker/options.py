@@ -0,0 +1,162 @@
+"""
+Worker command line options.
+
+The manager spawns workers with ``run_worker.py [options]``, so per-deployment
+settings are passed on the command line.  :func:`format_args` is used by the
+manager to build the argument list and :func:`parse_args` by the worker to
+read it back.
+"""
+
+from optparse import OptionParser
+
+
+def _option_parser():
+    p = OptionParser(usage="%prog [options]")
+    p.add_option('--rfd', type='int', default=3,
+                 help='fd to read messages from (default: 3)')
+    p.add_option('--wfd', type='int', default=4,
+                 help='fd to write messages to (default: 4)')
+    p.add_option('--timeout', type='float', default=None,
+                 help='default wall-clock timeout of a cell in seconds')
+    p.add_option('--cpu-timeout', dest='cpu_timeout', type='float',
+                 default=None,
+                 help='default CPU timeout of a cell in seconds')
+    p.add_option('--output-rate', dest='output_rate', type='int',
+                 default=None,
+                 help='default bytes of output a second a cell may send')
+    p.add_option('--output-soft-limit', dest='output_soft_limit',
+                 type='int', default=4 * 1024 * 1024,
+                 help='default bytes of output past which a cell\'s output '
+                      'is sampled (default: 4MB)')
+    p.add_option('--output-limit', dest='output_limit', type='int',
+                 default=64 * 1024 * 1024,
+                 help='default bytes of output past which a cell\'s output '
+                      'is dropped (default: 64MB)')
+    p.add_option('--output-interrupt', dest='output_interrupt',
+                 type='choice', choices=['True', 'False'], default='False',
+                 help='interrupt cells that pass --output-limit by default '
+                      '(default: False)')
+    p.add_option('--max-as', dest='max_as', type='int', default=None,
+                 help='address space limit of the worker in bytes')
+    p.add_option('--max-rss', dest='max_rss', type='int', default=None,
+                 help='resident set size limit of the worker in bytes')
+    p.add_option('--rss-warn', dest='rss_warn', type='float', default=0.8,
+                 help='fraction of --max-rss reported as a warning '
+                      '(default: 0.8)')
+    p.add_option('--rss-interval', dest='rss_interval', type='float',
+                 default=0.5,
+                 help='seconds between RSS checks (default: 0.5)')
+    p.add_option('--max-snapshots', dest='max_snapshots', type='int',
+                 default=4,
+                 help='snapshots kept before the oldest is dropped, 0 '
+                      'disables snapshots (default: 4)')
+    p.add_option('--cache-entries', dest='cache_entries', type='int',
+                 default=32,
+                 help='results of %cache=True cells kept in memory, 0 '
+                      'disables the cache (default: 32)')
+    p.add_option('--cache-dir', dest='cache_dir', default=None,
+                 help='directory that cached results pushed out of memory '
+                      'are written to, in a subdirectory of the worker\'s')
+    p.add_option('--max-procs', dest='max_procs', type='int', default=None,
+                 help='cells of a parallel batch run at once, and processes '
+                      'used by parallel_map (default: the number of CPUs)')
+    p.add_option('--progress-rate', dest='progress_rate', type='float',
+                 default=4.0,
+                 help='most progress() updates a cell sends a second '
+                      '(default: 4)')
+    p.add_option('--stdin-window', dest='stdin_window', type='int',
+                 default=65536,
+                 help='bytes of stdin that may be sent ahead of the reads '
+                      'of a cell, 0 disables read-ahead (default: 65536)')
+    p.add_option('--display-bytes', dest='display_bytes', type='int',
+                 default=65536,
+                 help='bytes of the repr of a result sent before the rest '
+                      'is left to be fetched (default: 65536)')
+    return p
+
+
+def parse_args(argv):
+    """
+    Returns an :class:`optparse.Values` instance.
+
+    EXAMPLES::
+
+        >>> o = parse_args(['--timeout', '30', '--cpu-timeout=10'])
+        >>> (o.rfd, o.wfd, o.timeout, o.cpu_timeout)
+        (3, 4, 30.0, 10.0)
+    """
+    opts, _ = _option_parser().parse_args(argv)
+    return opts
+
+
+def format_args(**opts):
+    """
+    Returns a list of command line arguments for the options in ``opts``.
+    Options that are None are left out.
+
+    EXAMPLES::
+
+        >>> format_args(timeout=30, cpu_timeout=None)
+        ['--timeout=30']
+        >>> parse_args(format_args(cpu_timeout=2.5)).cpu_timeout
+        2.5
+    """
+    args = []
+    for name in sorted(opts):
+        if opts[name] is not None:
+            args.append('--%s=%s' % (name.replace('_', '-'), opts[name]))
+    return args
+
+
+def worker_kwargs(opts):
+    """
+    Returns the keyword arguments for :class:`worker.Worker` from the parsed
+    options.
+
+    EXAMPLES::
+
+        >>> kw = worker_kwargs(parse_args(['--max-rss=1000', '--timeout=5']))
+        >>> sorted(kw.pop('exec_defaults').items())
+        ...     #doctest:+NORMALIZE_WHITESPACE
+        [('cpu_timeout', None), ('output_interrupt', False),
+         ('output_limit', 67108864), ('output_rate', None),
+         ('output_soft_limit', 4194304), ('timeout', 5.0)]
+        >>> sorted(kw.items()) #doctest:+NORMALIZE_WHITESPACE
+        [('cache_dir', None), ('cache_entries', 32), ('display_bytes', 65536),
+         ('max_as', None), ('max_procs', None), ('max_rss', 1000),
+         ('max_snapshots', 4), ('progress_rate', 4.0), ('rss_interval', 0.5),
+         ('rss_warn', 0.8), ('stdin_window', 65536)]
+    """
+    return {
+        'exec_defaults': exec_defaults(opts),
+        'max_as': opts.max_as,
+        'max_rss': opts.max_rss,
+        'rss_warn': opts.rss_warn,
+        'rss_interval': opts.rss_interval,
+        'max_snapshots': opts.max_snapshots,
+        'cache_entries': opts.cache_entries,
+        'cache_dir': opts.cache_dir,
+        'max_procs': opts.max_procs,
+        'progress_rate': opts.progress_rate,
+        'stdin_window': opts.stdin_window,
+        'display_bytes': opts.display_bytes,
+    }
+
+
+def exec_defaults(opts):
+    """
+    Returns the :class:`msg.ExecCell` defaults from the parsed options.
+    """
+    return {
+        'timeout': opts.timeout,
+        'cpu_timeout': opts.cpu_timeout,
+        'output_rate': opts.output_rate,
+        'output_soft_limit': opts.output_soft_limit,
+        'output_limit': opts.output_limit,
+        'output_interrupt': opts.output_interrupt == 'True',
+    }
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,659 @@
+"""
+Running independent cells at the same time in forked children.
+
+Each child is forked from the main thread, so it sees the namespace
+copy-on-write.  It executes its cell with its send queue replaced by a
+:class:`FrameWriter`, which pickles frames onto a pipe:
+
+    ---------------------------------
+    | length (4) | pickled frame ... |
+    ---------------------------------
+
+A frame is either ``('m', encoded message)`` for output, or
+``('r', ok, values, failed)`` with the pickled names the cell assigned and the
+names that wouldn't pickle.  The Done of a cell comes after its ``'r'``
+frame.  The parent forwards the output of the cells in order, so the
+output of one cell is streamed while the output of later cells is buffered
+until it's done.
+
+:class:`ParallelMap` uses the same frames to split the items of a single
+``parallel_map(f, items)`` call over forked children.
+"""
+
+import ast
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
+import os
+import select
+import signal
+from struct import pack, unpack, calcsize
+import sys
+import threading
+from time import time as _time
+import traceback
+from types import ModuleType
+
+from dataflow import global_names, parse_cell
+from queuefile import QueueFileOut
+import sageserver.msg as msg
+from sageserver.util import JoinBuffer
+
+_LEN_FMT = "<I"
+_LEN_LEN = calcsize(_LEN_FMT)
+
+# the parent waits on its children in steps of this many seconds, because
+# a blocking select() can't be interrupted with thread.interrupt_main()
+_POLL_INTERVAL = 0.25
+
+# nodes whose results are usually unpicklable, or that need the worker's
+# pipes
+_SERIAL_NODES = (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.ClassDef,
+                 ast.Lambda, ast.Global, ast.Exec, ast.Yield)
+_SERIAL_NAMES = frozenset(['input', 'raw_input', 'globals', 'locals',
+                           'vars', 'eval', 'execfile'])
+# values that are new objects, which a cell may change in place
+_FRESH_NODES = (ast.List, ast.Dict, ast.Set, ast.ListComp, ast.DictComp,
+                ast.SetComp)
+
+
+def parallel_safe(tree, modules=()):
+    """
+    Returns True if a cell can run in a child.  Cells that define functions
+    or classes, import, or read stdin run in the worker itself, and so do
+    cells that change an object they didn't make in place (see
+    :func:`mutated_names`), since a child's changes are lost.
+
+    :param modules: the global names bound to modules, whose methods are
+        taken to leave them alone.
+
+    EXAMPLES::
+
+        >>> parallel_safe(ast.parse('x = sum(range(10 ** 6))'))
+        True
+        >>> parallel_safe(ast.parse('import os'))
+        False
+        >>> parallel_safe(ast.parse('s = raw_input()'))
+        False
+        >>> parallel_safe(ast.parse('a[0] = 1'))
+        False
+        >>> parallel_safe(ast.parse('x = np.dot(a, b)'), ['np'])
+        True
+        >>> parallel_safe(ast.parse('t = []\\nfor i in r: t.append(f(i))'))
+        True
+    """
+    for node in ast.walk(tree):
+        if isinstance(node, _SERIAL_NODES):
+            return False
+        if isinstance(node, ast.Name) and node.id in _SERIAL_NAMES:
+            return False
+    reads, _ = global_names(tree)
+    made = _fresh_names(tree) - reads
+    return mutated_names(tree, modules) <= made
+
+
+def mutated_names(tree, modules=()):
+    """
+    Returns the names of the objects the module-level ast tree changes in
+    place: by assigning or deleting an item or attribute, or by calling a
+    method (which may or may not change it), unless the name is one of
+    modules.  Only changes made through a name are seen, not those of a
+    function the object is passed to.
+
+    EXAMPLES::
+
+        >>> def names(s, modules=()):
+        ...     return sorted(mutated_names(ast.parse(s), modules))
+        >>> names('a[0] = 1\\nb.x += 1\\ndel c.y[2]')
+        ['a', 'b', 'c']
+        >>> names('d.append(1)\\nx = e.f.g(2)')
+        ['d', 'e']
+        >>> names('x = math.sqrt(a[0])', ['math'])
+        []
+    """
+    names = set()
+    for node in ast.walk(tree):
+        if (isinstance(node, (ast.Subscript, ast.Attribute))
+                and not isinstance(node.ctx, ast.Load)):
+            target = node.value
+        elif (isinstance(node, ast.Call)
+                and isinstance(node.func, ast.Attribute)):
+            target = node.func.value
+        else:
+            continue
+        while isinstance(target, (ast.Subscript, ast.Attribute)):
+            target = target.value
+        if isinstance(target, ast.Name) and target.id not in modules:
+            names.add(target.id)
+    return names
+
+
+def _fresh_names(tree):
+    """
+    Returns the names the module-level ast tree only binds to new lists,
+    dicts and sets.
+    """
+    fresh = set()
+    targets = set()
+    for node in ast.walk(tree):
+        if (isinstance(node, ast.Assign)
+                and isinstance(node.value, _FRESH_NODES)):
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    fresh.add(target.id)
+                    targets.add(target)
+    for node in ast.walk(tree):
+        if (isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store)
+                and node not in targets):
+            fresh.discard(node.id)
+    return fresh
+
+
+def independent_prefix(sources, globals_=None):
+    """
+    Returns how many of the leading cell sources can run at the same time:
+    each is :func:`parallel_safe` and none of them reads or writes a name
+    that another one writes.
+
+    :param globals_: the namespace the cells run in, to tell the modules
+        in it apart.
+
+    EXAMPLES::
+
+        >>> independent_prefix(['a = f(1)', 'b = f(2)', 'c = a + b'])
+        2
+        >>> independent_prefix(['a = 1', 'a = 2'])
+        1
+        >>> independent_prefix(['import os', 'a = 1'])
+        0
+        >>> independent_prefix(['a = f(1)', 'l.append(2)'])
+        1
+    """
+    modules = ()
+    if globals_ is not None:
+        modules = frozenset(name for name, value in globals_.iteritems()
+                            if isinstance(value, ModuleType))
+    all_reads = set()
+    all_writes = set()
+    n = 0
+    for source in sources:
+        try:
+            tree = parse_cell(source)
+        except SyntaxError:
+            break
+        if not parallel_safe(tree, modules):
+            break
+        reads, writes = global_names(tree)
+        if (not writes.isdisjoint(all_reads)
+                or not writes.isdisjoint(all_writes)
+                or not reads.isdisjoint(all_writes)):
+            break
+        all_reads.update(reads)
+        all_writes.update(writes)
+        n += 1
+    return n
+
+
+class Encoded(object):
+    """
+    A message that's already encoded, to put on a send queue.
+    """
+
+    def __init__(self, bytes):
+        self._bytes = bytes
+
+    def encode(self):
+        return self._bytes
+
+    def __repr__(self):
+        return '<Encoded %d bytes>' % (len(self._bytes),)
+
+
+class FrameWriter(object):
+    """
+    The send queue of a cell running in a child.
+    """
+
+    def __init__(self, fd):
+        self._fd = fd
+        self._done = None
+        # progress() puts from a timer thread
+        self._lock = threading.Lock()
+
+    def put(self, m):
+        if m.type == msg.DONE:
+            # held back until the results are written
+            self._done = m
+        else:
+            self._write(('m', m.encode()))
+
+    def result(self, ok, globals_, names):
+        """
+        Writes the values of names in globals_, then the Done.
+        """
+        values = {}
+        failed = []
+        for name in names:
+            try:
+                values[name] = dumps(globals_[name], HIGHEST_PROTOCOL)
+            except Exception:
+                failed.append(name)
+        self._write(('r', ok, values, failed))
+        if self._done is not None:
+            self._write(('m', self._done.encode()))
+
+    def _write(self, frame):
+        with self._lock:
+            _write_frame(self._fd, frame)
+
+
+def _write_frame(fd, frame):
+    data = dumps(frame, HIGHEST_PROTOCOL)
+    data = pack(_LEN_FMT, len(data)) + data
+    i = 0
+    while i < len(data):
+        i += os.write(fd, buffer(data, i))
+
+
+class FrameReader(object):
+    """
+    Reads frames from a pipe.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.frames = [] # received but not handled yet
+        self.eof = False
+        # the reads are joined once a frame is whole, not on every read
+        self._buf = JoinBuffer()
+        self._n = None # length of the frame being read, once known
+
+    def read(self):
+        """
+        Reads what's available, appending whole frames to ``self.frames``.
+        """
+        rbytes = os.read(self.fd, 65536)
+        if not rbytes:
+            self.eof = True
+            return
+        self._buf.extend(rbytes)
+        while True:
+            if self._n is None:
+                hdr = self._buf.popleft(_LEN_LEN)
+                if hdr is None:
+                    break
+                self._n, = unpack(_LEN_FMT, hdr)
+            body = self._buf.popleft(self._n)
+            if body is None:
+                break
+            self._n = None
+            self.frames.append(loads(body))
+
+    def next_frame(self):
+        """
+        Blocks until a frame is read and returns it, or None on EOF.
+        """
+        while not self.frames:
+            if self.eof:
+                return None
+            self.read()
+        return self.frames.pop(0)
+
+
+class CellProcess(FrameReader):
+    """
+    The parent's handle on a child running a cell.
+    """
+
+    def __init__(self, pid, fd):
+        FrameReader.__init__(self, fd)
+        self.pid = pid
+        self.result = None # (ok, values, failed) once received
+
+    def close(self, kill=False):
+        if kill:
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        os.close(self.fd)
+        try:
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+
+
+def fork_cell(run):
+    """
+    Forks a child that calls ``run(writer)`` with a :class:`FrameWriter` and
+    exits.  Must be called from the main thread.  Returns a
+    :class:`CellProcess`.
+    """
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid:
+        os.close(w)
+        return CellProcess(pid, r)
+    status = 0
+    try:
+        os.close(r)
+        run(FrameWriter(w))
+    except BaseException:
+        status = 1
+    finally:
+        os._exit(status)
+
+
+def run_parallel(runs, max_procs, send_q, on_result):
+    """
+    Runs each of ``runs`` (see :func:`fork_cell`) in a child, at most
+    max_procs at a time, and forwards their output to send_q in order.
+
+    ``on_result(i, ok, values, failed)`` is called with the unpickled values
+    of ``runs[i]`` when they arrive, before its Done is forwarded.  A child
+    that dies without a result is reported as ``(False, {}, [])``.
+
+    On KeyboardInterrupt the children are killed and the indexes of the runs
+    whose Done wasn't forwarded are returned.  Otherwise returns ``[]``.
+    """
+    procs = [None] * len(runs)
+    next_i = 0 # next run to fork
+    out_i = 0 # run whose output is being forwarded
+    running = []
+    try:
+        while out_i < len(runs):
+            while next_i < len(runs) and len(running) < max_procs:
+                procs[next_i] = fork_cell(runs[next_i])
+                running.append(procs[next_i])
+                next_i += 1
+            rlist, _, _ = select.select([p.fd for p in running], [], [],
+                                        _POLL_INTERVAL)
+            for p in running[:]:
+                if p.fd in rlist:
+                    p.read()
+                    if p.eof:
+                        running.remove(p)
+                        p.close()
+            # forward in order, only the current run's frames go out
+            while out_i < len(runs) and procs[out_i] is not None:
+                p = procs[out_i]
+                for frame in p.frames:
+                    if frame[0] == 'r':
+                        p.result = frame[1:]
+                        on_result(out_i, *_unpickle(p.result))
+                    else:
+                        send_q.put(Encoded(frame[1]))
+                p.frames = []
+                if not p.eof:
+                    break
+                if p.result is None:
+                    on_result(out_i, False, {}, [])
+                out_i += 1
+    except KeyboardInterrupt:
+        for p in running:
+            p.close(kill=True)
+        return range(out_i, len(runs))
+    return []
+
+
+def _unpickle(result):
+    ok, values, failed = result
+    unpickled = {}
+    for name, data in values.iteritems():
+        try:
+            unpickled[name] = loads(data)
+        except Exception:
+            failed.append(name)
+    return ok, unpickled, failed
+
+
+class ParallelError(Exception):
+    """
+    Raised by :func:`parallel_map` when a child fails.  The message has the
+    child's traceback.
+    """
+
+
+def chunk_size(per_item, remaining, n_procs, target=0.2):
+    """
+    Returns how many items to hand a child next.
+
+    :param per_item: the seconds an item has taken so far, or None before
+        any chunk has come back.
+    :param remaining: the number of items not handed out yet.
+    :param target: the seconds a chunk should take.
+
+    Chunks are sized to take about ``target`` seconds, so fast functions
+    aren't dominated by the round trips and slow ones aren't stuck behind a
+    big chunk, and shrink towards the end so that the children finish
+    together.
+
+    EXAMPLES::
+
+        >>> chunk_size(None, 1000, 4)   # probing
+        1
+        >>> chunk_size(0.001, 1000, 4)  # 200 items take 0.2s
+        125
+        >>> chunk_size(0.001, 100000, 4)
+        200
+        >>> chunk_size(1.0, 1000, 4)
+        1
+    """
+    if per_item is None:
+        return 1
+    n = int(target / per_item) if per_item > 0 else remaining
+    return max(1, min(n, remaining // (2 * n_procs)))
+
+
+class ParallelMap(object):
+    """
+    ``parallel_map`` and ``parallel_for`` in the exec globals.
+
+    The items are split over up to ``max_procs`` children forked from the
+    cell, so the function and the items are inherited rather than pickled;
+    only the results of :func:`map` are.  The children are handed chunks of
+    indexes (see :func:`chunk_size`) and send back the results, which are
+    put in order as they arrive, and anything they print, which is written
+    to the cell's output as it arrives.
+
+    ``progress(done, total)`` is called at most every ``progress_interval``
+    seconds while the items are processed, and once at the end.
+    """
+
+    def __init__(self, max_procs, chunk_seconds=0.2, progress=None,
+                 progress_interval=0.25):
+        """
+        :param progress: the default progress callback, or None.
+        """
+        self.max_procs = max_procs
+        self.chunk_seconds = chunk_seconds
+        self.progress = progress
+        self.progress_interval = progress_interval
+
+    def map(self, f, iterable, procs=None, progress=None):
+        """
+        parallel_map(f, iterable, procs=None, progress=None)
+
+        Returns ``[f(x) for x in iterable]``, computed in up to procs
+        processes (by default one for each CPU).  The results must pickle.
+        Anything f does to the namespace is lost.
+        """
+        return self._run(f, iterable, True, procs, progress)
+
+    def for_each(self, f, iterable, procs=None, progress=None):
+        """
+        parallel_for(f, iterable, procs=None, progress=None)
+
+        Calls ``f(x)`` for each x in iterable in up to procs processes (by
+        default one for each CPU), for what f prints.  The results are
+        thrown away, and anything f does to the namespace is lost.
+        """
+        self._run(f, iterable, False, procs, progress)
+
+    def _run(self, f, iterable, collect, procs, progress):
+        items = (iterable if isinstance(iterable, (list, tuple))
+                 else list(iterable))
+        if progress is None:
+            progress = self.progress
+        n = len(items)
+        n_procs = min(n, procs or self.max_procs)
+        if n_procs <= 1:
+            results = []
+            for i, item in enumerate(items):
+                r = f(item)
+                if collect:
+                    results.append(r)
+                if progress is not None:
+                    progress(i + 1, n)
+            return results if collect else None
+
+        results = []
+        chunks = {} # start -> results of the chunks that came back early
+        children = []
+        next_start = 0
+        per_item = None
+        done = 0
+        last_progress = 0
+        idle = []
+        try:
+            for _ in xrange(n_procs):
+                children.append(_MapChild.fork(f, items, collect))
+                idle.append(children[-1])
+            while done < n:
+                while idle and next_start < n:
+                    size = chunk_size(per_item, n - next_start, n_procs,
+                                      self.chunk_seconds)
+                    idle.pop().send((next_start, next_start + size))
+                    next_start += size
+                rlist, _, _ = select.select([c.fd for c in children], [], [],
+                                            _POLL_INTERVAL)
+                for c in children:
+                    if c.fd not in rlist:
+                        continue
+                    c.read()
+                    for frame in c.frames:
+                        if frame[0] == 'o':
+                            _output(frame[1], frame[2])
+                        elif frame[0] == 'c':
+                            _, start, count, data, seconds = frame
+                            if collect:
+                                chunks[start] = loads(data)
+                            per_item = (seconds / count if per_item is None
+                                        else (per_item + seconds / count) / 2)
+                            done += count
+                            idle.append(c)
+                        else:
+                            raise ParallelError(frame[1])
+                    c.frames = []
+                    if c.eof and c not in idle:
+                        raise ParallelError("a child exited")
+                while len(results) in chunks:
+                    results.extend(chunks.pop(len(results)))
+                if (progress is not None
+                        and _time() - last_progress > self.progress_interval):
+                    last_progress = _time()
+                    progress(done, n)
+            if progress is not None:
+                progress(n, n)
+        finally:
+            for c in children:
+                c.stop(kill=c not in idle)
+        return results if collect else None
+
+
+class _MapChild(CellProcess):
+    """
+    The parent's handle on a child of :class:`ParallelMap`.
+    """
+
+    def __init__(self, pid, fd, cmd_fd):
+        CellProcess.__init__(self, pid, fd)
+        self.cmd_fd = cmd_fd
+
+    @classmethod
+    def fork(cls, f, items, collect):
+        cmd_r, cmd_w = os.pipe()
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid:
+            os.close(cmd_r)
+            os.close(w)
+            return cls(pid, r, cmd_w)
+        status = 0
+        try:
+            os.close(cmd_w)
+            os.close(r)
+            _map_child(f, items, collect, FrameReader(cmd_r), w)
+        except BaseException:
+            status = 1
+        finally:
+            os._exit(status)
+
+    def send(self, chunk):
+        _write_frame(self.cmd_fd, chunk)
+
+    def stop(self, kill=False):
+        """
+        Tells the child to exit, or kills it.
+        """
+        if not kill:
+            try:
+                self.send(None)
+            except OSError:
+                kill = True
+        os.close(self.cmd_fd)
+        self.close(kill)
+
+
+def _map_child(f, items, collect, cmds, fd):
+    sys.stdout = QueueFileOut(_OutputFrames(fd), msg.Stdout, 0)
+    sys.stderr = QueueFileOut(_OutputFrames(fd), msg.Stderr, 0)
+    while True:
+        chunk = cmds.next_frame()
+        if chunk is None:
+            return
+        start, stop = chunk
+        t = _time()
+        results = []
+        for i in xrange(start, stop):
+            try:
+                results.append(f(items[i]))
+            except Exception:
+                _write_frame(fd, ('e', "item %d raised:\n%s"
+                                       % (i, traceback.format_exc())))
+                return
+        seconds = _time() - t
+        data = None
+        if collect:
+            try:
+                data = dumps(results, HIGHEST_PROTOCOL)
+            except Exception, e:
+                _write_frame(fd, ('e', "the results of items %d to %d "
+                                       "can't be pickled: %s"
+                                       % (start, stop - 1, e)))
+                return
+        _write_frame(fd, ('c', start, stop - start, data, seconds))
+
+
+class _OutputFrames(object):
+    """
+    The send queue of the stdout and stderr of a :class:`ParallelMap`
+    child.
+    """
+
+    def __init__(self, fd):
+        self._fd = fd
+
+    def put(self, m):
+        _write_frame(self._fd, ('o', m.type, m['bytes']))
+
+
+def _output(msg_type, bytes):
+    """
+    Writes output from a child to the cell's stdout or stderr.
+    """
+    f = sys.stdout if msg_type == msg.STDOUT else sys.stderr
+    f.write(bytes)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
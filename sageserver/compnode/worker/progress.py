@@ -0,0 +1,106 @@
+"""
+Progress reporting from cells.
+
+``progress(fraction, label)`` in the exec globals sends a
+:class:`msg.Progress` for the running cell.  A Progress replaces the cell's
+previous one, so only the latest value matters: calls that come faster than
+``max_rate`` per second just replace the pending value, which is sent when
+the interval is up (by a timer thread if the cell doesn't call again) or
+when the cell finishes.
+"""
+
+import threading
+from time import time as _time
+
+import sageserver.msg as msg
+
+
+class ProgressReporter(object):
+    """
+    The ``progress`` function of the exec globals.
+
+    EXAMPLES::
+
+        >>> import Queue
+        >>> q = Queue.Queue()
+        >>> progress = ProgressReporter(max_rate=1)
+        >>> progress(0.1)           # not bound to a cell, dropped
+        >>> progress.bind(q, 3)
+        >>> for i in range(1, 11):
+        ...     progress(i / 10.0, 'step %d' % (i,))
+        >>> progress.finish()
+        >>> [(m['fraction'], m['label'], m.hdr.sid) for m in q.queue]
+        [(0.1, 'step 1', 3), (1.0, 'step 10', 3)]
+    """
+
+    def __init__(self, max_rate=4.0):
+        """
+        :param max_rate: the most Progress messages sent a second.
+        """
+        self.interval = 1.0 / max_rate
+        self._lock = threading.Lock()
+        self._send_q = None
+        self._sid = None
+        self._pending = None # (fraction, label) not sent yet
+        self._last_sent = 0
+        self._timer = None
+
+    def __call__(self, fraction, label=''):
+        """
+        progress(fraction, label='')
+
+        Shows how far along the cell is, ``fraction`` going from 0.0 to
+        1.0.  Calls from the function of a ``parallel_map`` are ignored.
+        """
+        fraction = min(1.0, max(0.0, float(fraction)))
+        with self._lock:
+            if self._send_q is None:
+                return
+            self._pending = (fraction, str(label))
+            wait = self._last_sent + self.interval - _time()
+            if wait <= 0:
+                self._send_pending()
+            elif self._timer is None:
+                self._timer = threading.Timer(wait, self._on_timer)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def bind(self, send_q, sid):
+        """
+        Reports progress of the cell sid from now on.
+        """
+        with self._lock:
+            self._send_q = send_q
+            self._sid = sid
+            self._pending = None
+            self._last_sent = 0
+
+    def finish(self):
+        """
+        Sends the pending value, if any, and stops reporting until the next
+        :meth:`bind`.  Called before the cell's Done.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._send_q is not None and self._pending is not None:
+                self._send_pending()
+            self._send_q = None
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+            if self._send_q is not None and self._pending is not None:
+                self._send_pending()
+
+    def _send_pending(self):
+        fraction, label = self._pending
+        self._pending = None
+        self._last_sent = _time()
+        self._send_q.put(msg.Progress(fraction, label, _hsid=self._sid))
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
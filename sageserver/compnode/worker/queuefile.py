@@ -1,8 +1,17 @@
+import Queue
+import signal
 from io import IOBase
 
 import sageserver.msg as msg
 from sageserver.util import JoinBuffer
 
+# seconds a blocked read waits on the queue at a time while a wall-clock
+# timer is armed.  A get() without a timeout is a lock acquire that signals
+# can't interrupt, so a cell's timeout (limits.CellTimer) would never fire
+# while it waits for stdin.  A timed get() sleeps in short steps instead,
+# so it's only used when there's a timer to wait for.
+_POLL = 1.0
+
 class QueueFileOut(IOBase):
     r"""
     Puts :func:`write` or :func:`writelines` data onto a queue.  Replaces
@@ -17,24 +26,27 @@ class QueueFileOut(IOBase):
         >>> q.qsize()
         2
         >>> m1 = q.get(); m2 = q.get()
-        >>> m1
-        Stdout('Hello World!', id=1)
-        >>> m2
-        Stdout('\n', id=1)
+        >>> m1['bytes'], m1.hdr.sid
+        ('Hello World!', 1)
+        >>> m2['bytes']
+        '\n'
     """
         
-    def __init__(self, send_q, msg_cls, sid):
+    def __init__(self, send_q, msg_cls, sid, limiter=None):
         """
         :param send_q: a :class:`Queue.Queue` object to put Msgs onto.
         :param msg_cls: a subclass of :class:`msg.MsgWithId`, usually
             :class:`Stdin` or :class:`Stderr`.
         :param id: an unsigned integer to pass to :class:`msg.MsgWithId`.
+        :param limiter: a :class:`limits.OutputLimiter` that decides which
+            writes are sent, or None to send them all.
         :raises: ValueError if msg_cls is not a subclass of
             :class:`msg.MsgWithId` or id is less than zero.
         """
         self._send_q = send_q
         self._msg_cls = msg_cls
         self._sid = sid
+        self._limiter = limiter
         
     @property
     def encoding(self):
@@ -55,6 +67,8 @@ class QueueFileOut(IOBase):
     def write(self, s):
         if not isinstance(s, basestring):
             s = str(s)
+        if self._limiter is not None and not self._limiter.admit(s):
+            return
         self._send_q.put(self._msg_cls(s, _hsid=self._sid))
         
     def writelines(self, iterable):
@@ -68,28 +82,26 @@ class QueueFileOut(IOBase):
 
 class QueueFileIn(IOBase):
     r"""
-    Reads data from a queue to return to :func:`read` calls.
+    Reads data from a queue to return to :func:`read` and
+    :func:`readline` calls.
 
     EXAMPLES:
         >>> import Queue
         >>> recv_q = Queue.Queue()
         >>> send_q = Queue.Queue()
-        >>> def need_recv_func(id, size):
-        ...     recv_q.put(msg.Stdin('Hello World!', id=3))
-        ...     recv_q.put(msg.Stdin(id=3))
-        >>> f = QueueFileIn(recv_q, send_q, 2, need_recv_func)
-        >>> f.read()
-        'Hello World!'
-        >>> send_q.qsize()
-        2
-        >>> m1 = send_q.get(); m2 = send_q.get()
-        >>> m1
-        Stdin('Hello World!', id=2)
-        >>> m2
-        Stdin(id=2)
+        >>> recv_q.put(msg.Stdin('Hello\nWorld!\n', _hsid=3))
+        >>> recv_q.put(msg.Stdin('Bye', _hsid=3))
+        >>> recv_q.put(msg.Stdin('', _hsid=3))
+        >>> f = QueueFileIn(recv_q, send_q, 2)
+        >>> f.readline()
+        'Hello\n'
+        >>> list(f)
+        ['World!\n', 'Bye']
+        >>> [(m['bytes'], m.hdr.sid) for m in send_q.queue]
+        [('Hello\n', 2), ('World!\n', 2), ('Bye', 2), ('', 2)]
     """
     
-    def __init__(self, recv_q, send_q, sid, echo_stdin=True):
+    def __init__(self, recv_q, send_q, sid, echo_stdin=True, window=0):
         """
         :param recv_q: a :class:`Queue.Queue` object to get Msg objects
             from. If the received Msg object is not an instance of
@@ -104,6 +116,14 @@ class QueueFileIn(IOBase):
         :param id: an integer >= to pass to need_recv_func.
         :param need_recv_func: A function (id, size) to call when read is
             called and there's nothing in the buffer to send.
+        :param window: how many bytes of Stdin may be sent ahead of the
+            reads, 0 to only send what a blocked read asks for.
+
+        The window is granted as credit in the ``window`` field of
+        :class:`msg.NeedStdin`: with the first blocked read, and then with
+        ``NeedStdin(0, n)`` whenever reads have freed half of it.  Stdin
+        that was sent ahead waits in recv_q, so reads only block and send
+        a NeedStdin when it's empty.
         """
         self._recv_q = recv_q
         self._send_q = send_q
@@ -111,6 +131,11 @@ class QueueFileIn(IOBase):
         self._echo_stdin = echo_stdin
         self._jbuf = JoinBuffer()
         self._waiting = False
+        self._window = window
+        self._granted = 0 # granted bytes that haven't been received yet
+        # an EOF that came after the bytes last returned, the next read
+        # returns ''
+        self._eof_pending = False
 
     @property
     def encoding(self):
@@ -130,7 +155,7 @@ class QueueFileIn(IOBase):
     @property
     def waiting(self):
         """
-        True if currently wiating for something over the queue.
+        True if blocked waiting for Stdin over the queue.
         """
         return self._waiting
         
@@ -142,13 +167,51 @@ class QueueFileIn(IOBase):
         :raises: KeyboardInterrupt if we received a :class:`msg.Interrupt`.
         """
         if self._recv_q.empty():
-            self._send_q.put(msg.NeedStdin(size, _hsid=self._sid))
-        m = self._recv_q.get()
+            self._send_q.put(msg.NeedStdin(size, self._grant(),
+                                           _hsid=self._sid))
+            self._waiting = True
+            try:
+                m = self._get()
+            finally:
+                self._waiting = False
+        else:
+            m = self._get()
         if m.type == msg.INTERRUPT:
             raise KeyboardInterrupt
         if not m.type == msg.STDIN:
             return ''
-        return m.bytes
+        bytes = m['bytes']
+        if isinstance(bytes, unicode):
+            # BSON strings are decoded as unicode
+            bytes = bytes.encode('utf-8')
+        self._granted = max(0, self._granted - len(bytes))
+        return bytes
+
+    def _get(self):
+        while signal.getitimer(signal.ITIMER_REAL)[0]:
+            try:
+                return self._recv_q.get(True, _POLL)
+            except Queue.Empty:
+                pass
+        return self._recv_q.get()
+
+    def _grant(self):
+        """
+        Returns how much more of the window can be granted, and counts it
+        as granted.
+        """
+        n = max(0, self._window - self._granted - len(self._jbuf))
+        self._granted += n
+        return n
+
+    def _regrant(self):
+        """
+        Grants the window again once half of it has been read.
+        """
+        if (self._window and self._window - self._granted - len(self._jbuf)
+                >= self._window // 2):
+            self._send_q.put(msg.NeedStdin(0, self._grant(),
+                                           _hsid=self._sid))
         
     def _send_stdin(self, bytes, wasEOF=True):
         """
@@ -156,15 +219,15 @@ class QueueFileIn(IOBase):
         wasEOF is true.
         """
         if self._echo_stdin:
-            self._send_q.put(msg.Stdin(bytes, _hsid=self._sid))
+            if bytes:
+                self._send_q.put(msg.Stdin(bytes, _hsid=self._sid))
             if wasEOF:
                 self._send_q.put(msg.Stdin('', _hsid=self._sid))
     
     def read(self, size=-1):
-        if size == 0:
+        if size == 0 or self._take_eof():
             return b''
         jbuf = self._jbuf
-        self._waiting = True
         if size < 0:
             while True:
                 rbytes = self._recv_stdin(-1)
@@ -173,7 +236,6 @@ class QueueFileIn(IOBase):
                 jbuf.extend(rbytes)
             r = jbuf.popall()
             self._send_stdin(r, True)
-            self._waiting = False
             return r
         # size > 0:
         wasEOF = False
@@ -185,11 +247,75 @@ class QueueFileIn(IOBase):
             jbuf.extend(rbytes)
         if wasEOF:
             r = jbuf.popall()
+            self._eof_pending = bool(r)
         else:
             r = jbuf.popleft(size)
         self._send_stdin(r, wasEOF)
-        self._waiting = False
-        return r            
+        if not wasEOF:
+            self._regrant()
+        return r
+
+    def _take_eof(self):
+        eof, self._eof_pending = self._eof_pending, False
+        return eof
+
+    def readline(self, size=-1):
+        """
+        Reads up to and including the next newline, or size bytes.  Echoes
+        the line as a single Stdin.
+        """
+        if size == 0 or self._take_eof():
+            return b''
+        jbuf = self._jbuf
+        wasEOF = False
+        scanned = 0 # no newline before this
+        while True:
+            i = jbuf.find('\n', scanned)
+            if i >= 0:
+                n = i + 1
+                break
+            if 0 < size <= len(jbuf):
+                n = size
+                break
+            scanned = len(jbuf)
+            rbytes = self._recv_stdin(size - len(jbuf) if size > 0 else -1)
+            if not rbytes:
+                wasEOF = True
+                n = len(jbuf)
+                self._eof_pending = n > 0
+                break
+            jbuf.extend(rbytes)
+        if size > 0:
+            n = min(n, size)
+        r = jbuf.popleft(n)
+        self._send_stdin(r, wasEOF)
+        if not wasEOF:
+            self._regrant()
+        return r
+
+    def readlines(self, hint=-1):
+        """
+        Returns a list of the lines up to EOF, or of the lines up to the one
+        that takes the total past hint bytes.
+        """
+        lines = []
+        total = 0
+        while hint <= 0 or total < hint:
+            line = self.readline()
+            if not line:
+                break
+            lines.append(line)
+            total += len(line)
+        return lines
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
 
 if __name__ == '__main__':
     import doctest
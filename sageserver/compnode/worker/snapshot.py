@@ -0,0 +1,158 @@
+"""
+Fork-based namespace snapshots.
+
+A snapshot is a forked copy of the worker that does nothing but wait on a
+control pipe, so the kernel shares its memory with the live worker
+copy-on-write until either of them changes it.  Rolling back promotes the
+snapshot: it takes over the message pipes and carries on as the worker, with
+the namespace exactly as it was when the snapshot was taken.
+
+The control pipe carries one command::
+
+    ----------------------------------------------------------
+    | cmd (1) | sid (2) | last_id (4) | n (4) | leftover (n) |
+    ----------------------------------------------------------
+
+where cmd is ``'p'`` (promote) or ``'k'`` (drop), sid is the stream id of
+the :class:`msg.Rollback` to reply to, last_id is the last snapshot id
+handed out by the worker being replaced and leftover is what that worker
+read from the message pipe after the Rollback.  EOF on the pipe is a
+drop.
+"""
+
+import logging
+import os
+from struct import pack, unpack, calcsize
+
+_CTL_FMT = "<cHII"
+_CTL_LEN = calcsize(_CTL_FMT)
+
+_PROMOTE = 'p'
+_DROP = 'k'
+
+
+class Snapshot(object):
+    """
+    The worker's handle on a snapshot process.
+    """
+
+    def __init__(self, snap_id, pid, ctl_w):
+        self.snap_id = snap_id
+        self.pid = pid
+        self._ctl_w = ctl_w
+        # snapshots inherited through a rollback aren't our children
+        self._ppid = os.getpid()
+
+    def alive(self):
+        try:
+            os.kill(self.pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def promote(self, sid, last_id, leftover=''):
+        """
+        Tells the snapshot to take over as the worker.
+
+        :raises: OSError if the snapshot process is gone.
+        """
+        bytes = pack(_CTL_FMT, _PROMOTE, sid, last_id, len(leftover))
+        bytes += leftover
+        try:
+            i = 0
+            while i < len(bytes):
+                i += os.write(self._ctl_w, buffer(bytes, i))
+        finally:
+            os.close(self._ctl_w)
+
+    def drop(self):
+        """
+        Tells the snapshot process to exit and reaps it if it's our child.
+        """
+        try:
+            os.write(self._ctl_w, pack(_CTL_FMT, _DROP, 0, 0, 0))
+        except OSError:
+            pass
+        os.close(self._ctl_w)
+        if self._ppid == os.getpid():
+            try:
+                os.waitpid(self.pid, 0)
+            except OSError:
+                pass
+
+
+def fork_snapshot(snap_id, on_promote):
+    """
+    Forks a frozen copy of this process.  Must be called from the main
+    thread, since that's the only thread the copy has.
+
+    In the parent, returns a :class:`Snapshot`.  The child blocks until it's
+    dropped or promoted.  When promoted it calls ``on_promote(sid, last_id,
+    leftover)``,
+    which runs the worker and returns when the worker shuts down.  The child
+    never returns from this function.
+    """
+    ctl_r, ctl_w = os.pipe()
+    pid = os.fork()
+    if pid:
+        os.close(ctl_r)
+        return Snapshot(snap_id, pid, ctl_w)
+    status = 0
+    try:
+        os.close(ctl_w)
+        cmd, sid, last_id, leftover = _read_ctl(ctl_r)
+        os.close(ctl_r)
+        if cmd == _PROMOTE:
+            _reinit_logging_locks()
+            on_promote(sid, last_id, leftover)
+    except:
+        status = 1
+        try:
+            logging.getLogger("Snapshot[pid=%s]" % (os.getpid(),)
+                              ).exception("[fork_snapshot]")
+        except:
+            pass
+    finally:
+        os._exit(status)
+
+
+def _read_ctl(fd):
+    """
+    Blocks until a whole command is read.  Returns (cmd, sid, last_id,
+    leftover).
+    """
+    bytes = _read_n(fd, _CTL_LEN)
+    if bytes is None:
+        return (_DROP, 0, 0, '')
+    cmd, sid, last_id, n = unpack(_CTL_FMT, bytes)
+    leftover = _read_n(fd, n) if n else ''
+    if leftover is None:
+        return (_DROP, 0, 0, '')
+    return cmd, sid, last_id, leftover
+
+
+def _read_n(fd, n):
+    """
+    Returns n bytes read from fd, or None at EOF.
+    """
+    chunks = []
+    while n:
+        rbytes = os.read(fd, n)
+        if not rbytes:
+            return None
+        chunks.append(rbytes)
+        n -= len(rbytes)
+    return ''.join(chunks)
+
+
+def _reinit_logging_locks():
+    """
+    Another thread may have held a logging lock when we forked, so give the
+    module and its handlers new ones.
+    """
+    import threading
+    logging._lock = threading.RLock()
+    for ref in logging._handlerList:
+        h = ref()
+        if h is not None:
+            h.createLock()
@@ -1,3 +1,5 @@
+from collections import OrderedDict
+from functools import partial
 import logging
 import os
 from Queue import Queue
@@ -5,8 +7,12 @@ import thread
 from time import sleep as _sleep, time as _time
 from traceback import format_exc
 
+from cellcache import CellCache
 from exec_env import ExecEnv
-from msgr import ShutdownNow
+from limits import MemoryWatcher, set_address_space_limit
+from msgr import HandOff, ShutdownNow
+from parallel import independent_prefix
+from snapshot import fork_snapshot
 import sageserver.msg as msg
 from sageserver.msg.decodedmsg import CallbackMsgDecoder
 
@@ -33,12 +39,77 @@ class Worker(object):
     communication threads is possible.
     
     Communication between threads is done with Queue's.
+
+    A :class:`msg.Hibernate` writes the namespace to disk and shuts the
+    worker down; a :class:`msg.Restore` in a new worker loads it back.
+
+    A :class:`msg.Snapshot` forks a frozen copy of the worker (see
+    :mod:`snapshot`) and a :class:`msg.Rollback` hands the message pipes over
+    to one of those copies, which then carries on as the worker.
     """
-    def __init__(self, msgr):
+    def __init__(self, msgr, exec_defaults=None, max_as=None, max_rss=None,
+                 rss_warn=0.8, rss_interval=0.5, max_snapshots=4,
+                 cache_entries=32, cache_dir=None, max_procs=None,
+                 progress_rate=4.0, stdin_window=65536, display_bytes=65536):
+        """
+        :param msgr: a :class:`msgr.PipeMsgr` instance.
+        :param exec_defaults: a dict of :class:`msg.ExecCell` defaults set by
+            the manager for this deployment (see :mod:`options`).
+        :param max_as: address space limit in bytes, or None.
+        :param max_rss: RSS limit in bytes, or None.  Watched by a
+            :class:`limits.MemoryWatcher`.
+        :param rss_warn: fraction of max_rss that is reported as approaching
+            the limit.
+        :param rss_interval: seconds between RSS checks.
+        :param max_snapshots: the number of snapshots kept before the oldest
+            is dropped.  0 disables snapshots.
+        :param cache_entries: the number of ``%cache=True`` results kept in
+            memory.  0 disables the cache.
+        :param cache_dir: a directory for cached results pushed out of
+            memory (in a private directory of the worker's), or None to drop
+            them.
+        :param max_procs: the number of cells of a parallel
+            :class:`msg.ExecBatch` run at once, and of processes used by
+            ``parallel_map``, or None for the number of CPUs.
+        :param progress_rate: the most :class:`msg.Progress` messages a
+            cell sends a second.
+        :param stdin_window: bytes of Stdin the manager may send ahead of a
+            cell's reads, 0 to only send what a blocked read asks for.
+        :param display_bytes: about how much of the repr of a result is
+            sent before the rest is left for a :class:`msg.FetchMore`.
+        """
         self._log = logging.getLogger(
             "%s[pid=%s]" % (self.__class__.__name__, os.getpid()) )
-        self._msgr = msgr        
-            
+        self._msgr = msgr
+        self._exec_defaults = exec_defaults
+        self._max_as = max_as
+        self._max_rss = max_rss
+        self._rss_warn = rss_warn
+        self._rss_interval = rss_interval
+        self._max_snapshots = max_snapshots
+        if max_procs is None:
+            from multiprocessing import cpu_count
+            max_procs = cpu_count()
+        self._max_procs = max_procs
+        self._progress_rate = progress_rate
+        self._stdin_window = stdin_window
+        self._display_bytes = display_bytes
+        self._cell_cache = None
+        if cache_entries > 0:
+            self._cell_cache = CellCache(cache_entries, cache_dir)
+        self._snapshots = OrderedDict() # snap_id -> snapshot.Snapshot
+        self._last_snap_id = 0
+        self._exec_env = None
+        # incremented by each Interrupt, batches received before it are
+        # skipped
+        self._interrupt_gen = 0
+
+        self._MAIN_HANDLERS = {
+            msg.EXEC_BATCH: self._main_ExecBatch,
+            msg.SNAPSHOT: self._main_Snapshot,
+            msg.HIBERNATE: self._main_Hibernate,
+        }
+
     def loop_forever(self):
         msgr = self._msgr
         self._shutdown = False
@@ -49,33 +120,61 @@ class Worker(object):
 
         self._main_q = Queue()
         self._send_q = msgr.get_send_queue()
-        
-        self._exec_env = ExecEnv(msgr)
+
+        if self._max_as:
+            set_address_space_limit(self._max_as)
+        mem_watcher = None
+        if self._max_rss:
+            mem_watcher = MemoryWatcher(self._send_q, self._max_rss,
+                                        self._rss_warn, self._rss_interval)
+
+        if self._exec_env is None:
+            self._exec_env = ExecEnv(msgr, self._exec_defaults, mem_watcher,
+                                     self._cell_cache, self._max_procs,
+                                     self._progress_rate, self._stdin_window,
+                                     self._display_bytes)
+        else:
+            # we're a snapshot that was promoted
+            self._exec_env.bind(msgr, mem_watcher)
         msgr.recv_handlers.update({
             msg.SHUTDOWN: self._recv_Shutdown,
             msg.IS_COMPUTING: self._recv_IsComputing,
+            msg.INTERRUPT: self._recv_Interrupt,
             msg.EXEC_CELL: self._recv_pass_to_main,
+            msg.EXEC_BATCH: self._recv_ExecBatch,
+            msg.SNAPSHOT: self._recv_pass_to_main,
+            msg.ROLLBACK: self._recv_Rollback,
+            msg.HIBERNATE: self._recv_pass_to_main,
+            msg.RESTORE: self._recv_pass_to_main,
+            msg.FETCH_MORE: self._recv_pass_to_main,
         })
         msgr.set_shutdown_test(self.is_shutdown)
         msgr.set_on_shutdown(self.shutdown)
                 
         msgr.start_io()
-        
+        if mem_watcher is not None:
+            mem_watcher.start(self.is_shutdown)
+
         try:  
             while not self._shutdown:
-                self._main_receiving = True
-                m = self._main_q.get()
-                self._main_receiving = False
-                self._log.debug("[_main_thread] Got %r", m)
-                if m.type == msg.SHUTDOWN:
-                    self._shutdown = m
-                    break
-                if m.type in self._exec_env.MAIN_HANDLERS:
-                    self._exec_env.MAIN_HANDLERS[m.type](m)
-                else:
-                    self._log.error("[_main_thread] unhandled message %s", m)
-        except KeyboardInterrupt:
-            pass
+                try:
+                    self._main_receiving = True
+                    m = self._main_q.get()
+                    self._main_receiving = False
+                    self._log.debug("[_main_thread] Got %r", m)
+                    if m.type == msg.SHUTDOWN:
+                        self._shutdown = m
+                        break
+                    if m.type in self._MAIN_HANDLERS:
+                        self._MAIN_HANDLERS[m.type](m)
+                    elif m.type in self._exec_env.MAIN_HANDLERS:
+                        self._exec_env.MAIN_HANDLERS[m.type](m)
+                    else:
+                        self._log.error("[_main_thread] unhandled message %s",
+                                        m)
+                except KeyboardInterrupt:
+                    # an Interrupt that arrived just after a cell finished
+                    self._log.debug("[_main_thread] late KeyboardInterrupt")
         except:
             self._log.error("[_main_thread] %s", format_exc())
         finally:
@@ -83,9 +182,13 @@ class Worker(object):
             self._main_receiving = False
             self._log.debug("[_main_thread] Exiting.")
             self.shutdown()
+            self._drop_snapshots()
+            if self._cell_cache is not None:
+                self._cell_cache.close()
+            self._msgr.wait_sent(1.0)
 
     def _recv_Shutdown(self, m):
-        self._shutdown = m
+        self.shutdown(m)
         raise ShutdownNow()
     
     def _recv_IsComputing(self, m):
@@ -94,16 +197,165 @@ class Worker(object):
         
     def _recv_pass_to_main(self, m):
         self._main_q.put(m)
+
+    def _recv_Interrupt(self, m):
+        self._interrupt_gen += 1
+        # polling for the main thread would hold up receiving
+        thread.start_new_thread(self._interrupt_reply, (m,))
+
+    def _interrupt_reply(self, m):
+        rm = msg.Yes() if self._interrupt_main(m['timeout']) else msg.No()
+        self._send_q.put(rm.as_reply_to(m))
+
+    def _recv_ExecBatch(self, m):
+        m.interrupt_gen = self._interrupt_gen
+        self._main_q.put(m)
+
+    def _main_ExecBatch(self, m):
+        """
+        Executes the cells of a batch in order, each under its own sid.
+        """
+        run = None
+        if m['incremental']:
+            affected = self._exec_env.dataflow.affected(
+                    [(c.get('cid', 0), c['source']) for c in m['cells']])
+            self._send_q.put(msg.Affected(affected, _hsid=m.hdr.sid))
+            run = frozenset(affected)
+        exec_msgs = [_batch_cell_msg(cell) for cell in m['cells']]
+        skip = None
+        i = 0
+        while i < len(exec_msgs):
+            exec_msg = exec_msgs[i]
+            if skip is None and m.interrupt_gen != self._interrupt_gen:
+                skip = 'INTERRUPT'
+            if skip is not None:
+                self._send_q.put(msg.Skipped(skip).as_reply_to(exec_msg))
+                i += 1
+                continue
+            if run is not None and exec_msg['cid'] not in run:
+                self._send_q.put(
+                        msg.Skipped('UNCHANGED').as_reply_to(exec_msg))
+                i += 1
+                continue
+            n = 1
+            if m['parallel'] and self._max_procs > 1:
+                n = max(1, self._parallel_group(exec_msgs[i:], run))
+            if n == 1:
+                oks = [self._exec_env.exec_cell(exec_msg)]
+            else:
+                oks = self._exec_env.exec_parallel(exec_msgs[i:i + n],
+                                                   self._max_procs)
+            i += n
+            if m.interrupt_gen != self._interrupt_gen:
+                skip = 'INTERRUPT'
+            elif not all(oks) and m['stop_on_error']:
+                skip = 'ERROR'
+        self._send_q.put(msg.Done().as_reply_to(m))
+
+    def _parallel_group(self, exec_msgs, run):
+        """
+        Returns how many of the leading exec_msgs can run at the same time.
+        """
+        sources = []
+        for exec_msg in exec_msgs:
+            if run is not None and exec_msg['cid'] not in run:
+                break
+            sources.append(exec_msg['source'])
+        return independent_prefix(sources, self._exec_env.globals)
+
+    def _main_Snapshot(self, m):
+        if self._max_snapshots <= 0:
+            self._send_q.put(msg.No().as_reply_to(m))
+            return
+        evicted = []
+        while len(self._snapshots) >= self._max_snapshots:
+            _, snap = self._snapshots.popitem(last=False)
+            snap.drop()
+            evicted.append(snap.snap_id)
+        self._last_snap_id += 1
+        snap_id = self._last_snap_id
+        self._snapshots[snap_id] = fork_snapshot(
+                snap_id, partial(self._promoted, snap_id))
+        self._log.debug("[_main_Snapshot] snapshot %d is pid %d", snap_id,
+                        self._snapshots[snap_id].pid)
+        self._send_q.put(msg.SnapshotTaken(snap_id, evicted).as_reply_to(m))
+
+    def _recv_Rollback(self, m):
+        snap = self._snapshots.get(m['snap_id'])
+        if snap is None or not snap.alive():
+            self._snapshots.pop(m['snap_id'], None)
+            self._send_q.put(msg.No().as_reply_to(m))
+            return
+        # stop receiving, the snapshot reads the rest of the pipe
+        raise HandOff(partial(self._hand_off, snap, m.hdr.sid))
+
+    def _hand_off(self, snap, sid, leftover):
+        """
+        Called by the send thread once all our output is sent.  Promotes snap,
+        passing it the leftover bytes read after the Rollback, and exits, or
+        returns False if the snapshot is gone.
+        """
+        for s in self._snapshots.values():
+            if s.snap_id > snap.snap_id:
+                # newer than the state we're rolling back to
+                s.drop()
+        try:
+            snap.promote(sid, self._last_snap_id, leftover)
+        except OSError:
+            self._log.error("[_hand_off] snapshot %d is gone", snap.snap_id)
+            del self._snapshots[snap.snap_id]
+            self._send_q.put(msg.No(_hsid=sid, _hflags=msg.HDRF_SCLOSE))
+            return False
+        self._log.debug("[_hand_off] promoted snapshot %d", snap.snap_id)
+        os._exit(0)
+
+    def _promoted(self, snap_id, sid, last_id, leftover):
+        """
+        Called in a snapshot process when it's promoted to be the worker.
+        """
+        self._log = logging.getLogger(
+            "%s[pid=%s]" % (self.__class__.__name__, os.getpid()) )
+        self._last_snap_id = max(self._last_snap_id, last_id)
+        # keep a frozen copy so that we can be rolled back to again
+        self._snapshots[snap_id] = fork_snapshot(
+                snap_id, partial(self._promoted, snap_id))
+        self._msgr = self._msgr.reopen(leftover)
+        self._msgr.get_send_queue().put(
+                msg.RolledBack(snap_id, os.getpid(), _hsid=sid,
+                               _hflags=msg.HDRF_SCLOSE))
+        self.loop_forever()
+
+    def _main_Hibernate(self, m):
+        """
+        Writes the namespace to disk and shuts down.
+        """
+        start = _time()
+        try:
+            info = self._exec_env.hibernate(m['path'])
+        except (IOError, OSError):
+            self._log.error("[_main_Hibernate] %s", format_exc())
+            self._send_q.put(msg.No().as_reply_to(m))
+            return
+        self._send_q.put(msg.Hibernated(m['path'], info['nbytes'],
+                                        _time() - start, info['n_globals'],
+                                        info['n_cells']).as_reply_to(m))
+        self.shutdown()
+
+    def _drop_snapshots(self):
+        while self._snapshots:
+            _, snap = self._snapshots.popitem(last=False)
+            snap.drop()
    
-    def shutdown(self):
+    def shutdown(self, m=None):
         if self._shutdown_called:
             return
         self._shutdown_called = True
-        if not self._shutdown:
-            self._shutdown = msg.Shutdown()
-        sd = self._shutdown
+        sd = self._shutdown or m or msg.Shutdown()
+        # queued before is_shutdown() is true, the send thread exits as
+        # soon as it is and its queue is empty
         self._send_q.put(sd)
         self._main_q.put(sd)
+        self._shutdown = sd
         return
         
         if _poll_for(self, '_main_dead', timeout=sd['before_int']):
@@ -130,8 +382,10 @@ class Worker(object):
             if _poll_for(self, '_main_receiving', timeout=poll_for):
                 return True
             
-        self._log.debug("[_interrupt_main] thread.interrupt_main()")
-        thread.interrupt_main()
+        if self._exec_env.executing:
+            # between cells a batch stops by itself
+            self._log.debug("[_interrupt_main] thread.interrupt_main()")
+            thread.interrupt_main()
         if _poll_for(self, '_main_receiving', timeout=poll_for):
             return True
             
@@ -139,7 +393,36 @@ class Worker(object):
         
     def is_shutdown(self):
         return bool(self._shutdown)
-    
+
+
+def _batch_cell_msg(cell):
+    """
+    Returns a :class:`msg.ExecCell` for a cell of a :class:`msg.ExecBatch`.
+
+    EXAMPLES::
+
+        >>> m = _batch_cell_msg({'sid': 7, 'source': 'a = 1', 'cid': 3})
+        >>> (m.hdr.sid, m['source'], m['cid'], m['except_msg'])
+        (7, 'a = 1', 3, False)
+    """
+    m = msg.ExecCell(cell['source'], _hsid=cell.get('sid', 0))
+    for k, v in cell.iteritems():
+        if k != 'sid':
+            m[k] = v
+    return m
+
+
+def _poll_for(obj, attr, timeout, interval=0.01):
+    """
+    Waits up to timeout seconds for ``getattr(obj, attr)`` to be true.
+    Returns its last value.
+    """
+    endt = _time() + timeout
+    while not getattr(obj, attr) and _time() < endt:
+        _sleep(interval)
+    return getattr(obj, attr)
+
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
\ No newline at end of file
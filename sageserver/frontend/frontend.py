@@ -0,0 +1,292 @@
+"""
+The front-end, which places client sessions on compute nodes.
+
+    python run_frontend.py [port] name=host:port ...
+
+Clients connect to the front-end as they would to a compute node's
+manager.  The front-end reads the WebSocket handshake, picks a node with
+its :class:`scheduler.Scheduler` and from then on relays the bytes both
+ways, so the session is the node's for as long as the connection lasts.
+
+A new session is placed by its key: the ``user`` in the URL
+(``ws://host/?user=alice``), or else the client's address.  A client
+resuming a session (``?session=<token>``) goes back to the node that named
+the token, see the manager's ``exc_node_name``.
+
+Each node's capacity is polled with ``GET /capacity`` every
+``fe_poll_interval`` seconds.
+"""
+
+import json
+import sys
+from urlparse import parse_qs, urlparse
+
+from twisted.application import service
+from twisted.internet import defer, protocol, reactor, task
+from twisted.python import log
+
+from scheduler import Scheduler
+
+DEFAULT_CONFIG = {
+    'fe_port': 8000,
+    'fe_poll_interval': 2.0,
+    'fe_poll_timeout': 5.0,
+    'fe_stale_after': 10.0,
+    'fe_overflow': 1.25,
+    'fe_max_load': 1.5,
+    'fe_min_free_ram': 256 * 1024 * 1024,
+    'fe_connect_tries': 3,
+}
+
+_MAX_HANDSHAKE = 8192
+
+
+class CapacityQuery(protocol.Protocol):
+    """
+    Asks a manager for its capacity.
+    """
+
+    def connectionMade(self):
+        self._data = []
+        self.transport.write('GET /capacity HTTP/1.0\r\n\r\n')
+
+    def dataReceived(self, data):
+        self._data.append(data)
+
+    def connectionLost(self, reason):
+        head, _, body = ''.join(self._data).partition('\r\n\r\n')
+        d, self.factory.deferred = self.factory.deferred, None
+        if d is None:
+            return
+        try:
+            if not head.startswith('HTTP/1.1 200'):
+                raise ValueError("bad answer: %r" % (head,))
+            d.callback(json.loads(body))
+        except ValueError, e:
+            d.errback(e)
+
+
+class CapacityQueryFactory(protocol.ClientFactory):
+    protocol = CapacityQuery
+
+    def __init__(self):
+        self.deferred = defer.Deferred()
+
+    def clientConnectionFailed(self, connector, reason):
+        d, self.deferred = self.deferred, None
+        if d is not None:
+            d.errback(reason)
+
+
+def poll_capacity(host, port, timeout=5.0):
+    """
+    Returns a Deferred that fires with the capacity of the manager at host
+    and port.
+    """
+    f = CapacityQueryFactory()
+    reactor.connectTCP(host, port, f, timeout=timeout)
+    return f.deferred
+
+
+class NodeRelay(protocol.Protocol):
+    """
+    The front-end's connection to a node for one client.
+    """
+
+    def connectionMade(self):
+        self.client = self.factory.client
+        self.client.node_connected(self)
+
+    def dataReceived(self, data):
+        self.client.transport.write(data)
+
+    def connectionLost(self, reason):
+        self.client.transport.loseConnection()
+
+
+class NodeRelayFactory(protocol.ClientFactory):
+    protocol = NodeRelay
+
+    def __init__(self, client, node):
+        self.client = client
+        self.node = node
+
+    def clientConnectionFailed(self, connector, reason):
+        self.client.node_failed(self.node)
+
+
+class ClientRelay(protocol.Protocol):
+    """
+    A client's connection.  It's held until the handshake has been read and
+    the node connected, then relayed.  Each side is the other's producer,
+    so a slow reader holds up the writer.
+    """
+
+    def connectionMade(self):
+        self._buf = []
+        self._head = None
+        self._tried = set()
+        self._node = None # connection
+
+    def dataReceived(self, data):
+        if self._node is not None:
+            self._node.transport.write(data)
+            return
+        self._buf.append(data)
+        if self._head is not None:
+            return
+        buf = ''.join(self._buf)
+        end = buf.find('\r\n\r\n')
+        if end < 0:
+            if len(buf) > _MAX_HANDSHAKE:
+                self.transport.loseConnection()
+            return
+        self._head = buf[:end]
+        self._connect()
+
+    def _connect(self):
+        service = self.factory.service
+        node = None
+        if len(self._tried) < service.config.get('fe_connect_tries', 3):
+            node = service.route(self._head, self.transport.getPeer(),
+                                 self._tried)
+        if node is None:
+            self.transport.write('HTTP/1.1 503 Service Unavailable\r\n'
+                                 'Content-Length: 0\r\n\r\n')
+            self.transport.loseConnection()
+            return
+        self._tried.add(node.name)
+        reactor.connectTCP(node.host, node.port, NodeRelayFactory(self, node))
+
+    def node_connected(self, relay):
+        if not self.transport.connected:
+            relay.transport.loseConnection()
+            return
+        self._node = relay
+        relay.transport.write(''.join(self._buf))
+        self._buf = None
+        self.transport.registerProducer(relay.transport, True)
+        relay.transport.registerProducer(self.transport, True)
+
+    def node_failed(self, node):
+        log.msg("node %s (%s:%s) is unreachable" % (node.name, node.host,
+                                                    node.port))
+        self.factory.service.scheduler.failed(node.name)
+        if self.transport.connected:
+            self._connect()
+
+    def connectionLost(self, reason):
+        if self._node is not None:
+            self._node.transport.loseConnection()
+
+
+class FrontendFactory(protocol.ServerFactory):
+    protocol = ClientRelay
+
+    def __init__(self, service):
+        self.service = service
+
+
+class FrontendService(service.Service):
+    """
+    Keeps the scheduler's view of the nodes up to date.
+    """
+
+    def __init__(self, config, nodes):
+        """
+        :param nodes: ``(name, host, port)`` of each compute node.
+        """
+        self.config = config
+        self.scheduler = Scheduler(
+                overflow=config.get('fe_overflow', 1.25),
+                max_load=config.get('fe_max_load', 1.5),
+                min_free_ram=config.get('fe_min_free_ram',
+                                        256 * 1024 * 1024),
+                stale_after=config.get('fe_stale_after', 10.0))
+        for name, host, port in nodes:
+            self.scheduler.add_node(name, host, port)
+
+    def startService(self):
+        service.Service.startService(self)
+        self._poll_loop = task.LoopingCall(self.poll)
+        self._poll_loop.start(self.config.get('fe_poll_interval', 2.0))
+
+    def stopService(self):
+        service.Service.stopService(self)
+        self._poll_loop.stop()
+
+    def poll(self):
+        """
+        Asks every node for its capacity.  Returns a Deferred that fires
+        once they've all answered or failed.
+        """
+        ds = []
+        for node in self.scheduler.nodes.values():
+            d = poll_capacity(node.host, node.port,
+                              self.config.get('fe_poll_timeout', 5.0))
+            d.addCallbacks(self._reported, self._poll_failed,
+                           callbackArgs=(node,), errbackArgs=(node,))
+            ds.append(d)
+        return defer.DeferredList(ds)
+
+    def _reported(self, capacity, node):
+        if not node.up:
+            log.msg("node %s is up" % (node.name,))
+        self.scheduler.report(node.name, capacity)
+
+    def _poll_failed(self, failure, node):
+        if node.up:
+            log.msg("node %s is down: %s" % (node.name,
+                                              failure.getErrorMessage()))
+        self.scheduler.failed(node.name)
+
+    def route(self, head, peer, exclude=()):
+        """
+        Returns the node for a client whose handshake is head, or None if
+        there isn't one up.
+        """
+        try:
+            path = head.split('\r\n', 1)[0].split(' ')[1]
+        except IndexError:
+            path = '/'
+        query = parse_qs(urlparse(path).query)
+        token = query.get('session', [None])[0]
+        if token is not None:
+            node = self.scheduler.node_for_token(token)
+            if node is not None and node.name not in exclude:
+                return node
+        key = query.get('user', [getattr(peer, 'host', '')])[0]
+        return self.scheduler.place(key, exclude)
+
+
+def parse_node(arg):
+    """
+    Returns ``(name, host, port)`` for a ``name=host:port`` argument.
+
+    EXAMPLES::
+
+        >>> parse_node('a=localhost:8081')
+        ('a', 'localhost', 8081)
+    """
+    name, _, addr = arg.partition('=')
+    host, _, port = addr.rpartition(':')
+    return name, host, int(port)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    config = dict(DEFAULT_CONFIG)
+    if argv and '=' not in argv[0]:
+        config['fe_port'] = int(argv.pop(0))
+    log.startLogging(sys.stdout)
+    s = FrontendService(config, [parse_node(a) for a in argv])
+    s.startService()
+    reactor.addSystemEventTrigger('before', 'shutdown', s.stopService)
+    reactor.listenTCP(config['fe_port'], FrontendFactory(s))
+    reactor.run()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
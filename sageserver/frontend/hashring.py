@@ -0,0 +1,95 @@
+"""
+Consistent hashing of session keys onto compute nodes.
+"""
+
+from bisect import bisect
+from hashlib import md5
+from struct import unpack_from
+
+
+def _hash(s):
+    return unpack_from('>I', md5(s).digest())[0]
+
+
+class HashRing(object):
+    """
+    Nodes placed at ``replicas`` points each on a ring of 32 bit hashes.  A
+    key's nodes, in order of preference, are those of the points after its
+    hash going round the ring, so adding or removing a node only moves the
+    keys it gains or loses.
+
+    EXAMPLES::
+
+        >>> r = HashRing(['a', 'b', 'c'])
+        >>> r.preference('alice')
+        ['b', 'a', 'c']
+        >>> keys = ['user%d' % i for i in range(1000)]
+        >>> before = dict((k, r.preference(k)[0]) for k in keys)
+        >>> sorted(before.values()).count('a')
+        328
+        >>> r.add('d')
+        >>> moved = [k for k in keys if r.preference(k)[0] != before[k]]
+        >>> set(r.preference(k)[0] for k in moved)
+        set(['d'])
+        >>> r.remove('d')
+        >>> all(r.preference(k)[0] == before[k] for k in keys)
+        True
+    """
+
+    def __init__(self, nodes=(), replicas=100):
+        """
+        :param nodes: the names of the nodes.
+        :param replicas: the points a node has, more spread keys more
+            evenly.
+        """
+        self.replicas = replicas
+        self._hashes = [] # sorted
+        self._nodes = [] # the node at each hash
+        self._names = set()
+        for name in nodes:
+            self.add(name)
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, name):
+        if name in self._names:
+            return
+        self._names.add(name)
+        for i in range(self.replicas):
+            h = _hash('%s#%d' % (name, i))
+            j = bisect(self._hashes, h)
+            self._hashes.insert(j, h)
+            self._nodes.insert(j, name)
+
+    def remove(self, name):
+        if name not in self._names:
+            return
+        self._names.discard(name)
+        keep = [(h, n) for h, n in zip(self._hashes, self._nodes)
+                if n != name]
+        self._hashes = [h for h, n in keep]
+        self._nodes = [n for h, n in keep]
+
+    def preference(self, key):
+        """
+        Returns the names of all the nodes, the one key hashes to first.
+        """
+        n = len(self._names)
+        out = []
+        if not n:
+            return out
+        i = bisect(self._hashes, _hash(key))
+        points = len(self._hashes)
+        for k in xrange(points):
+            name = self._nodes[(i + k) % points]
+            if name not in out:
+                out.append(name)
+                if len(out) == n:
+                    break
+        return out
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
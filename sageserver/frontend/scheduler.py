@@ -0,0 +1,179 @@
+"""
+Placement of client sessions on compute nodes.
+"""
+
+from math import ceil
+from time import time as _time
+
+from sageserver.compnode.manager.stats import Stats
+from hashring import HashRing
+
+
+class Node(object):
+    """
+    A compute node, as last reported by its manager (see
+    ``WorkerService.capacity``).
+    """
+
+    def __init__(self, name, host, port):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.capacity = None # the last report
+        self.reported = None # when it came
+        self.placed = 0 # sessions sent to it since
+        self.up = False
+
+    @property
+    def sessions(self):
+        """
+        The sessions on the node, counting those placed since its report.
+        """
+        reported = self.capacity['sessions'] if self.capacity else 0
+        return reported + self.placed
+
+    def busy(self, max_load, min_free_ram):
+        """
+        Returns True if the node hasn't an idle worker for another session,
+        its load per CPU is max_load or more, or it has less than
+        min_free_ram bytes free.
+        """
+        c = self.capacity
+        if c['idle_workers'] <= self.placed:
+            return True
+        if c['load'] is not None and c['load'] >= max_load * c['cpus']:
+            return True
+        return c['free_ram'] is not None and c['free_ram'] < min_free_ram
+
+    def __repr__(self):
+        return '<Node %s %s:%s>' % (self.name, self.host, self.port)
+
+
+class Scheduler(object):
+    """
+    Picks the node for each new session.
+
+    A session's key (its user, say) is consistently hashed onto the nodes,
+    so the same key goes to the same node while it has room, and adding a
+    node only moves the keys it takes over.  A node has room if it isn't
+    :meth:`Node.busy` and has fewer than ``overflow`` times the average
+    sessions; otherwise the session overflows to the next node for the key
+    on the ring.  If every node is busy the bound alone decides.
+
+    A node is down once it has failed a report, or hasn't reported for
+    ``stale_after`` seconds.  A reconnecting session goes back to the node
+    named in its token, whatever the load.
+
+    EXAMPLES::
+
+        >>> now = [0.0]
+        >>> s = Scheduler(overflow=2.0, clock=lambda: now[0])
+        >>> for i, name in enumerate(['a', 'b', 'c']):
+        ...     s.add_node(name, 'localhost', 8081 + i)
+        >>> s.place('alice') is None     # no reports yet
+        True
+        >>> def report(name, idle, sessions=0, load=0.0):
+        ...     s.report(name, {'sessions': sessions, 'idle_workers': idle,
+        ...                     'load': load, 'cpus': 4,
+        ...                     'free_ram': 2 ** 30})
+        >>> for name in 'abc':
+        ...     report(name, idle=2)
+        >>> s.place('alice'), s.place('alice')
+        (<Node b localhost:8082>, <Node b localhost:8082>)
+        >>> s.place('alice')             # b is full
+        <Node a localhost:8081>
+        >>> report('b', idle=4, sessions=2, load=8.0)
+        >>> s.place('alice')             # b's CPUs are busy
+        <Node a localhost:8081>
+        >>> s.node_for_token('b-0f3c'), s.node_for_token('z-0f3c')
+        (<Node b localhost:8082>, None)
+        >>> now[0] += 30                 # nobody has reported since
+        >>> s.place('alice') is None, s.node_for_token('b-0f3c')
+        (True, None)
+        >>> st = s.stats.snapshot()
+        >>> st['placed_home'], st['placed_overflow'], st['no_node']
+        (2, 2, 2)
+    """
+
+    def __init__(self, overflow=1.25, max_load=1.5,
+                 min_free_ram=256 * 1024 * 1024, stale_after=10.0,
+                 replicas=100, clock=_time):
+        """
+        :param overflow: how many times the average sessions a node takes
+            before sessions overflow to the next.
+        :param max_load: the load average per CPU over which a node is
+            busy.
+        :param min_free_ram: the free bytes under which a node is busy.
+        :param stale_after: seconds without a report after which a node is
+            down.
+        :param replicas: points a node has on the hash ring.
+        """
+        self.overflow = overflow
+        self.max_load = max_load
+        self.min_free_ram = min_free_ram
+        self.stale_after = stale_after
+        self._clock = clock
+        self._ring = HashRing(replicas=replicas)
+        self.nodes = {} # name -> Node
+        self.stats = Stats()
+
+    def add_node(self, name, host, port):
+        self.nodes[name] = Node(name, host, port)
+        self._ring.add(name)
+
+    def report(self, name, capacity):
+        """
+        Records a node's capacity.
+        """
+        node = self.nodes[name]
+        node.capacity = capacity
+        node.reported = self._clock()
+        node.placed = 0
+        node.up = True
+
+    def failed(self, name):
+        """
+        Called when a node couldn't be reached.
+        """
+        self.nodes[name].up = False
+
+    def alive(self, node):
+        return node.up and self._clock() - node.reported <= self.stale_after
+
+    def node_for_token(self, token):
+        """
+        Returns the node of a session token, or None if it's down or the
+        token isn't from a named node.
+        """
+        node = self.nodes.get(token.rpartition('-')[0])
+        if node is None or not self.alive(node):
+            return None
+        self.stats.incr('placed_resumed')
+        return node
+
+    def place(self, key, exclude=()):
+        """
+        Returns the node for a new session with key, or None if no node is
+        up.  Nodes named in exclude aren't considered.
+        """
+        order = [self.nodes[name] for name in self._ring.preference(key)
+                 if name not in exclude]
+        order = [node for node in order if self.alive(node)]
+        if not order:
+            self.stats.incr('no_node')
+            return None
+        total = sum(node.sessions for node in order) + 1
+        bound = ceil(self.overflow * total / len(order))
+        for any_load in (False, True):
+            for node in order:
+                if node.sessions < bound and (any_load or not node.busy(
+                        self.max_load, self.min_free_ram)):
+                    node.placed += 1
+                    self.stats.incr('placed_home' if node is order[0]
+                                    else 'placed_overflow')
+                    return node
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
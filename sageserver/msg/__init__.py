@@ -39,31 +39,16 @@ from hdr import *
 from output_msgs import *
 from request_msgs import *
 
-'''
-def _gen_type_strs():
-    import msgints
-    return dict([(getattr(msgints, k), k)
-                 for k in dir(msgints)
-                 if k.isupper()])
-    
-TYPE_STRS = _gen_type_strs()
-
-def _gen_type_dict():
-    import msgs_outputs
-    import msgs_requests
-    type_dict = {}
-    for k, v in TYPE_STRS.iteritems():
-        clsname = ''.join( map(str.capitalize, v.split('_')) )
-        cls = None
-        if hasattr(msgs_outputs, clsname):
-            cls = getattr(msgs_outputs, clsname)
-        elif hasattr(msgs_requests, clsname):
-            cls = getattr(msgs_requests, clsname)
-        else:
-            #print "Warning: no %s(Msg) defined for type %s!" % (clsname, v)
-            continue
-        type_dict[k] = cls
-    return type_dict
-
-TYPE_DICT = _gen_type_dict()
-'''
\ No newline at end of file
+def _gen_type_classes():
+    import output_msgs
+    import request_msgs
+    classes = {}
+    for mod in (output_msgs, request_msgs):
+        for v in vars(mod).itervalues():
+            if isinstance(v, type) and isinstance(getattr(v, 'type', None),
+                                                  int):
+                classes[v.type] = v
+    return classes
+
+# message type -> message class
+TYPE_CLASSES = _gen_type_classes()
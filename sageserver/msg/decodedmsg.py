@@ -32,7 +32,27 @@ class DecodedMsg(object):
     def __setitem__(self, key, value):
         self.ensure_decoded()
         self._body[key] = value
-        
+
+    def get(self, key, default=None):
+        self.ensure_decoded()
+        return self._body.get(key, default)
+
+    def body(self):
+        """
+        Returns the decoded body, a :class:`SON`.
+        """
+        self.ensure_decoded()
+        return self._body
+
+    def raw_body(self):
+        """
+        Returns the body bytes as received, or None if the body has been
+        decoded (and may have been changed since).
+        """
+        if self._body is None:
+            return self._bodybytes
+        return None
+
     def ensure_decoded(self):
         """
         Decodes the body if not yet decoded.
@@ -99,8 +119,14 @@ class CallbackMsgDecoder(object):
         self._log = log
         self._jbuf = JoinBuffer()
         self._hdr = None
+        self._hdrbytes = None
         
     def feed(self, bytes):
+        """
+        Decodes bytes and calls the callback of each whole message.  If a
+        callback raises, the bytes after its message are kept for
+        :meth:`leftover`.
+        """
         callbacks = self._callbacks
         jbuf = self._jbuf
         jbuf.extend(bytes)
@@ -108,17 +134,26 @@ class CallbackMsgDecoder(object):
             if self._hdr is None:
                 if len(jbuf) < HDR_LEN:
                     break
-                hdrbytes = jbuf.popleft(HDR_LEN)
-                self._hdr = Hdr.decode(hdrbytes)
+                self._hdrbytes = jbuf.popleft(HDR_LEN)
+                self._hdr = Hdr.decode(self._hdrbytes)
             else:
                 if len(jbuf) < self._hdr.length:
                     break
-                if self._hdr.type in callbacks:
-                    bodybytes = jbuf.popleft(self._hdr.length)
-                    m = DecodedMsg(self._hdr, bodybytes)
-                    callbacks[self._hdr.type](m)
+                hdr, self._hdr = self._hdr, None
+                if hdr.type in callbacks:
+                    bodybytes = jbuf.popleft(hdr.length)
+                    m = DecodedMsg(hdr, bodybytes)
+                    callbacks[hdr.type](m)
                 elif self._log is not None:
-                    jbuf.popleft(self._hdr.length, False)
+                    jbuf.popleft(hdr.length, False)
                     self._log.warning("Unhandled message type=%d",
-                                      self._hdr.type)
-                self._hdr = None
\ No newline at end of file
+                                      hdr.type)
+
+    def leftover(self):
+        """
+        Returns the bytes fed that haven't been decoded yet, and forgets
+        them.
+        """
+        head = self._hdrbytes if self._hdr is not None else ''
+        self._hdr = None
+        return head + self._jbuf.popall()
\ No newline at end of file
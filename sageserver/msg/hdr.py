@@ -1,4 +1,4 @@
-from struct import calcsize, pack_into, unpack_from
+from struct import calcsize, pack, pack_into, unpack_from
 
 __all__ = ("HDR_LEN", "HDRF_SOPEN", "HDRF_SCLOSE",
            "Hdr", "HdrDecodeError")
@@ -59,7 +59,27 @@ class Hdr(object):
                   self.length,
                   self.flags, csum)
         return bytes
-        
+
+    def encode_with_sid(self, sid):
+        """
+        Returns this header as a string, but with sid as the stream id.
+        The checksum is worked out from the fields rather than the bytes.
+
+        TESTS::
+
+            >>> h = Hdr(1, 4, 70000, 0x40)
+            >>> Hdr.decode(h.encode_with_sid(0xfffe))
+            Hdr(type=1, sid=65534, length=70000, flags=64)
+            >>> h.sid
+            4
+        """
+        t = self.type
+        n = self.length
+        csum = (((t & 0xff) + (t >> 8) + (sid & 0xff) + (sid >> 8)
+                 + (n & 0xff) + (n >> 8 & 0xff) + (n >> 16 & 0xff)
+                 + (n >> 24)) & _CSUM_MASK) ^ _CSUM_MASK
+        return pack(_HDR_STRUCT_FMT, t, sid, n, self.flags, csum)
+
     @classmethod
     def decode(cls, bytearr, offset=0):
         t, s, l, f, csum = unpack_from(_HDR_STRUCT_FMT, buffer(bytearr), offset)
@@ -13,6 +13,7 @@ YES = 101
 INTERRUPT = 110
 SHUTDOWN = 111
 EXEC_CELL = 120
+EXEC_BATCH = 121
 IS_COMPUTING = 130
 GET_COMPLETIONS = 140
 COMPLETIONS = 141
@@ -20,6 +21,16 @@ GET_DOC = 142
 DOC = 143
 GET_SOURCE = 144
 SOURCE = 145
+FETCH_MORE = 146
+FETCH_DISPLAY = 147
+SNAPSHOT = 150
+SNAPSHOT_TAKEN = 151
+ROLLBACK = 152
+ROLLED_BACK = 153
+HIBERNATE = 160
+HIBERNATED = 161
+RESTORE = 162
+RESTORED = 163
 
 
 '''
@@ -29,6 +40,16 @@ Output message types
 STDIN = 0
 STDOUT = 1
 STDERR = 2
+DISPLAY = 5
 EXCEPT = 10
+MEMORY_USAGE = 80
+PROGRESS = 82
+NOTICE = 83
+SESSION = 84
+QUEUED = 86
+REJECTED = 88
+AFFECTED = 85
+TRUNCATED = 87
 NEED_STDIN = 90
+SKIPPED = 95
 DONE = 99
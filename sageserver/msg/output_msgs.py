@@ -98,6 +98,42 @@ class Stderr(SON):
         return self.hdr.encode() + bodybytes
         
 
+class Display(SON):
+    """
+    Sent for a result with a rich repr such as _repr_png_
+    
+    Message Arguments:
+        mime -- e.g. 'image/png', 'image/svg+xml' or 'text/html'
+        data -- the payload as a bson Binary, or None if it is too big to send inline
+        size -- length of the payload in bytes
+        ref -- what to ask for with FetchDisplay when data is None (default: None)
+    """
+    type = 5
+    
+    def __init__(self, mime, data, size, ref=None, _hsid=0, _hflags=0):
+        SON.__init__(self)
+        self.hdr = Hdr(5, _hsid, 0, _hflags)
+        self.type = 5
+        self['t'] = 5
+        self['mime'] = mime
+        self['data'] = data
+        self['size'] = size
+        self['ref'] = ref
+        
+    def as_reply_to(self, m):
+        self.hdr.sid = m.hdr.sid
+        self.hdr.flags |= HDRF_SCLOSE
+        return self
+        
+    def encode(self):
+        """
+        Returns the encoded representation of this message.
+        """
+        bodybytes = _dict_to_bson(self, False)
+        self.hdr.length = len(bodybytes)
+        return self.hdr.encode() + bodybytes
+        
+
 class Except(SON):
     """
     Except Message
@@ -136,21 +172,323 @@ class Except(SON):
         return self.hdr.encode() + bodybytes
         
 
+class MemoryUsage(SON):
+    """
+    Sent by the worker when its memory level changes
+    
+    Message Arguments:
+        rss -- Resident set size of the worker in bytes
+        limit -- RSS limit of the worker in bytes
+        level -- 
+            'OK': below the warning threshold.
+            'WARN': approaching the limit.
+            'BREACH': over the limit, the worker should be recycled.
+    """
+    type = 80
+    
+    def __init__(self, rss, limit, level, _hsid=0, _hflags=0):
+        SON.__init__(self)
+        self.hdr = Hdr(80, _hsid, 0, _hflags)
+        self.type = 80
+        self['t'] = 80
+        self['rss'] = rss
+        self['limit'] = limit
+        self['level'] = level
+        
+    def as_reply_to(self, m):
+        self.hdr.sid = m.hdr.sid
+        self.hdr.flags |= HDRF_SCLOSE
+        return self
+        
+    def encode(self):
+        """
+        Returns the encoded representation of this message.
+        """
+        bodybytes = _dict_to_bson(self, False)
+        self.hdr.length = len(bodybytes)
+        return self.hdr.encode() + bodybytes
+        
+
+class Progress(SON):
+    """
+    Sent by progress() in a cell.  Replaces the cell's previous Progress rather than adding to its output
+    
+    Message Arguments:
+        fraction -- how much of the cell is done, from 0.0 to 1.0
+        label -- what is being done, may be empty
+    """
+    type = 82
+    
+    def __init__(self, fraction, label, _hsid=0, _hflags=0):
+        SON.__init__(self)
+        self.hdr = Hdr(82, _hsid, 0, _hflags)
+        self.type = 82
+        self['t'] = 82
+        self['fraction'] = fraction
+        self['label'] = label
+        
+    def as_reply_to(self, m):
+        self.hdr.sid = m.hdr.sid
+        self.hdr.flags |= HDRF_SCLOSE
+        return self
+        
+    def encode(self):
+        """
+        Returns the encoded representation of this message.
+        """
+        bodybytes = _dict_to_bson(self, False)
+        self.hdr.length = len(bodybytes)
+        return self.hdr.encode() + bodybytes
+        
+
+class Notice(SON):
+    """
+    Sent by the manager about the session rather than a cell
+    
+    Message Arguments:
+        kind -- 
+            'RECYCLE': the worker is being replaced, the namespace is
+            carried over.
+        text -- a message for the user
+    """
+    type = 83
+    
+    def __init__(self, kind, text, _hsid=0, _hflags=0):
+        SON.__init__(self)
+        self.hdr = Hdr(83, _hsid, 0, _hflags)
+        self.type = 83
+        self['t'] = 83
+        self['kind'] = kind
+        self['text'] = text
+        
+    def as_reply_to(self, m):
+        self.hdr.sid = m.hdr.sid
+        self.hdr.flags |= HDRF_SCLOSE
+        return self
+        
+    def encode(self):
+        """
+        Returns the encoded representation of this message.
+        """
+        bodybytes = _dict_to_bson(self, False)
+        self.hdr.length = len(bodybytes)
+        return self.hdr.encode() + bodybytes
+        
+
+class Session(SON):
+    """
+    Sent by the manager first on each connection, outside the numbering
+    
+    Message Arguments:
+        token -- connect with ?session=<token>&seq=<n> to resume the session
+        seq -- the number of the message before the next one, messages after this are numbered seq + 1, seq + 2, ...
+        resumed -- True if this is the session asked for and no messages since the seq asked for were lost
+    """
+    type = 84
+    
+    def __init__(self, token, seq, resumed, _hsid=0, _hflags=0):
+        SON.__init__(self)
+        self.hdr = Hdr(84, _hsid, 0, _hflags)
+        self.type = 84
+        self['t'] = 84
+        self['token'] = token
+        self['seq'] = seq
+        self['resumed'] = resumed
+        
+    def as_reply_to(self, m):
+        self.hdr.sid = m.hdr.sid
+        self.hdr.flags |= HDRF_SCLOSE
+        return self
+        
+    def encode(self):
+        """
+        Returns the encoded representation of this message.
+        """
+        bodybytes = _dict_to_bson(self, False)
+        self.hdr.length = len(bodybytes)
+        return self.hdr.encode() + bodybytes
+        
+
+class Queued(SON):
+    """
+    Sent by the manager for a request waiting for a worker or for its turn to run, and again as it moves up
+    
+    Message Arguments:
+        position -- requests ahead of this one, plus one
+        wait -- estimated seconds until it runs, or None if there is too little to go on
+    """
+    type = 86
+    
+    def __init__(self, position, wait, _hsid=0, _hflags=0):
+        SON.__init__(self)
+        self.hdr = Hdr(86, _hsid, 0, _hflags)
+        self.type = 86
+        self['t'] = 86
+        self['position'] = position
+        self['wait'] = wait
+        
+    def as_reply_to(self, m):
+        self.hdr.sid = m.hdr.sid
+        self.hdr.flags |= HDRF_SCLOSE
+        return self
+        
+    def encode(self):
+        """
+        Returns the encoded representation of this message.
+        """
+        bodybytes = _dict_to_bson(self, False)
+        self.hdr.length = len(bodybytes)
+        return self.hdr.encode() + bodybytes
+        
+
+class Rejected(SON):
+    """
+    Sent by the manager instead of running a request, followed by a Done
+    
+    Message Arguments:
+        reason -- 
+            'OVERLOADED': the node has too many requests waiting.
+            'USER_QUEUE_FULL': you have too many requests waiting.
+        text -- a message for the user
+        retry_after -- seconds after which trying again may succeed, or None
+    """
+    type = 88
+    
+    def __init__(self, reason, text, retry_after, _hsid=0, _hflags=0):
+        SON.__init__(self)
+        self.hdr = Hdr(88, _hsid, 0, _hflags)
+        self.type = 88
+        self['t'] = 88
+        self['reason'] = reason
+        self['text'] = text
+        self['retry_after'] = retry_after
+        
+    def as_reply_to(self, m):
+        self.hdr.sid = m.hdr.sid
+        self.hdr.flags |= HDRF_SCLOSE
+        return self
+        
+    def encode(self):
+        """
+        Returns the encoded representation of this message.
+        """
+        bodybytes = _dict_to_bson(self, False)
+        self.hdr.length = len(bodybytes)
+        return self.hdr.encode() + bodybytes
+        
+
+class Affected(SON):
+    """
+    Sent first for an incremental ExecBatch
+    
+    Message Arguments:
+        cids -- cids of the cells that will run, in order
+    """
+    type = 85
+    
+    def __init__(self, cids, _hsid=0, _hflags=0):
+        SON.__init__(self)
+        self.hdr = Hdr(85, _hsid, 0, _hflags)
+        self.type = 85
+        self['t'] = 85
+        self['cids'] = cids
+        
+    def as_reply_to(self, m):
+        self.hdr.sid = m.hdr.sid
+        self.hdr.flags |= HDRF_SCLOSE
+        return self
+        
+    def encode(self):
+        """
+        Returns the encoded representation of this message.
+        """
+        bodybytes = _dict_to_bson(self, False)
+        self.hdr.length = len(bodybytes)
+        return self.hdr.encode() + bodybytes
+        
+
+class Truncated(SON):
+    """
+    Sent after the output of a result whose repr was cut short
+    
+    Message Arguments:
+        more_id -- what to ask for with FetchMore
+        shown -- bytes of the repr sent so far
+    """
+    type = 87
+    
+    def __init__(self, more_id, shown, _hsid=0, _hflags=0):
+        SON.__init__(self)
+        self.hdr = Hdr(87, _hsid, 0, _hflags)
+        self.type = 87
+        self['t'] = 87
+        self['more_id'] = more_id
+        self['shown'] = shown
+        
+    def as_reply_to(self, m):
+        self.hdr.sid = m.hdr.sid
+        self.hdr.flags |= HDRF_SCLOSE
+        return self
+        
+    def encode(self):
+        """
+        Returns the encoded representation of this message.
+        """
+        bodybytes = _dict_to_bson(self, False)
+        self.hdr.length = len(bodybytes)
+        return self.hdr.encode() + bodybytes
+        
+
 class NeedStdin(SON):
     """
     NeedStdin Message
     
     Message Arguments:
-        nbytes -- None
+        nbytes -- bytes a blocked read wants, -1 for all of them, or 0 when only granting window
+        window -- more bytes of Stdin that may be sent ahead of demand (default: 0)
     """
     type = 90
     
-    def __init__(self, nbytes, _hsid=0, _hflags=0):
+    def __init__(self, nbytes, window=0, _hsid=0, _hflags=0):
         SON.__init__(self)
         self.hdr = Hdr(90, _hsid, 0, _hflags)
         self.type = 90
         self['t'] = 90
         self['nbytes'] = nbytes
+        self['window'] = window
+        
+    def as_reply_to(self, m):
+        self.hdr.sid = m.hdr.sid
+        self.hdr.flags |= HDRF_SCLOSE
+        return self
+        
+    def encode(self):
+        """
+        Returns the encoded representation of this message.
+        """
+        bodybytes = _dict_to_bson(self, False)
+        self.hdr.length = len(bodybytes)
+        return self.hdr.encode() + bodybytes
+        
+
+class Skipped(SON):
+    """
+    Sent instead of Done for a cell of an ExecBatch that did not run
+    
+    Message Arguments:
+        reason -- 
+            'ERROR': an earlier cell in the batch raised.
+            'INTERRUPT': the batch was interrupted.
+            'UNCHANGED': an incremental batch didn't need to run it.
+    """
+    type = 95
+    
+    def __init__(self, reason, _hsid=0, _hflags=0):
+        SON.__init__(self)
+        self.hdr = Hdr(95, _hsid, 0, _hflags)
+        self.type = 95
+        self['t'] = 95
+        self['reason'] = reason
         
     def as_reply_to(self, m):
         self.hdr.sid = m.hdr.sid
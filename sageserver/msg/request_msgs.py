@@ -136,10 +136,17 @@ class ExecCell(SON):
             'NONE': nothing. (default: NONE)
         print_ast -- If True, print the abstract syntax tree before executing. (default: False)
         except_msg -- If True, send an Except message when an exception occurs.  If False, print to stderr. (default: False)
+        timeout -- Wall-clock seconds the cell may run before CellTimeout is raised.  None uses the worker default. (default: None)
+        cpu_timeout -- CPU seconds the cell may use before CellCPUTimeout is raised.  None uses the worker default. (default: None)
+        cache -- If True, and the cell ran before with the same code and the same values of the globals it reads, restore what it assigned and replay its output instead of executing it.  Usually set with %cache=True. (default: False)
+        output_rate -- Bytes of stdout and stderr a second past which output is dropped.  None uses the worker default. (default: None)
+        output_soft_limit -- Bytes of output past which only a line a second is sent.  None uses the worker default. (default: None)
+        output_limit -- Bytes of output past which none is sent.  None uses the worker default. (default: None)
+        output_interrupt -- If True, raise OutputLimitExceeded in the cell when it passes output_limit.  None uses the worker default. (default: None)
     """
     type = 120
     
-    def __init__(self, source, cid=0, echo_stdin=True, displayhook='LAST', assignhook='NONE', print_ast=False, except_msg=False, _hsid=0, _hflags=0):
+    def __init__(self, source, cid=0, echo_stdin=True, displayhook='LAST', assignhook='NONE', print_ast=False, except_msg=False, timeout=None, cpu_timeout=None, cache=False, output_rate=None, output_soft_limit=None, output_limit=None, output_interrupt=None, _hsid=0, _hflags=0):
         SON.__init__(self)
         self.hdr = Hdr(120, _hsid, 0, _hflags)
         self.type = 120
@@ -151,6 +158,49 @@ class ExecCell(SON):
         self['assignhook'] = assignhook
         self['print_ast'] = print_ast
         self['except_msg'] = except_msg
+        self['timeout'] = timeout
+        self['cpu_timeout'] = cpu_timeout
+        self['cache'] = cache
+        self['output_rate'] = output_rate
+        self['output_soft_limit'] = output_soft_limit
+        self['output_limit'] = output_limit
+        self['output_interrupt'] = output_interrupt
+        
+    def as_reply_to(self, m):
+        self.hdr.sid = m.hdr.sid
+        self.hdr.flags |= HDRF_SCLOSE
+        return self
+        
+    def encode(self):
+        """
+        Returns the encoded representation of this message.
+        """
+        bodybytes = _dict_to_bson(self, False)
+        self.hdr.length = len(bodybytes)
+        return self.hdr.encode() + bodybytes
+        
+
+class ExecBatch(SON):
+    """
+    Execute several cells back to back.  Cells that don't run get Skipped instead of Done, then the batch gets Done.  An Interrupt skips the rest of the running batch and all queued batches
+    
+    Message Arguments:
+        cells -- List of cells to execute in order.  Each is a dict of ExecCell fields plus "sid", the stream id its output and Done are sent with
+        stop_on_error -- If True, the cells after one that raises are Skipped (default: True)
+        incremental -- If True, only run the cells that were edited since they last ran, or that depend on one that runs.  The cids that will run are sent in Affected first (default: False)
+        parallel -- If True, consecutive cells that don't share any globals run at the same time in forked children.  Their output is still sent in order, and what they assign is merged back if it pickles (default: False)
+    """
+    type = 121
+    
+    def __init__(self, cells, stop_on_error=True, incremental=False, parallel=False, _hsid=0, _hflags=0):
+        SON.__init__(self)
+        self.hdr = Hdr(121, _hsid, 0, _hflags)
+        self.type = 121
+        self['t'] = 121
+        self['cells'] = cells
+        self['stop_on_error'] = stop_on_error
+        self['incremental'] = incremental
+        self['parallel'] = parallel
         
     def as_reply_to(self, m):
         self.hdr.sid = m.hdr.sid
@@ -394,3 +444,318 @@ class Source(SON):
         self.hdr.length = len(bodybytes)
         return self.hdr.encode() + bodybytes
         
+
+class FetchMore(SON):
+    """
+    Sends more of a truncated result as Stdout, then a Truncated if there's still more, then Done
+    
+    Message Arguments:
+        more_id -- from a Truncated
+        nbytes -- about how many more bytes to send, None for the worker default (default: None)
+    """
+    type = 146
+    
+    def __init__(self, more_id, nbytes=None, _hsid=0, _hflags=0):
+        SON.__init__(self)
+        self.hdr = Hdr(146, _hsid, 0, _hflags)
+        self.type = 146
+        self['t'] = 146
+        self['more_id'] = more_id
+        self['nbytes'] = nbytes
+        
+    def as_reply_to(self, m):
+        self.hdr.sid = m.hdr.sid
+        self.hdr.flags |= HDRF_SCLOSE
+        return self
+        
+    def encode(self):
+        """
+        Returns the encoded representation of this message.
+        """
+        bodybytes = _dict_to_bson(self, False)
+        self.hdr.length = len(bodybytes)
+        return self.hdr.encode() + bodybytes
+        
+
+class FetchDisplay(SON):
+    """
+    Returns the Display with its payload inline, or No if it is no longer available
+    
+    Message Arguments:
+        ref -- from a Display
+    """
+    type = 147
+    
+    def __init__(self, ref, _hsid=0, _hflags=0):
+        SON.__init__(self)
+        self.hdr = Hdr(147, _hsid, 0, _hflags)
+        self.type = 147
+        self['t'] = 147
+        self['ref'] = ref
+        
+    def as_reply_to(self, m):
+        self.hdr.sid = m.hdr.sid
+        self.hdr.flags |= HDRF_SCLOSE
+        return self
+        
+    def encode(self):
+        """
+        Returns the encoded representation of this message.
+        """
+        bodybytes = _dict_to_bson(self, False)
+        self.hdr.length = len(bodybytes)
+        return self.hdr.encode() + bodybytes
+        
+
+class Snapshot(SON):
+    """
+    Fork a frozen copy-on-write copy of the worker.  Returns SnapshotTaken, or No if snapshots are disabled
+    """
+    type = 150
+    
+    def __init__(self, _hsid=0, _hflags=0):
+        SON.__init__(self)
+        self.hdr = Hdr(150, _hsid, 0, _hflags)
+        self.type = 150
+        self['t'] = 150
+        
+        
+    def as_reply_to(self, m):
+        self.hdr.sid = m.hdr.sid
+        self.hdr.flags |= HDRF_SCLOSE
+        return self
+        
+    def encode(self):
+        """
+        Returns the encoded representation of this message.
+        """
+        bodybytes = _dict_to_bson(self, False)
+        self.hdr.length = len(bodybytes)
+        return self.hdr.encode() + bodybytes
+        
+
+class SnapshotTaken(SON):
+    """
+    SnapshotTaken Message
+    
+    Message Arguments:
+        snap_id -- id to pass to Rollback
+        evicted -- ids of the snapshots dropped to stay under the cap
+    """
+    type = 151
+    
+    def __init__(self, snap_id, evicted, _hsid=0, _hflags=0):
+        SON.__init__(self)
+        self.hdr = Hdr(151, _hsid, 0, _hflags)
+        self.type = 151
+        self['t'] = 151
+        self['snap_id'] = snap_id
+        self['evicted'] = evicted
+        
+    def as_reply_to(self, m):
+        self.hdr.sid = m.hdr.sid
+        self.hdr.flags |= HDRF_SCLOSE
+        return self
+        
+    def encode(self):
+        """
+        Returns the encoded representation of this message.
+        """
+        bodybytes = _dict_to_bson(self, False)
+        self.hdr.length = len(bodybytes)
+        return self.hdr.encode() + bodybytes
+        
+
+class Rollback(SON):
+    """
+    Replace the worker with a snapshot.  Returns RolledBack from the new worker process, or No.  Nothing else may be sent to the worker until the reply arrives
+    
+    Message Arguments:
+        snap_id -- None
+    """
+    type = 152
+    
+    def __init__(self, snap_id, _hsid=0, _hflags=0):
+        SON.__init__(self)
+        self.hdr = Hdr(152, _hsid, 0, _hflags)
+        self.type = 152
+        self['t'] = 152
+        self['snap_id'] = snap_id
+        
+    def as_reply_to(self, m):
+        self.hdr.sid = m.hdr.sid
+        self.hdr.flags |= HDRF_SCLOSE
+        return self
+        
+    def encode(self):
+        """
+        Returns the encoded representation of this message.
+        """
+        bodybytes = _dict_to_bson(self, False)
+        self.hdr.length = len(bodybytes)
+        return self.hdr.encode() + bodybytes
+        
+
+class RolledBack(SON):
+    """
+    RolledBack Message
+    
+    Message Arguments:
+        snap_id -- None
+        pid -- pid of the worker process that is now live
+    """
+    type = 153
+    
+    def __init__(self, snap_id, pid, _hsid=0, _hflags=0):
+        SON.__init__(self)
+        self.hdr = Hdr(153, _hsid, 0, _hflags)
+        self.type = 153
+        self['t'] = 153
+        self['snap_id'] = snap_id
+        self['pid'] = pid
+        
+    def as_reply_to(self, m):
+        self.hdr.sid = m.hdr.sid
+        self.hdr.flags |= HDRF_SCLOSE
+        return self
+        
+    def encode(self):
+        """
+        Returns the encoded representation of this message.
+        """
+        bodybytes = _dict_to_bson(self, False)
+        self.hdr.length = len(bodybytes)
+        return self.hdr.encode() + bodybytes
+        
+
+class Hibernate(SON):
+    """
+    Save the namespace to disk and exit once the current cell is done.  Returns Hibernated, then the worker shuts down
+    
+    Message Arguments:
+        path -- file to write the namespace to
+    """
+    type = 160
+    
+    def __init__(self, path, _hsid=0, _hflags=0):
+        SON.__init__(self)
+        self.hdr = Hdr(160, _hsid, 0, _hflags)
+        self.type = 160
+        self['t'] = 160
+        self['path'] = path
+        
+    def as_reply_to(self, m):
+        self.hdr.sid = m.hdr.sid
+        self.hdr.flags |= HDRF_SCLOSE
+        return self
+        
+    def encode(self):
+        """
+        Returns the encoded representation of this message.
+        """
+        bodybytes = _dict_to_bson(self, False)
+        self.hdr.length = len(bodybytes)
+        return self.hdr.encode() + bodybytes
+        
+
+class Hibernated(SON):
+    """
+    Hibernated Message
+    
+    Message Arguments:
+        path -- None
+        nbytes -- size of the file written
+        seconds -- time taken to write it
+        n_globals -- number of globals saved by value
+        n_cells -- number of cells to replay on Restore
+    """
+    type = 161
+    
+    def __init__(self, path, nbytes, seconds, n_globals, n_cells, _hsid=0, _hflags=0):
+        SON.__init__(self)
+        self.hdr = Hdr(161, _hsid, 0, _hflags)
+        self.type = 161
+        self['t'] = 161
+        self['path'] = path
+        self['nbytes'] = nbytes
+        self['seconds'] = seconds
+        self['n_globals'] = n_globals
+        self['n_cells'] = n_cells
+        
+    def as_reply_to(self, m):
+        self.hdr.sid = m.hdr.sid
+        self.hdr.flags |= HDRF_SCLOSE
+        return self
+        
+    def encode(self):
+        """
+        Returns the encoded representation of this message.
+        """
+        bodybytes = _dict_to_bson(self, False)
+        self.hdr.length = len(bodybytes)
+        return self.hdr.encode() + bodybytes
+        
+
+class Restore(SON):
+    """
+    Load a hibernated namespace, replaying cells without output.  Returns Restored.  Cells sent after it run in the restored namespace
+    
+    Message Arguments:
+        path -- file written by Hibernate
+    """
+    type = 162
+    
+    def __init__(self, path, _hsid=0, _hflags=0):
+        SON.__init__(self)
+        self.hdr = Hdr(162, _hsid, 0, _hflags)
+        self.type = 162
+        self['t'] = 162
+        self['path'] = path
+        
+    def as_reply_to(self, m):
+        self.hdr.sid = m.hdr.sid
+        self.hdr.flags |= HDRF_SCLOSE
+        return self
+        
+    def encode(self):
+        """
+        Returns the encoded representation of this message.
+        """
+        bodybytes = _dict_to_bson(self, False)
+        self.hdr.length = len(bodybytes)
+        return self.hdr.encode() + bodybytes
+        
+
+class Restored(SON):
+    """
+    Restored Message
+    
+    Message Arguments:
+        path -- None
+        seconds -- time taken to restore
+        errors -- values that failed to load and replayed cells that raised
+    """
+    type = 163
+    
+    def __init__(self, path, seconds, errors, _hsid=0, _hflags=0):
+        SON.__init__(self)
+        self.hdr = Hdr(163, _hsid, 0, _hflags)
+        self.type = 163
+        self['t'] = 163
+        self['path'] = path
+        self['seconds'] = seconds
+        self['errors'] = errors
+        
+    def as_reply_to(self, m):
+        self.hdr.sid = m.hdr.sid
+        self.hdr.flags |= HDRF_SCLOSE
+        return self
+        
+    def encode(self):
+        """
+        Returns the encoded representation of this message.
+        """
+        bodybytes = _dict_to_bson(self, False)
+        self.hdr.length = len(bodybytes)
+        return self.hdr.encode() + bodybytes
+        
@@ -0,0 +1,185 @@
+r"""
+Translation between message bodies and the JSON the WebSocket clients speak.
+
+:func:`bson_to_json` writes the JSON text of a BSON body as it walks the
+bytes, without building the body's SON and then encoding that again.
+Strings are escaped straight from their UTF-8 bytes.
+
+EXAMPLES::
+
+    >>> import sageserver.msg as msg
+    >>> body = str(msg.Stdout('hi\n').encode())[HDR_LEN:]
+    >>> bson_to_json(body)
+    '{"t": 1, "bytes": "hi\\n"}'
+    >>> bson_to_json(body, head='"type": "Stdout", "id": 7', skip='t')
+    '{"type": "Stdout", "id": 7, "bytes": "hi\\n"}'
+"""
+
+from base64 import b64encode
+from json import loads
+from json.encoder import encode_basestring_ascii, FLOAT_REPR, INFINITY
+from struct import Struct
+
+from hdr import HDR_LEN
+
+_int32 = Struct('<i').unpack_from
+_int64 = Struct('<q').unpack_from
+_double = Struct('<d').unpack_from
+
+# raw key -> its JSON text with the separator, there are few distinct keys
+_keys = {}
+
+
+def bson_to_json(data, offset=0, head=None, skip=None):
+    r"""
+    Returns the JSON text of the BSON document at offset in data.
+
+    The output is what ``json.dumps`` gives for the decoded document.  The
+    types used in message bodies are supported: strings, ints, floats,
+    bools, None, documents and arrays.  Binary data is written as a base64
+    string, as JSON has no bytes type.  Other types raise ValueError.
+
+    :param head: JSON members to write first, e.g. ``'"id": 3'``.
+    :param skip: a key to leave out.
+
+    EXAMPLES::
+
+        >>> from bson import BSON, SON
+        >>> from bson.binary import Binary
+        >>> doc = SON([('s', u'caf\xe9 "x"'), ('n', None), ('b', True),
+        ...            ('i', 2 ** 40), ('f', 0.5), ('l', [1, [], {}]),
+        ...            ('d', SON([('x', -1)])), ('bin', Binary('\x00\xff', 0))])
+        >>> bson_to_json(BSON.encode(doc))
+        '{"s": "caf\\u00e9 \\"x\\"", "n": null, "b": true, "i": 1099511627776, "f": 0.5, "l": [1, [], {}], "d": {"x": -1}, "bin": "AP8="}'
+        >>> bson_to_json(BSON.encode({}), head='"id": 3')
+        '{"id": 3}'
+    """
+    out = []
+    _document(data, offset, out, False, head, skip)
+    return ''.join(out)
+
+
+def _document(data, pos, out, array, head=None, skip=None):
+    """
+    Appends the JSON text of the document or array at pos to out.  Returns
+    the position after it.
+    """
+    end = pos + _int32(data, pos)[0]
+    pos += 4
+    append = out.append
+    append('[' if array else '{')
+    sep = ''
+    if head:
+        append(head)
+        sep = ', '
+    while pos < end - 1:
+        t = data[pos]
+        k = data.index('\x00', pos + 1)
+        key = data[pos + 1:k]
+        pos = k + 1
+        if key == skip:
+            append_value = _discard
+        else:
+            append(sep)
+            sep = ', '
+            if not array:
+                kj = _keys.get(key)
+                if kj is None:
+                    kj = _keys[key] = encode_basestring_ascii(key) + ': '
+                append(kj)
+            append_value = append
+        if t == '\x02':
+            n = _int32(data, pos)[0]
+            append_value(encode_basestring_ascii(data[pos + 4:pos + 3 + n]))
+            pos += 4 + n
+        elif t == '\x10':
+            append_value(str(_int32(data, pos)[0]))
+            pos += 4
+        elif t == '\x08':
+            append_value('true' if data[pos] == '\x01' else 'false')
+            pos += 1
+        elif t == '\x0a':
+            append_value('null')
+        elif t == '\x03' or t == '\x04':
+            if append_value is _discard:
+                pos += _int32(data, pos)[0]
+            else:
+                pos = _document(data, pos, out, t == '\x04')
+        elif t == '\x12':
+            append_value(str(_int64(data, pos)[0]))
+            pos += 8
+        elif t == '\x01':
+            append_value(_float(_double(data, pos)[0]))
+            pos += 8
+        elif t == '\x05':
+            n = _int32(data, pos)[0]
+            append_value('"%s"' % (b64encode(data[pos + 5:pos + 5 + n]),))
+            pos += 5 + n
+        else:
+            raise ValueError("unsupported BSON type 0x%02x" % (ord(t),))
+    append(']' if array else '}')
+    return end
+
+
+def _discard(s):
+    pass
+
+
+def _float(f):
+    """
+    Returns the JSON for a float, as ``json.dumps`` writes it.
+    """
+    if f != f:
+        return 'NaN'
+    if f == INFINITY:
+        return 'Infinity'
+    if f == -INFINITY:
+        return '-Infinity'
+    return FLOAT_REPR(f)
+
+
+def json_to_msg(text, classes):
+    """
+    Returns ``(message, client id)`` for the JSON text of a client's
+    message, ``{"type": <class name>, "id": <client id>, <fields>}``.
+    Raises ValueError if it isn't one of classes, a dict of class name to
+    message class.
+
+    Requests are small, so this is ``json.loads`` and the class's
+    constructor, which fills in the defaults.
+
+    EXAMPLES::
+
+        >>> import sageserver.msg as msg
+        >>> classes = {'ExecCell': msg.ExecCell}
+        >>> m, cid = json_to_msg('{"type": "ExecCell", "id": 3, '
+        ...                      '"source": "1"}', classes)
+        >>> m.type == msg.EXEC_CELL, m['source'], cid
+        (True, u'1', 3)
+        >>> json_to_msg('{"type": "Hdr", "id": 3}', classes)
+        Traceback (most recent call last):
+            ...
+        ValueError: unknown message type u'Hdr'
+        >>> json_to_msg('{"type": "ExecCell", "src": "1"}', classes)
+        Traceback (most recent call last):
+            ...
+        ValueError: bad ExecCell: __init__() got an unexpected keyword argument 'src'
+    """
+    d = loads(text)
+    if not isinstance(d, dict):
+        raise ValueError("not a message: %r" % (d,))
+    name = d.pop('type', None)
+    cls = classes.get(name)
+    if cls is None:
+        raise ValueError("unknown message type %r" % (name,))
+    client_id = d.pop('id', 0)
+    try:
+        m = cls(**dict((str(k), v) for k, v in d.iteritems()))
+    except TypeError, e:
+        raise ValueError("bad %s: %s" % (name, e))
+    return m, client_id
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -3,6 +3,7 @@ Random Utility Classes.
 """
 
 from collections import deque
+import re
 
 
 class JoinBuffer(object):
@@ -25,6 +26,34 @@ class JoinBuffer(object):
         self._bufs.append(bytes)
         self._buflen += len(bytes)
         
+    def find(self, byte, start=0):
+        r"""
+        Returns the index of the first ``byte`` at or after start, or -1.
+        Doesn't join or copy the buffers.
+
+        EXAMPLES::
+
+            >>> jb = JoinBuffer()
+            >>> jb.extend('ab')
+            >>> jb.extend('cd\nef')
+            >>> jb.find('\n')
+            4
+            >>> jb.popleft(3)
+            'abc'
+            >>> jb.find('\n'), jb.find('\n', 2), jb.find('x')
+            (1, -1, -1)
+        """
+        # re searches buffer objects in place, str.find doesn't
+        pattern = re.compile(re.escape(byte))
+        offset = 0
+        for buf in self._bufs:
+            if offset + len(buf) > start:
+                m = pattern.search(buf, max(0, start - offset))
+                if m is not None:
+                    return offset + m.start()
+            offset += len(buf)
+        return -1
+
     def popall(self, join=True):
         r = b''.join(map(bytes, self._bufs)) if join else None
         self.clear()
@@ -0,0 +1,421 @@
+import json
+import os
+import stat
+import time
+import unittest
+
+from twisted.internet import reactor
+from twisted.internet.testing import StringTransport
+
+from sageserver.compnode.manager.manager import (DEFAULT_CONFIG, Worker,
+        WorkerService, WebSocketFactory)
+from sageserver.compnode.manager.websocket import (OP_CLOSE, OP_TEXT,
+        decode_frame, encode_frame, mask)
+from sageserver.frontend.frontend import FrontendService
+import sageserver.msg as msg
+from sageserver.msg.decodedmsg import MsgDecoder
+
+
+class FakeProcess(object):
+    """
+    Stands in for a worker process, keeping the messages written to it.
+    """
+
+    _next_pid = [2000000]
+
+    def __init__(self, started):
+        """
+        :param started: a list the sources of the ExecCells are appended
+            to, in the order they're sent to any worker.
+        """
+        self.pid = self._next_pid[0]
+        self._next_pid[0] += 1
+        self.received = []
+        self.paused = False
+        self.killed = False
+        self._started = started
+        self._decoder = MsgDecoder()
+
+    def writeToChild(self, fd, data):
+        for m in self._decoder.feed(data):
+            self.received.append(m)
+            if m.type == msg.EXEC_CELL:
+                self._started.append(m['source'])
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def signalProcess(self, signal):
+        self.killed = True
+
+
+class FakeWorkerService(WorkerService):
+
+    def __init__(self, config):
+        WorkerService.__init__(self, config)
+        self.started = [] # sources of the ExecCells sent
+
+    def _start_worker(self):
+        w = Worker(self)
+        self._starting[w] = (reactor.callLater(3600, lambda: None),
+                             time.time())
+        w.makeConnection(FakeProcess(self.started))
+        return w
+
+
+class Client(object):
+    """
+    A WebSocket connection to the manager over a StringTransport.
+    """
+
+    def __init__(self, service, query=''):
+        self.protocol = WebSocketFactory(service).buildProtocol(None)
+        self.transport = StringTransport()
+        self.protocol.makeConnection(self.transport)
+        self.protocol.dataReceived(
+                'GET /?%s HTTP/1.1\r\n'
+                'Upgrade: websocket\r\n'
+                'Connection: Upgrade\r\n'
+                'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+                'Sec-WebSocket-Version: 13\r\n\r\n' % (query,))
+        head, _, rest = self.transport.value().partition('\r\n\r\n')
+        assert head.startswith('HTTP/1.1 101'), head
+        self.transport.clear()
+        self._buf = rest
+        self.session = self.protocol.session
+
+    def send(self, m, client_id):
+        d = dict(m)
+        del d['t']
+        d['type'] = msg.TYPE_CLASSES[m.type].__name__
+        d['id'] = client_id
+        self.send_frame(OP_TEXT, json.dumps(d))
+
+    def send_frame(self, opcode, payload):
+        key = os.urandom(4)
+        f = encode_frame(opcode, payload)
+        hdr = f[:len(f) - len(payload)]
+        self.protocol.dataReceived(hdr[0] + chr(ord(hdr[1]) | 0x80)
+                                   + hdr[2:] + key + mask(payload, key))
+
+    def frames(self):
+        """
+        Returns the ``(opcode, payload)`` of the frames received since the
+        last call.
+        """
+        self._buf += self.transport.value()
+        self.transport.clear()
+        frames = []
+        offset = 0
+        while True:
+            f = decode_frame(self._buf, offset)
+            if f is None:
+                break
+            fin, opcode, payload, offset = f
+            frames.append((opcode, payload))
+        self._buf = self._buf[offset:]
+        return frames
+
+    def messages(self):
+        """
+        Returns the JSON messages received since the last call.
+        """
+        return [json.loads(payload) for opcode, payload in self.frames()
+                if opcode == OP_TEXT]
+
+    def drop(self):
+        self.protocol.connectionLost(None)
+
+
+class ManagerTestCase(unittest.TestCase):
+    """
+    Runs a WorkerService with fake workers, which the tests answer for.
+    The reactor isn't run, calls it schedules are cancelled.
+    """
+
+    config = {}
+
+    def setUp(self):
+        config = dict(DEFAULT_CONFIG)
+        config.update({
+            'exc_hibernate_after': None,
+            'exc_replay_disk': 0,
+            'exc_min_idle_workers': 1,
+        })
+        config.update(self.config)
+        self.service = FakeWorkerService(config)
+        self.service.startService()
+        self._ready()
+
+    def tearDown(self):
+        self.service.stopService()
+        for call in reactor.getDelayedCalls():
+            if call.active():
+                call.cancel()
+
+    def _ready(self):
+        """
+        Answers the startup IsComputing of the workers being started, until
+        no more are.
+        """
+        while self.service._starting:
+            for w in list(self.service._starting):
+                self._reply(w, msg.No())
+
+    def _reply(self, w, *msgs):
+        w.childDataReceived(4, ''.join(str(m.encode()) for m in msgs))
+
+    def _worker(self, client):
+        return client.session._worker
+
+    def _received(self, w, type):
+        """
+        Returns the messages of type the worker w was sent.
+        """
+        return [m for m in w.transport.received if m.type == type]
+
+    def _connect(self, user='alice', query=''):
+        c = Client(self.service, query or 'user=' + user)
+        c.messages()
+        return c
+
+    def _exec(self, c, source, client_id):
+        c.send(msg.ExecCell(source), client_id)
+        self._ready()
+
+    def _finish(self, w, *outputs):
+        """
+        Answers the oldest cell still running on w with outputs and a
+        Done.
+        """
+        execs = self._received(w, msg.EXEC_CELL)
+        m = execs[len(execs) - len(w._running)]
+        self._reply(w, *[msg.Stdout(s, _hsid=m.hdr.sid) for s in outputs]
+                        + [msg.Done().as_reply_to(m)])
+
+
+class TestSessionBackpressure(ManagerTestCase):
+
+    config = {'exc_send_high_water': 1000, 'exc_send_low_water': 100}
+
+    def test_pause_and_resume(self):
+        c = self._connect()
+        self._exec(c, 'f()', 1)
+        w = self._worker(c)
+        c.protocol.pauseProducing()
+        m, = self._received(w, msg.EXEC_CELL)
+        self._reply(w, msg.Stdout('x' * 600, _hsid=m.hdr.sid))
+        self.assertFalse(w.transport.paused)
+        self._reply(w, msg.Stdout('y' * 600, _hsid=m.hdr.sid))
+        # over the high watermark
+        self.assertTrue(w.transport.paused)
+        self.assertEqual(c.frames(), [])
+        self.assertTrue(c.session.buffered_bytes > 1000)
+        c.protocol.resumeProducing()
+        self.assertFalse(w.transport.paused)
+        self.assertEqual([(d['type'], len(d['bytes'])) for d in c.messages()],
+                         [('Stdout', 1200)])
+        self.assertEqual(self.service.stats.get('backpressure_pauses'), 1)
+
+
+class TestSessionReplay(ManagerTestCase):
+
+    config = {'exc_replay_memory': 1024}
+
+    def _reconnect(self, c, seq):
+        c.drop()
+        c2 = Client(self.service, 'session=%s&seq=%d' % (c.session.token,
+                                                          seq))
+        return c2, c2.messages()
+
+    def test_replay_after_reconnect(self):
+        c = self._connect()
+        self._exec(c, 'f()', 1)
+        w = self._worker(c)
+        self._finish(w, 'a', 'b')
+        self.assertEqual([d['type'] for d in c.messages()],
+                         ['Stdout', 'Stdout', 'Done'])
+        # the client only saw the first of them
+        c2, msgs = self._reconnect(c, 1)
+        self.assertIs(c2.session, c.session)
+        self.assertEqual(msgs[0]['type'], 'Session')
+        self.assertEqual((msgs[0]['seq'], msgs[0]['resumed']), (1, True))
+        self.assertEqual([(d['type'], d.get('bytes')) for d in msgs[1:]],
+                         [('Stdout', 'b'), ('Done', None)])
+        # and carries on
+        self._exec(c2, 'g()', 2)
+        self._finish(w, 'c')
+        self.assertEqual([d['id'] for d in c2.messages()], [2, 2])
+
+    def test_replay_with_a_gap(self):
+        c = self._connect()
+        self._exec(c, 'f()', 1)
+        w = self._worker(c)
+        self._finish(w, *['%03d' % i + 'x' * 200 for i in range(20)])
+        self.assertEqual(len(c.messages()), 21)
+        # the first messages are no longer kept
+        c2, msgs = self._reconnect(c, 1)
+        self.assertIs(c2.session, c.session)
+        self.assertEqual(len(msgs), 1)
+        self.assertEqual((msgs[0]['seq'], msgs[0]['resumed']), (21, False))
+        self.assertEqual(self.service.stats.get('replay_gaps'), 1)
+
+
+class TestFairQueue(ManagerTestCase):
+
+    config = {'exc_max_running': 1, 'exc_user_max_queued': 2}
+
+    def test_users_take_turns(self):
+        alice = self._connect('alice')
+        for i in range(3):
+            alice.send(msg.ExecCell('a%d' % i), i + 1)
+        self._ready()
+        bob = self._connect('bob')
+        self._exec(bob, 'b0', 1)
+        self.assertEqual(self.service.started, ['a0'])
+        wa, wb = self._worker(alice), self._worker(bob)
+        for w in [wa, wa, wb]:
+            self._finish(w)
+        # bob's first cell goes ahead of alice's third
+        self.assertEqual(self.service.started, ['a0', 'a1', 'b0', 'a2'])
+        queued = [d['id'] for d in alice.messages() if d['type'] == 'Queued']
+        self.assertEqual(sorted(set(queued)), [2, 3])
+
+    def test_user_quota(self):
+        alice = self._connect('alice')
+        for i in range(4):
+            alice.send(msg.ExecCell('a%d' % i), i + 1)
+        self._ready()
+        msgs = alice.messages()
+        # one running, two waiting, the fourth turned away
+        self.assertEqual([(d['type'], d['id']) for d in msgs
+                          if d['type'] != 'Queued'],
+                         [('Rejected', 4), ('Done', 4)])
+        rejected, = [d for d in msgs if d['type'] == 'Rejected']
+        self.assertEqual(rejected['reason'], 'USER_QUEUE_FULL')
+        self.assertEqual(self.service.started, ['a0'])
+        self.assertEqual(self.service.stats.get('rejected_user_queue_full'),
+                         1)
+
+
+class TestRecycle(ManagerTestCase):
+
+    config = {'exc_recycle_cells': 2}
+
+    def test_recycled_after_max_cells(self):
+        c = self._connect()
+        self._exec(c, 'x = 1', 1)
+        w = self._worker(c)
+        self._finish(w)
+        self.assertEqual(self._received(w, msg.HIBERNATE), [])
+        self._exec(c, 'y = 2', 2)
+        self._finish(w)
+        self.assertEqual([d['type'] for d in c.messages()],
+                         ['Done', 'Notice', 'Done'])
+        hib, = self._received(w, msg.HIBERNATE)
+        hib_dir = os.path.dirname(hib['path'])
+        self.assertEqual(stat.S_IMODE(os.stat(hib_dir).st_mode), 0700)
+        self.assertEqual(self.service.stats.get('recycled_cells'), 1)
+        # held until the new worker has the namespace
+        c.send(msg.Interrupt(), 3)
+        self.assertEqual(self._received(w, msg.INTERRUPT), [])
+        self._reply(w, msg.Hibernated(hib['path'], 10, 0.01, 2, 0))
+        self._ready()
+        w2 = self._worker(c)
+        self.assertIsNot(w2, w)
+        self.assertEqual([m.type for m in w2.transport.received[1:]],
+                         [msg.RESTORE, msg.INTERRUPT])
+        self.assertEqual(w2.transport.received[1]['path'], hib['path'])
+
+    def test_shutdown_stops_the_loops(self):
+        service = self.service
+        loops = [service._queue_loop, service._pool_loop]
+        self.assertTrue(all(loop.running for loop in loops))
+        service.stopService()
+        self.assertFalse(any(loop.running for loop in loops))
+        self.assertFalse(os.path.exists(service._hibernate_dir))
+        service.startService()
+
+
+class TestSessionRequests(ManagerTestCase):
+
+    def test_manager_requests_refused(self):
+        c = self._connect()
+        self._exec(c, 'x = 1', 1)
+        w = self._worker(c)
+        c.send(msg.Shutdown(), 2)
+        c.send(msg.Hibernate('/tmp/x'), 3)
+        self.assertEqual([(d['type'], d['id']) for d in c.messages()],
+                         [('No', 2), ('No', 3)])
+        self.assertEqual(self._received(w, msg.SHUTDOWN), [])
+        self.assertEqual(self._received(w, msg.HIBERNATE), [])
+
+    def test_held_during_rollback(self):
+        c = self._connect()
+        self._exec(c, 'x = 1', 1)
+        w = self._worker(c)
+        self._finish(w)
+        c.send(msg.Rollback(1), 2)
+        c.send(msg.ExecCell('print x'), 3)
+        rb, = self._received(w, msg.ROLLBACK)
+        self.assertEqual(len(self._received(w, msg.EXEC_CELL)), 1)
+        self._reply(w, msg.RolledBack(1, 12345, _hsid=rb.hdr.sid,
+                                      _hflags=msg.HDRF_SCLOSE))
+        self.assertEqual(self.service.started, ['x = 1', 'print x'])
+        self.assertEqual([d['type'] for d in c.messages()],
+                         ['Done', 'RolledBack'])
+
+    def test_close_code_echoed(self):
+        c = self._connect()
+        c.send_frame(OP_CLOSE, '\x03\xe9')
+        self.assertEqual(c.frames(), [(OP_CLOSE, '\x03\xe9')])
+        self.assertTrue(c.transport.disconnecting)
+
+
+class TestFrontendRouting(unittest.TestCase):
+
+    def setUp(self):
+        self.service = FrontendService({}, [('a', 'localhost', 8081),
+                                            ('b', 'localhost', 8082),
+                                            ('c', 'localhost', 8083)])
+        self._report()
+
+    def _report(self):
+        for name in 'abc':
+            self.service.scheduler.report(name, {
+                    'sessions': 0, 'idle_workers': 8, 'load': 0.0,
+                    'cpus': 4, 'free_ram': 2 ** 30})
+
+    def _route(self, query, exclude=()):
+        node = self.service.route('GET /?%s HTTP/1.1\r\nHost: x' % (query,),
+                                  None, exclude)
+        return node.name if node is not None else None
+
+    def test_session_token(self):
+        self.assertEqual(self._route('session=b-0123abcd&seq=4'), 'b')
+        self.assertEqual(self._route('session=c-0123abcd'), 'c')
+        # a node that couldn't be reached isn't tried again
+        self.assertNotEqual(self._route('session=b-0123abcd', ['b']), 'b')
+
+    def test_user(self):
+        first = self._route('user=alice')
+        self._report()
+        self.assertEqual(self._route('user=alice'), first)
+        # until it has more than its share of the sessions placed
+        self.assertNotEqual(self._route('user=alice'), first)
+        self._report()
+        self.assertNotEqual(self._route('user=alice', [first]), first)
+        self.service.scheduler.failed(first)
+        self.assertNotEqual(self._route('user=alice'), first)
+
+    def test_no_node(self):
+        for name in 'abc':
+            self.service.scheduler.failed(name)
+        self.assertEqual(self._route('user=alice'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,18 +8,25 @@ from sageserver.compnode.worker.msgr import PipeMsgr
 import sageserver.msg as msg
 from sageserver.msg.decodedmsg import MsgDecoder
 
-class TestWorker(unittest.TestCase):
-    
+class WorkerTestCase(unittest.TestCase):
+    """
+    Starts a worker in a child process for each test.
+    """
+
+    worker_kwargs = {}
+
     def setUp(self):
         p2c_r, self._p2c_w = os.pipe()
         self._c2p_r, c2p_w = os.pipe()
+        # kept between reads, which can end in the middle of a message
+        self._decoder = MsgDecoder()
         from multiprocessing import Process
         self._childp = Process(target=self._child_start, args=(p2c_r, c2p_w))
         self._childp.start()
         
     def _child_start(self, p2c_r, c2p_w):
         msgr = PipeMsgr(p2c_r, c2p_w)
-        w = Worker(msgr)
+        w = Worker(msgr, **self.worker_kwargs)
         w.loop_forever()
         
     def _send_msg(self, m):
@@ -32,7 +39,7 @@ class TestWorker(unittest.TestCase):
         """
         Returns a list of child messages.
         """
-        decoder = MsgDecoder()
+        decoder = self._decoder
         msgs = []
         if timeout is None:
             endt = time.time() - 1.0
@@ -45,17 +52,36 @@ class TestWorker(unittest.TestCase):
                 rbytes = os.read(fd, 4096)
                 msgs.extend(decoder.feed(rbytes))
         return msgs
-        
+
+    def _exec(self, source, n=1):
+        self._send_msg(msg.ExecCell(source))
+        return self._get_child_msgs(n, timeout=2.0)
+
+    def tearDown(self):
+        if self._childp.is_alive():
+            self._send_msg(msg.Shutdown())
+            self._childp.join(0.25)
+            if self._childp.is_alive():
+                self._childp.terminate()
+
+
+class TestWorker(WorkerTestCase):
 
     def test_Shutdown(self):
         self._send_msg(msg.Shutdown())
-        self._childp.join(1.0)
+        self._childp.join(5.0)
         self.assertFalse(self._childp.is_alive())
         
     def test_IsComputing(self):
-        self._send_msg(msg.IsComputing())
-        msgs = self._get_child_msgs(timeout=0.25)
-        self.assertEqual(len(msgs), 1)
+        # Yes until the main thread is waiting for cells, which takes
+        # longer to start than the receiving thread
+        for i in range(20):
+            self._send_msg(msg.IsComputing())
+            msgs = self._get_child_msgs(timeout=0.25)
+            self.assertEqual(len(msgs), 1)
+            if msgs[0].type == msg.NO:
+                break
+            time.sleep(0.05)
         self.assertEqual(msgs[0].type, msg.NO)
         
     def test_exec_hello_world(self):
@@ -63,15 +89,341 @@ class TestWorker(unittest.TestCase):
         msgs = self._get_child_msgs(2, timeout=0.25)
         self.assertEqual([m.type for m in msgs],
                          [msg.STDOUT, msg.STDOUT, msg.DONE])
-        
-    
-    def tearDown(self):
-        if self._childp.is_alive():
-            self._send_msg(msg.Shutdown())
-            self._childp.join(0.25)
-            if self._childp.is_alive():
-                self._childp.terminate()
-        
+
+    def test_exec_timeout(self):
+        self._send_msg(msg.ExecCell('while 1: pass', timeout=0.2,
+                                    except_msg=True))
+        msgs = self._get_child_msgs(2, timeout=2.0)
+        self.assertEqual([m.type for m in msgs], [msg.EXCEPT, msg.DONE])
+        self.assertEqual(msgs[0]['etype'], 'CellTimeout')
+
+    def test_exec_cpu_timeout(self):
+        self._send_msg(msg.ExecCell('while 1: pass', cpu_timeout=0.2,
+                                    except_msg=True))
+        msgs = self._get_child_msgs(2, timeout=2.0)
+        self.assertEqual([m.type for m in msgs], [msg.EXCEPT, msg.DONE])
+        self.assertEqual(msgs[0]['etype'], 'CellCPUTimeout')
+
+    def test_exec_timeout_reading_stdin(self):
+        self._send_msg(msg.ExecCell('raw_input()', timeout=0.2,
+                                    except_msg=True))
+        msgs = self._get_child_msgs(3, timeout=2.0)
+        self.assertEqual([m.type for m in msgs],
+                         [msg.NEED_STDIN, msg.EXCEPT, msg.DONE])
+        self.assertEqual(msgs[1]['etype'], 'CellTimeout')
+
+    def test_exec_batch(self):
+        self._send_msg(msg.ExecBatch([
+            {'sid': 11, 'source': 'print 1'},
+            {'sid': 12, 'source': 'raise ValueError', 'except_msg': True},
+            {'sid': 13, 'source': 'print 2'},
+        ], _hsid=10))
+        msgs = self._get_child_msgs(7, timeout=2.0)
+        self.assertEqual([(m.type, m.hdr.sid) for m in msgs],
+                         [(msg.STDOUT, 11), (msg.STDOUT, 11), (msg.DONE, 11),
+                          (msg.EXCEPT, 12), (msg.DONE, 12),
+                          (msg.SKIPPED, 13), (msg.DONE, 10)])
+        self.assertEqual(msgs[5]['reason'], 'ERROR')
+
+    def test_incremental_batch(self):
+        cells = [{'sid': 1, 'cid': 1, 'source': 'a = 1'},
+                 {'sid': 2, 'cid': 2, 'source': 'b = a + 1'},
+                 {'sid': 3, 'cid': 3, 'source': 'c = 10'},
+                 {'sid': 4, 'cid': 4, 'source': 'print b + c'}]
+        self._send_msg(msg.ExecBatch(cells, incremental=True))
+        msgs = self._get_child_msgs(8, timeout=2.0)
+        self.assertEqual(msgs[0]['cids'], [1, 2, 3, 4])
+        cells[0]['source'] = 'a = 5'
+        self._send_msg(msg.ExecBatch(cells, incremental=True))
+        msgs = self._get_child_msgs(8, timeout=2.0)
+        self.assertEqual(msgs[0].type, msg.AFFECTED)
+        self.assertEqual(msgs[0]['cids'], [1, 2, 4])
+        self.assertEqual([(m.type, m.hdr.sid) for m in msgs[1:]],
+                         [(msg.DONE, 1), (msg.DONE, 2), (msg.SKIPPED, 3),
+                          (msg.STDOUT, 4), (msg.STDOUT, 4), (msg.DONE, 4),
+                          (msg.DONE, 0)])
+        self.assertEqual(msgs[4]['bytes'], '16')
+
+    def test_cache(self):
+        source = '%cache=True\nimport random\nr = random.random()\nprint a'
+        def run():
+            msgs = self._exec(source, 3)
+            self.assertEqual([m.type for m in msgs],
+                             [msg.STDOUT, msg.STDOUT, msg.DONE])
+            return msgs[0]['bytes']
+        def get_r():
+            return self._exec('print r', 3)[0]['bytes']
+        self._exec('a = 1')
+        self.assertEqual(run(), '1')
+        r = get_r()
+        self._exec('r = None')
+        # a hit replays the output and restores r without drawing again
+        self.assertEqual(run(), '1')
+        self.assertEqual(get_r(), r)
+        self._exec('a = 2')
+        self.assertEqual(run(), '2')
+        self.assertNotEqual(get_r(), r)
+
+    def test_interrupt_batches(self):
+        self._send_msg(msg.ExecBatch([
+            {'sid': 21, 'source': 'while 1: pass', 'except_msg': True},
+            {'sid': 22, 'source': 'print 1'},
+        ], _hsid=20))
+        self._send_msg(msg.ExecBatch([{'sid': 31, 'source': 'print 2'}],
+                                     _hsid=30))
+        time.sleep(0.2)
+        self._send_msg(msg.Interrupt(_hsid=40))
+        msgs = self._get_child_msgs(7, timeout=2.0)
+        got = [(m.type, m.hdr.sid) for m in msgs]
+        self.assertEqual(got[:6],
+                         [(msg.EXCEPT, 21), (msg.DONE, 21),
+                          (msg.SKIPPED, 22), (msg.DONE, 20),
+                          (msg.SKIPPED, 31), (msg.DONE, 30)])
+        self.assertEqual(msgs[0]['etype'], 'KeyboardInterrupt')
+        self.assertEqual(msgs[2]['reason'], 'INTERRUPT')
+        self.assertEqual(got[6], (msg.YES, 40))
+
+    def test_progress(self):
+        msgs = self._exec('for i in range(1000): progress(i / 999.0)', 3)
+        # the first is sent, the rest are throttled down to the last
+        self.assertEqual([m.type for m in msgs],
+                         [msg.PROGRESS, msg.PROGRESS, msg.DONE])
+        self.assertEqual([m['fraction'] for m in msgs[:2]], [0.0, 1.0])
+
+    def test_stdin_read_ahead(self):
+        self._send_msg(msg.ExecCell('import sys\n'
+                                    'print [sys.stdin.read(4) for i in '
+                                    'range(3)]', echo_stdin=False))
+        m, = self._get_child_msgs(timeout=2.0)
+        self.assertEqual((m.type, m['nbytes'], m['window']),
+                         (msg.NEED_STDIN, 4, 65536))
+        # sent ahead, the next reads don't ask for more
+        self._send_msg(msg.Stdin('aaaabbbbcccc'))
+        msgs = self._get_child_msgs(3, timeout=2.0)
+        self.assertEqual([m.type for m in msgs],
+                         [msg.STDOUT, msg.STDOUT, msg.DONE])
+        self.assertEqual(msgs[0]['bytes'], "['aaaa', 'bbbb', 'cccc']")
+
+    def test_stdin_readlines(self):
+        self._send_msg(msg.ExecCell('import sys\n'
+                                    'print sys.stdin.readlines()'))
+        m, = self._get_child_msgs(timeout=2.0)
+        self.assertEqual(m.type, msg.NEED_STDIN)
+        self._send_msg(msg.Stdin('a\nbb\nc'))
+        self._send_msg(msg.Stdin(''))
+        # a second NeedStdin comes first if the worker reads again before
+        # the EOF has arrived
+        msgs = []
+        while not msgs or msgs[-1].type != msg.DONE:
+            more = self._get_child_msgs(timeout=2.0)
+            self.assertTrue(more)
+            msgs.extend(more)
+        # one echo for each line, then the EOF
+        self.assertEqual([m['bytes'] for m in msgs if m.type == msg.STDIN],
+                         ['a\n', 'bb\n', 'c', ''])
+        self.assertEqual([m['bytes'] for m in msgs if m.type == msg.STDOUT],
+                         ["['a\\n', 'bb\\n', 'c']", '\n'])
+
+    def test_display_truncated(self):
+        self._exec('x = range(100000)')
+        msgs = self._exec('x', 10)
+        self.assertEqual([m.type for m in msgs[-2:]],
+                         [msg.TRUNCATED, msg.DONE])
+        shown = ''.join(m['bytes'] for m in msgs[:-2])
+        self.assertEqual(len(shown), 65536)
+        self.assertEqual(msgs[-2]['shown'], 65536)
+        self._send_msg(msg.FetchMore(msgs[-2]['more_id'], 10 ** 7, _hsid=7))
+        msgs = []
+        while not msgs or msgs[-1].type != msg.DONE:
+            msgs.extend(self._get_child_msgs(timeout=2.0))
+        rest = ''.join(m['bytes'] for m in msgs[:-1])
+        self.assertEqual(shown + rest, repr(range(100000)) + '\n')
+
+    def test_output_limit(self):
+        self._send_msg(msg.ExecCell('while 1: print "x" * 99',
+                                    output_limit=10000, output_interrupt=True,
+                                    except_msg=True))
+        msgs = []
+        while not msgs or msgs[-1].type != msg.DONE:
+            msgs.extend(self._get_child_msgs(timeout=2.0))
+        self.assertEqual([m.type for m in msgs[-3:]],
+                         [msg.EXCEPT, msg.STDERR, msg.DONE])
+        self.assertEqual(msgs[-3]['etype'], 'OutputLimitExceeded')
+        self.assertEqual(msgs[-2]['bytes'],
+                         '[output limited: 10000 of 10099 bytes shown]\n')
+        shown = ''.join(m['bytes'] for m in msgs[:-3])
+        self.assertEqual(shown, ('x' * 99 + '\n') * 100)
+
+    def test_display_rich(self):
+        self._exec('class Png(object):\n'
+                   '    def __init__(self, n): self.n = n\n'
+                   '    def _repr_png_(self): return "\\x89PNG" * self.n')
+        msgs = self._exec('display(Png(1)); Png(100000)', 3)
+        self.assertEqual([m.type for m in msgs],
+                         [msg.DISPLAY, msg.DISPLAY, msg.DONE])
+        self.assertEqual(msgs[0]['mime'], 'image/png')
+        self.assertEqual(str(msgs[0]['data']), '\x89PNG')
+        # too big to send inline
+        self.assertEqual(msgs[1]['data'], None)
+        self.assertEqual(msgs[1]['size'], 400000)
+        self._send_msg(msg.FetchDisplay(msgs[1]['ref'], _hsid=12))
+        m, = self._get_child_msgs(timeout=2.0)
+        self.assertEqual(m.type, msg.DISPLAY)
+        self.assertEqual(str(m['data']), '\x89PNG' * 100000)
+
+    def test_snapshot_rollback(self):
+        self._exec('a = 1')
+        self._send_msg(msg.Snapshot())
+        msgs = self._get_child_msgs(timeout=2.0)
+        self.assertEqual(msgs[0].type, msg.SNAPSHOT_TAKEN)
+        snap_id = msgs[0]['snap_id']
+        for _ in range(2):
+            # a snapshot can be rolled back to more than once
+            self._exec('a = 2')
+            self._send_msg(msg.Rollback(snap_id))
+            msgs = self._get_child_msgs(timeout=2.0)
+            self.assertEqual(msgs[0].type, msg.ROLLED_BACK)
+            self.assertNotEqual(msgs[0]['pid'], self._childp.pid)
+            msgs = self._exec('print a', 3)
+            self.assertEqual([m.type for m in msgs],
+                             [msg.STDOUT, msg.STDOUT, msg.DONE])
+            self.assertEqual(msgs[0]['bytes'], '1')
+        self._send_msg(msg.Shutdown())
+
+    def test_rollback_with_more_in_the_read(self):
+        self._exec('a = 1')
+        self._send_msg(msg.Snapshot())
+        snap_id = self._get_child_msgs(timeout=2.0)[0]['snap_id']
+        self._exec('a = 2')
+        # read by the worker that hands off, decoded by the snapshot
+        data = (msg.Rollback(snap_id, _hsid=5).encode()
+                + msg.ExecCell('print a', _hsid=6).encode())
+        os.write(self._p2c_w, str(data))
+        msgs = self._get_child_msgs(4, timeout=2.0)
+        self.assertEqual([(m.type, m.hdr.sid) for m in msgs],
+                         [(msg.ROLLED_BACK, 5), (msg.STDOUT, 6),
+                          (msg.STDOUT, 6), (msg.DONE, 6)])
+        self.assertEqual(msgs[1]['bytes'], '1')
+        # the promoted worker isn't our child, tearDown can't reap it
+        self._send_msg(msg.Shutdown())
+        m, = self._get_child_msgs(timeout=2.0)
+        self.assertEqual(m.type, msg.SHUTDOWN)
+
+    def test_snapshot_eviction(self):
+        snap_ids = []
+        for i in range(5):
+            self._send_msg(msg.Snapshot())
+            m, = self._get_child_msgs(timeout=2.0)
+            snap_ids.append(m['snap_id'])
+        self.assertEqual(m['evicted'], [snap_ids[0]])
+        self._send_msg(msg.Rollback(snap_ids[0]))
+        m, = self._get_child_msgs(timeout=2.0)
+        self.assertEqual(m.type, msg.NO)
+
+    def test_hibernate_restore(self):
+        import tempfile
+        path = tempfile.mktemp()
+        self._exec('import os\nx = [1, 2]')
+        self._exec('def f(): return x + [os.sep]')
+        self._send_msg(msg.Hibernate(path))
+        m, sd = self._get_child_msgs(2, timeout=2.0)
+        self.assertEqual((m.type, sd.type), (msg.HIBERNATED, msg.SHUTDOWN))
+        # x is pickled, the two cells that bound os and f are replayed
+        self.assertEqual((m['n_globals'], m['n_cells']), (1, 2))
+        self._childp.join(2.0)
+        self.assertFalse(self._childp.is_alive())
+
+        self.setUp()
+        try:
+            self._send_msg(msg.Restore(path))
+            m, = self._get_child_msgs(timeout=2.0)
+            self.assertEqual(m.type, msg.RESTORED)
+            self.assertEqual(m['errors'], [])
+            msgs = self._exec('print f()', 3)
+            self.assertEqual(msgs[0]['bytes'], "[1, 2, '/']")
+        finally:
+            os.unlink(path)
+
+
+class TestWorkerParallel(WorkerTestCase):
+
+    worker_kwargs = {'max_procs': 4}
+    def test_parallel_batch(self):
+        self._exec('import os\nppid = os.getpid()')
+        self._send_msg(msg.ExecBatch([
+            {'sid': 1, 'source': 'a = os.getpid() != ppid\nprint 1'},
+            {'sid': 2, 'source': 'b = os.getpid() != ppid\nprint 2'},
+            {'sid': 3, 'source': 'print a and b'},
+        ], parallel=True, _hsid=4))
+        msgs = self._get_child_msgs(10, timeout=5.0)
+        self.assertEqual([(m.type, m.hdr.sid) for m in msgs],
+                         [(msg.STDOUT, 1), (msg.STDOUT, 1), (msg.DONE, 1),
+                          (msg.STDOUT, 2), (msg.STDOUT, 2), (msg.DONE, 2),
+                          (msg.STDOUT, 3), (msg.STDOUT, 3), (msg.DONE, 3),
+                          (msg.DONE, 4)])
+        self.assertEqual([msgs[i]['bytes'] for i in (0, 3, 6)],
+                         ['1', '2', 'True'])
+
+    def test_parallel_batch_mutates_in_place(self):
+        self._exec('import os\nppid = os.getpid()\nl = []')
+        self._send_msg(msg.ExecBatch([
+            {'sid': 1, 'source': 'l.append(os.getpid() != ppid)'},
+            {'sid': 2, 'source': 'b = 2'},
+            {'sid': 3, 'source': 'print l'},
+        ], parallel=True, _hsid=4))
+        msgs = self._get_child_msgs(6, timeout=5.0)
+        # the append isn't lost in a child
+        self.assertEqual([m['bytes'] for m in msgs if m.type == msg.STDOUT],
+                         ['[False]', '\n'])
+
+    def test_parallel_map(self):
+        self._exec('import os\nppid = os.getpid()\n'
+                   'def f(x): return (x * x, os.getpid() != ppid)')
+        msgs = self._exec('r = parallel_map(f, range(100))\n'
+                          'print [a for a, _ in r] == [x * x for x in '
+                          'range(100)], all(b for _, b in r)', 6)
+        progress = [m for m in msgs if m.type == msg.PROGRESS]
+        msgs = [m for m in msgs if m.type != msg.PROGRESS]
+        self.assertEqual(msgs[0]['bytes'], 'True')
+        self.assertEqual(msgs[2]['bytes'], 'True')
+        self.assertEqual(progress[-1]['fraction'], 1.0)
+
+    def test_parallel_map_interrupt(self):
+        self._exec('import os, time')
+        self._send_msg(msg.ExecCell(
+                'parallel_for(time.sleep, [10] * 8)', except_msg=True))
+        time.sleep(0.5)
+        self._send_msg(msg.Interrupt(_hsid=40))
+        msgs = self._get_child_msgs(4, timeout=2.0)
+        self.assertEqual([m.type for m in msgs],
+                         [msg.PROGRESS, msg.EXCEPT, msg.DONE, msg.YES])
+        self.assertEqual(msgs[1]['etype'], 'KeyboardInterrupt')
+        # the children were killed and waited for
+        msgs = self._exec('try: os.waitpid(-1, os.WNOHANG)\n'
+                          'except OSError: print "no children"', 3)
+        self.assertEqual(msgs[0]['bytes'], 'no children')
+
+
+class TestWorkerMemoryLimits(WorkerTestCase):
+
+    worker_kwargs = {'max_as': 2 ** 30, 'max_rss': 200 * 2 ** 20,
+                     'rss_interval': 0.05}
+
+    def test_rss_limit(self):
+        self._send_msg(msg.ExecCell('x = " " * (300 * 2 ** 20)\n'
+                                    'while 1: pass', except_msg=True))
+        msgs = self._get_child_msgs(3, timeout=5.0)
+        self.assertEqual([m.type for m in msgs],
+                         [msg.MEMORY_USAGE, msg.EXCEPT, msg.DONE])
+        self.assertEqual(msgs[0]['level'], 'BREACH')
+        self.assertEqual(msgs[1]['etype'], 'MemoryLimitExceeded')
+
+    def test_address_space_limit(self):
+        self._send_msg(msg.ExecCell('x = " " * 2 ** 31', except_msg=True))
+        msgs = self._get_child_msgs(2, timeout=5.0)
+        self.assertEqual([m.type for m in msgs], [msg.EXCEPT, msg.DONE])
+        self.assertEqual(msgs[0]['etype'], 'MemoryError')
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file